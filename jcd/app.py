@@ -26,9 +26,18 @@
 import re
 import sys
 import json
+import time
+import codecs
 import argparse
+import itertools
 import requests
 
+# optional faster json decoder with the same api, stdlib is used otherwise
+try:
+    import simplejson as stream_json
+except ImportError:
+    stream_json = json
+
 import jcd.common
 import jcd.cmd
 
@@ -37,8 +46,54 @@ class ApiAccess(object):
 
     BaseUrl = "https://api.jcdecaux.com/vls/v1"
 
-    def __init__(self, apikey):
+    # connections kept alive in the pool, and (connect, read) timeouts
+    PoolSize = 4
+    Timeout = (10, 60)
+
+    # bytes read at once when streaming replies
+    ChunkSize = 65536
+
+    def __init__(self, apikey, pool_size=None, timeout=None, journal=None):
         self._apikey = apikey[0]
+        self._pool_size = self.PoolSize if pool_size is None else pool_size
+        self._timeout = self.Timeout if timeout is None else timeout
+        self._session = None
+        self._journal = journal
+        # timestamp of journaled replies, current time if None
+        self.timestamp = None
+
+    def open(self):
+        if self._session is None:
+            self._session = requests.Session()
+            # reuse connections across calls instead of a handshake per call
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=self._pool_size,
+                pool_maxsize=self._pool_size)
+            self._session.mount("https://", adapter)
+            self._session.mount("http://", adapter)
+            # ask for compressed transfers, decoded transparently by requests
+            self._session.headers.update({
+                "Accept": "application/json",
+                "Accept-Encoding": "gzip, deflate",
+                "Connection": "keep-alive",
+            })
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+        self._session = None
+
+    def __enter__(self):
+        # open the session if it's not already open
+        self.open()
+        # return self in case a 'as' statement is present
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # close the session and its pooled connections
+        self.close()
+        # don't suppress the eventual exception
+        return False
 
     @staticmethod
     def _parse_reply(reply_text):
@@ -54,18 +109,34 @@ class ApiAccess(object):
                 "JCDecaux API exception: %s" % reply_json["error"])
         return reply_json
 
+    def _get_timestamp(self):
+        if self.timestamp is None:
+            return int(time.time())
+        return self.timestamp
+
+    def _write_journal(self, sub_url, payload, chunks):
+        if self._journal is None:
+            return
+        for _ in self._journal.record(self._get_timestamp(),
+                sub_url, payload.get("contract", ""), chunks):
+            pass
+
     def _get(self, sub_url, payload=None):
         if payload is None:
             payload = {}
         # add the api key to the call
         payload["apiKey"] = self._apikey
         url = "%s/%s" % (self.BaseUrl, sub_url)
-        headers = {"Accept": "application/json"}
+        # session is opened lazily, and kept for subsequent calls
+        self.open()
         try:
-            request = requests.get(url, params=payload, headers=headers)
+            request = self._session.get(url, params=payload,
+                                        timeout=self._timeout)
             if request.status_code != requests.codes.ok:
                 raise jcd.common.JcdException("JCDecaux Requests exception: (%i) %s headers=%s content=%s" % (
                     request.status_code, url, repr(request.headers), repr(request.text)))
+            # keep the raw reply if requested
+            self._write_journal(sub_url, payload, [request.content])
             # avoid ultra-slow character set auto-detection
             # see https://github.com/kennethreitz/requests/issues/2359
             request.encoding = "utf-8"
@@ -76,9 +147,108 @@ class ApiAccess(object):
                 "JCDecaux Requests exception: (%s) %s" % (
                     type(exception).__name__, exception))
 
+    def _get_stream(self, sub_url, payload=None):
+        if payload is None:
+            payload = {}
+        # add the api key to the call
+        payload["apiKey"] = self._apikey
+        url = "%s/%s" % (self.BaseUrl, sub_url)
+        # session is opened lazily, and kept for subsequent calls
+        self.open()
+        request = None
+        try:
+            request = self._session.get(url, params=payload, stream=True,
+                                        timeout=self._timeout)
+            if request.status_code != requests.codes.ok:
+                raise jcd.common.JcdException("JCDecaux Requests exception: (%i) %s headers=%s content=%s" % (
+                    request.status_code, url, repr(request.headers), repr(request.text)))
+            # yield array items as soon as they are decoded
+            chunks = request.iter_content(self.ChunkSize)
+            if self._journal is not None:
+                chunks = self._journal.record(self._get_timestamp(),
+                    sub_url, payload.get("contract", ""), chunks)
+            for item in self.iter_reply(chunks):
+                yield item
+        except requests.exceptions.RequestException as exception:
+            raise jcd.common.JcdException(
+                "JCDecaux Requests exception: (%s) %s" % (
+                    type(exception).__name__, exception))
+        finally:
+            if request is not None:
+                request.close()
+
+    @classmethod
+    def iter_reply(cls, chunks):
+        # peek the first significant byte to detect api errors
+        chunks = iter(chunks)
+        head = ""
+        for chunk in chunks:
+            head += chunk
+            if head.strip():
+                break
+        chunks = itertools.chain([head], chunks)
+        if not head.lstrip().startswith("["):
+            # not an array: parse the whole reply, raising on api errors
+            reply = cls._parse_reply("".join(chunks).decode("utf-8"))
+            raise jcd.common.JcdException(
+                "Unexpected JSON reply : %s" % repr(reply))
+        return cls._iter_array(chunks)
+
+    @staticmethod
+    def _iter_array(chunks):
+        # decode one array item at a time, only the current item and the
+        # not yet decoded text are held in memory
+        decoder = stream_json.JSONDecoder()
+        utf8 = codecs.getincrementaldecoder("utf-8")()
+        separators = re.compile(r"[\s,]*")
+        spaces = re.compile(r"\s*")
+        text = u""
+        pos = 0
+        started = False
+        for chunk in itertools.chain(chunks, [None]):
+            last = chunk is None
+            text = text[pos:] + utf8.decode(chunk or "", last)
+            pos = separators.match(text).end()
+            # skip the opening bracket once
+            if not started:
+                if pos == len(text):
+                    continue
+                pos = separators.match(text, pos + 1).end()
+                started = True
+            while pos < len(text):
+                if text[pos] == "]":
+                    return
+                try:
+                    item, end = decoder.raw_decode(text, pos)
+                except ValueError as error:
+                    # item not fully received yet
+                    if not last:
+                        break
+                    print "%s: %s" % (type(error).__name__, error)
+                    raise jcd.common.JcdException(
+                        "Could not parse JSON reply near :\n%s" % (
+                            text[pos:pos+200], ))
+                # an item is complete once followed by a delimiter, as a
+                # number could go on in the next chunk (1 then .5)
+                follow = spaces.match(text, end).end()
+                if follow == len(text):
+                    break
+                if text[follow] not in u",]":
+                    if not last:
+                        break
+                    raise jcd.common.JcdException(
+                        "Could not parse JSON reply near :\n%s" % (
+                            text[pos:pos+200], ))
+                yield item
+                pos = separators.match(text, end).end()
+        raise jcd.common.JcdException("Truncated JSON reply")
+
     def get_all_stations(self):
         return self._get("stations")
 
+    def iter_all_stations(self):
+        return self._get_stream("stations")
+
     def get_contract_station(self, contract_name, station_id):
         return self._get("stations/%i" % station_id,
                          {"contract": contract_name})
@@ -117,6 +287,18 @@ class App(object):
             action='store_true',
             help='display operationnal informations'
         )
+        self._parser.add_argument(
+            '--wal',
+            action='store_true',
+            help='use write-ahead logging, so that reads do not block writes'
+        )
+        self._parser.add_argument(
+            '--busy-timeout',
+            type=float,
+            help='seconds to wait for a locked database (default: %s)' % (
+                jcd.common.SqliteDB.BusyTimeout),
+            default=jcd.common.SqliteDB.BusyTimeout
+        )
         # top level commands
         top_command = self._parser.add_subparsers(dest='command')
         # init command
@@ -170,6 +352,15 @@ class App(object):
             action='store_true',
             help='get current state'
         )
+        fetch.add_argument(
+            '--workers', '-w',
+            type=int,
+            help='fetch state by contract using parallel requests (default: fetch_workers setting)'
+        )
+        fetch.add_argument(
+            '--only', '-o',
+            help='comma separated contract names to fetch state for (default: fetch_only setting)'
+        )
         # store command
         top_command.add_parser(
             'store',
@@ -182,6 +373,51 @@ class App(object):
             help='do a full acquisition cycle',
             description='Fetch and store according to configuration'
         )
+        # daemon command
+        daemon = top_command.add_parser(
+            'daemon',
+            help='do acquisition cycles continuously',
+            description='Fetch and store at a fixed rate until terminated'
+        )
+        daemon.add_argument(
+            '--interval', '-i',
+            type=int,
+            help='seconds between cycles (default: %i)' % jcd.cmd.DaemonCmd.DefaultInterval,
+            default=jcd.cmd.DaemonCmd.DefaultInterval
+        )
+        daemon.add_argument(
+            '--adaptive', '-a',
+            action='store_true',
+            help='poll each contract according to its observed activity'
+        )
+        # replay command
+        replay = top_command.add_parser(
+            'replay',
+            help='store journaled API replies again',
+            description='Feed the API replies journal back into storage'
+        )
+        replay.add_argument(
+            'start',
+            type=self.date_type_check,
+            help='first day to replay (YYYY-MM-DD)'
+        )
+        replay.add_argument(
+            'end',
+            type=self.date_type_check,
+            nargs='?',
+            help='last day to replay (YYYY-MM-DD, default: start)'
+        )
+        replay.add_argument(
+            '--journal',
+            help='folder containing the journal to replay (default: data folder)'
+        )
+        replay.add_argument(
+            '--sync',
+            help='sqlite synchronous pragma: 0/1/2/3 (default: 0)',
+            type=int,
+            choices=range(0, 4),
+            default=0
+        )
         # import v1 command
         import_v1 = top_command.add_parser(
             'import_v1',
@@ -200,6 +436,22 @@ class App(object):
             choices=range(0, 4),
             default=0
         )
+        import_v1.add_argument(
+            '--jobs', '-j',
+            type=int,
+            help='import days in parallel, with this number of worker processes'
+        )
+        # stats command
+        stats = top_command.add_parser(
+            'stats',
+            help='aggregate station activity',
+            description='Aggregate the activity of each station by day and hour, into stats.db'
+        )
+        stats.add_argument(
+            '--rebuild',
+            action='store_true',
+            help='aggregate all days again, instead of the new or changed ones only'
+        )
         # export_csv command
         export_csv = top_command.add_parser(
             'export_csv',
@@ -211,6 +463,53 @@ class App(object):
             type=self.export_param_type_check,
             help="'contracts', 'stations', or date (YYYY-MM-DD)"
         )
+        export_csv.add_argument(
+            '--end',
+            type=self.date_type_check,
+            help='last day to export, when exporting samples (YYYY-MM-DD, default: source)'
+        )
+        export_csv.add_argument(
+            '--contract',
+            help='only export this contract (name)'
+        )
+        export_csv.add_argument(
+            '--station',
+            type=int,
+            help='only export this station (number) of the contract'
+        )
+        export_csv.add_argument(
+            '--output', '-o',
+            help='file to export to (default: standard output)'
+        )
+        export_csv.add_argument(
+            '--compress',
+            choices=jcd.common.OutputWriter.Compressions,
+            help='compress the export (default: from the output file extension, .gz or .xz)'
+        )
+        export_csv.add_argument(
+            '--output-dir',
+            help='folder to export to, one file per day (samples_YYYY_MM_DD.csv, and .gz or .xz)'
+        )
+        export_csv.add_argument(
+            '--jobs', '-j',
+            type=int,
+            help='days exported in parallel (default with --output-dir: one per cpu)'
+        )
+        export_csv.add_argument(
+            '--step',
+            type=int,
+            help='export the state of each station every STEP seconds, instead of its changes'
+        )
+        export_csv.add_argument(
+            '--binary',
+            action='store_true',
+            help='export the states as a binary matrix, instead of csv (needs --step)'
+        )
+        export_csv.add_argument(
+            '--at',
+            type=self.time_type_check,
+            help='export the state of each station at this time of the day (HH:MM or HH:MM:SS, UTC), instead of its changes'
+        )
 
     def run(self):
         try:
@@ -225,6 +524,11 @@ class App(object):
             # consume verbose
             App.Verbose = args.verbose
             del args.verbose
+            # consume database concurrency arguments
+            jcd.common.SqliteDB.Wal = args.wal
+            del args.wal
+            jcd.common.SqliteDB.BusyTimeout = args.busy_timeout
+            del args.busy_timeout
             # consume command
             command = getattr(self, args.command)
             del args.command
@@ -243,6 +547,25 @@ class App(object):
         except:
             raise argparse.ArgumentTypeError("String '%s' does not match required format"% value)
 
+    @staticmethod
+    def date_type_check(value):
+        try:
+            return re.match("^\d{4}-\d{2}-\d{2}$", value).group(0)
+        except:
+            raise argparse.ArgumentTypeError("String '%s' does not match required format"% value)
+
+    @staticmethod
+    def time_type_check(value):
+        # seconds since the start of the day
+        try:
+            match = re.match("^(\d{2}):(\d{2})(?::(\d{2}))?$", value)
+            hours, minutes, seconds = (int(group or 0) for group in match.groups())
+        except:
+            raise argparse.ArgumentTypeError("String '%s' does not match required format"% value)
+        if hours > 23 or minutes > 59 or seconds > 59:
+            raise argparse.ArgumentTypeError("Time '%s' is not within a day"% value)
+        return hours * 3600 + minutes * 60 + seconds
+
     @staticmethod
     def init(args):
         init = jcd.cmd.InitCmd(args)
@@ -273,11 +596,26 @@ class App(object):
         cron = jcd.cmd.CronCmd(args)
         cron.run()
 
+    @staticmethod
+    def daemon(args):
+        daemon = jcd.cmd.DaemonCmd(args)
+        daemon.run()
+
+    @staticmethod
+    def replay(args):
+        replay = jcd.cmd.ReplayCmd(args)
+        replay.run()
+
     @staticmethod
     def import_v1(args):
         import1 = jcd.cmd.Import1Cmd(args)
         import1.run()
 
+    @staticmethod
+    def stats(args):
+        stats = jcd.cmd.StatsCmd(args)
+        stats.run()
+
     @staticmethod
     def export_csv(args):
         exportcsv = jcd.cmd.ExportCsvCmd(args)
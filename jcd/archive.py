@@ -0,0 +1,309 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*- vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# The MIT License (MIT)
+#
+# Copyright (c) 2015-2016 Nicolas Pillot
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the 'Software'),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS', WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import sys
+import zlib
+import heapq
+import array
+import struct
+import os.path
+import itertools
+
+import jcd.common
+
+# compact storage for the archived samples of a closed day
+#
+# file layout (little endian) :
+# - header : magic, version, start of day timestamp, number of stations,
+#   then number of keyframes (from version 2)
+# - index, one entry per station ordered by contract and number :
+#   contract id, station number, number of samples, block offset and size
+# - keyframe index (from version 2), one entry per keyframe in time order :
+#   keyframe timestamp, block offset and size
+# - blocks, one per station : zlib compressed signed 32 bits integers,
+#   timestamp deltas (first one from the start of day), then bikes deltas,
+#   then stands deltas (first ones from zero)
+# - keyframe blocks, one per keyframe : zlib compressed signed 32 bits
+#   integers, the contract ids of the stations, their numbers, the age of
+#   their last change at the keyframe, their bikes, then their stands
+class CompactArchive(object):
+
+    Magic = "JCDA"
+    Version = 2
+    Extension = "jca"
+    HeaderFormat = "<4sHII"
+    KeyframeCountFormat = "<I"
+    IndexFormat = "<IIIQI"
+    KeyframeIndexFormat = "<IQI"
+
+    def __init__(self, file_path):
+        self._file_path = file_path
+        self._file = None
+        self._day_start = None
+        self._index = None
+        self._keyframes = None
+
+    @classmethod
+    def _encode(cls, day_start, samples):
+        timestamps = array.array("i")
+        bikes = array.array("i")
+        stands = array.array("i")
+        previous = (day_start, 0, 0)
+        for sample in samples:
+            timestamps.append(sample[0] - previous[0])
+            bikes.append(sample[1] - previous[1])
+            stands.append(sample[2] - previous[2])
+            previous = sample
+        timestamps.extend(bikes)
+        timestamps.extend(stands)
+        return cls._compress(timestamps)
+
+    @staticmethod
+    def _compress(values):
+        if sys.byteorder != "little":
+            values.byteswap()
+        return zlib.compress(values.tostring(), 9)
+
+    @classmethod
+    def _encode_keyframe(cls, keyframe, samples):
+        # samples are (timestamp, contract_id, station_number, bikes, stands)
+        values = array.array("i")
+        values.extend(sample[1] for sample in samples)
+        values.extend(sample[2] for sample in samples)
+        values.extend(keyframe - sample[0] for sample in samples)
+        values.extend(sample[3] for sample in samples)
+        values.extend(sample[4] for sample in samples)
+        return cls._compress(values)
+
+    @classmethod
+    def write(cls, file_path, day_start, samples, keyframes=()):
+        # samples are (timestamp, contract_id, station_number, bikes, stands),
+        # keyframes rows are the keyframe timestamp followed by a sample
+        stations = {}
+        for timestamp, contract_id, station_number, bikes, stands in samples:
+            stations.setdefault((contract_id, station_number), []).append(
+                (timestamp, bikes, stands))
+        blocks = []
+        for key in sorted(stations):
+            station_samples = sorted(stations[key])
+            blocks.append((key, len(station_samples),
+                           cls._encode(day_start, station_samples)))
+        frames = {}
+        for row in keyframes:
+            frames.setdefault(row[0], []).append(tuple(row)[1:])
+        frame_blocks = [(keyframe, cls._encode_keyframe(
+            keyframe, sorted(frames[keyframe], key=lambda sample: sample[1:3])))
+                        for keyframe in sorted(frames)]
+        # blocks follow the header and the indexes
+        offset = (struct.calcsize(cls.HeaderFormat) +
+                  struct.calcsize(cls.KeyframeCountFormat) +
+                  len(blocks) * struct.calcsize(cls.IndexFormat) +
+                  len(frame_blocks) * struct.calcsize(cls.KeyframeIndexFormat))
+        # never leave a partial file under the final name
+        temp_path = "%s.tmp" % file_path
+        with open(temp_path, "wb") as archive:
+            archive.write(struct.pack(
+                cls.HeaderFormat, cls.Magic, cls.Version, day_start, len(blocks)))
+            archive.write(struct.pack(cls.KeyframeCountFormat, len(frame_blocks)))
+            for key, count, block in blocks:
+                archive.write(struct.pack(
+                    cls.IndexFormat, key[0], key[1], count, offset, len(block)))
+                offset += len(block)
+            for keyframe, block in frame_blocks:
+                archive.write(struct.pack(
+                    cls.KeyframeIndexFormat, keyframe, offset, len(block)))
+                offset += len(block)
+            for key, count, block in blocks:
+                archive.write(block)
+            for keyframe, block in frame_blocks:
+                archive.write(block)
+        os.rename(temp_path, file_path)
+        # return number of stations
+        return len(blocks)
+
+    def open(self):
+        if self._file is None:
+            try:
+                self._file = open(self._file_path, "rb")
+                header_size = struct.calcsize(self.HeaderFormat)
+                magic, version, self._day_start, count = struct.unpack(
+                    self.HeaderFormat, self._file.read(header_size))
+                if magic != self.Magic or version not in (1, self.Version):
+                    raise jcd.common.JcdException(
+                        "[%s] is not a compact archive" % self._file_path)
+                # version 1 files have no keyframe
+                num_keyframes = 0
+                if version > 1:
+                    num_keyframes = struct.unpack(
+                        self.KeyframeCountFormat, self._file.read(
+                            struct.calcsize(self.KeyframeCountFormat)))[0]
+                self._index = self._read_index(self.IndexFormat, count)
+                self._keyframes = self._read_index(
+                    self.KeyframeIndexFormat, num_keyframes)
+            except (IOError, struct.error) as error:
+                self.close()
+                raise jcd.common.JcdException(
+                    "Could not read compact archive [%s]: %s" % (
+                        self._file_path, error))
+
+    def _read_index(self, entry_format, count):
+        entry_size = struct.calcsize(entry_format)
+        index = self._file.read(count * entry_size)
+        return [struct.unpack_from(entry_format, index, position)
+                for position in xrange(0, len(index), entry_size)]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def get_day_start(self):
+        return self._day_start
+
+    def get_stations(self):
+        # (contract_id, station_number, number of samples)
+        return [entry[:3] for entry in self._index]
+
+    def get_keyframes(self):
+        # timestamps of the keyframes, in time order
+        return [entry[0] for entry in self._keyframes]
+
+    def read_keyframe(self, keyframe, contract_id=None, station_number=None):
+        # last change of each station as of a keyframe, sorted by station
+        for entry in self._keyframes:
+            if entry[0] == keyframe:
+                break
+        else:
+            return
+        self._file.seek(entry[1])
+        values = self._decode(self._file.read(entry[2]))
+        count = len(values) // 5
+        for i in xrange(count):
+            if contract_id is not None and values[i] != contract_id:
+                continue
+            if station_number is not None and values[count + i] != station_number:
+                continue
+            yield (keyframe - values[2 * count + i], values[i], values[count + i],
+                   values[3 * count + i], values[4 * count + i])
+
+    def get_bounds(self):
+        # first and last timestamps of the day, None if there is no sample
+        first = None
+        last = None
+        for contract_id, station_number, count, offset, size in self._index:
+            self._file.seek(offset)
+            values = self._decode(self._file.read(size))
+            timestamp = self._day_start + values[0]
+            if first is None or timestamp < first:
+                first = timestamp
+            timestamp = self._day_start + sum(values[:count])
+            if last is None or timestamp > last:
+                last = timestamp
+        return first, last
+
+    @staticmethod
+    def _decode(block):
+        values = array.array("i")
+        values.fromstring(zlib.decompress(block))
+        if sys.byteorder != "little":
+            values.byteswap()
+        return values
+
+    def read_station(self, contract_id, station_number):
+        for entry in self._index:
+            if entry[0] == contract_id and entry[1] == station_number:
+                break
+        else:
+            return
+        self._file.seek(entry[3])
+        for sample in self._iter_block(contract_id, station_number, entry[2],
+                                       self._decode(self._file.read(entry[4]))):
+            yield sample
+
+    def _iter_block(self, contract_id, station_number, count, values):
+        timestamp = self._day_start
+        bikes = 0
+        stands = 0
+        for i in xrange(count):
+            timestamp += values[i]
+            bikes += values[count + i]
+            stands += values[2 * count + i]
+            yield timestamp, contract_id, station_number, bikes, stands
+
+    def read_all(self, contract_id=None, station_number=None):
+        # same order as the sqlite archives : timestamp, contract, station
+        # only the decoded blocks are kept, the samples of the stations are
+        # merged as they are read
+        blocks = []
+        for entry in self._index:
+            if contract_id is not None and entry[0] != contract_id:
+                continue
+            if station_number is not None and entry[1] != station_number:
+                continue
+            self._file.seek(entry[3])
+            blocks.append(self._iter_block(
+                entry[0], entry[1], entry[2], self._decode(self._file.read(entry[4]))))
+        return heapq.merge(*blocks)
+
+# regular grid of station states, see ShortSamplesDAO.list_grid
+#
+# file layout (little endian) :
+# - header : magic, version, first timestamp, step in seconds, number of
+#   steps, number of stations
+# - index, one entry per station ordered by contract and number :
+#   contract id, station number
+# - blocks, one per day : signed 16 bits integers, the bikes of each station
+#   at each step of the day (stations x steps), then their stands, -1 as
+#   long as the state of a station is unknown
+class GridMatrix(object):
+
+    Magic = "JCDG"
+    Version = 1
+    HeaderFormat = "<4sHIIII"
+    IndexFormat = "<II"
+
+    @classmethod
+    def get_header(cls, start, step, num_steps, stations):
+        header = [struct.pack(cls.HeaderFormat, cls.Magic, cls.Version,
+                              start, step, num_steps, len(stations))]
+        header.extend(struct.pack(cls.IndexFormat, *station) for station in stations)
+        return "".join(header)
+
+    @staticmethod
+    def get_block(all_bikes, all_stands):
+        block = array.array("h")
+        for values in itertools.chain(all_bikes, all_stands):
+            block.extend(values)
+        if sys.byteorder != "little":
+            block.byteswap()
+        return block.tostring()
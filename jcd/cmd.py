@@ -30,12 +30,19 @@ import errno
 import codecs
 import shutil
 import random
+import signal
+import sqlite3
+import calendar
+import tempfile
+import itertools
 import os.path
 import collections
+import multiprocessing.pool
 
 import jcd.common
 import jcd.app
 import jcd.dao
+import jcd.archive
 
 # initialize application data
 class InitCmd(object):
@@ -81,19 +88,24 @@ class InitCmd(object):
             settings.create_table()
             contracts = jcd.dao.ContractsDAO(app_db)
             contracts.create_table()
+            stations = jcd.dao.StationsDAO(app_db)
+            stations.create_table()
             full_samples = jcd.dao.FullSamplesDAO(app_db)
             full_samples.create_tables()
             short_samples = jcd.dao.ShortSamplesDAO(app_db)
             short_samples.create_changed_table()
+            archives = jcd.dao.ArchivesDAO(app_db)
+            archives.create_table()
 
     @staticmethod
     def set_default_parameters():
         with jcd.common.SqliteDB(jcd.app.App.DbName, jcd.app.App.DataPath) as app_db:
             settings = jcd.dao.SettingsDAO(app_db)
             for value in ConfigCmd.Parameters:
-                if jcd.app.App.Verbose and value[3] is not None:
-                    print "Setting parameter [%s] to default value [%s]" % (
-                        value[0], value[3])
+                if value[3] is not None:
+                    if jcd.app.App.Verbose:
+                        print "Setting parameter [%s] to default value [%s]" % (
+                            value[0], value[3])
                     settings.set_parameter(value[0], value[3])
             # if all went well
             app_db.commit()
@@ -113,11 +125,30 @@ class ConfigCmd(object):
     Parameters = (
         ('apikey', str, 'JCDecaux API key', None),
         ('contract_ttl', int, 'contracts refresh interval in seconds', 3600),
+        ('journal', int, 'keep a compressed journal of API replies (0: no, 1: yes)', 0),
+        ('storage_mode', str, "state storage: 'tables' (compare new and old samples tables), 'memory' (compare in memory, write changes only) or 'direct' (as memory, and archive changes at once)", 'tables'),
+        ('fetch_workers', int, 'parallel requests when fetching state by contract (0: all stations in one request)', 0),
+        ('fetch_only', str, 'comma separated contract names to limit state fetching to', None),
+        ('poll_min_interval', int, 'adaptive daemon: minimum seconds between two polls of a contract', 30),
+        ('poll_max_interval', int, 'adaptive daemon: maximum seconds between two polls of a contract', 600),
+        ('poll_budget', int, 'adaptive daemon: maximum API requests per minute', 30),
+        ('station_index', int, 'index closed days by station when optimizing archives, for faster station history (0: no, 1: yes)', 0),
+        ('keyframe_interval', int, 'seconds between two snapshots of the whole state in the daily databases, the first one when the day opens (0: none, 3600: hourly)', 86400),
     )
 
     def __init__(self, args):
         self._args = args
 
+    @staticmethod
+    def get_value(settings, param):
+        # stored value, or default value if it was never set
+        value = settings.get_parameter(param)[0]
+        if value is None:
+            for item in ConfigCmd.Parameters:
+                if item[0] == param:
+                    return item[3]
+        return value
+
     @staticmethod
     def display_parameter(param):
         with jcd.common.SqliteDB(jcd.app.App.DbName, jcd.app.App.DataPath) as app_db:
@@ -153,14 +184,117 @@ class ConfigCmd(object):
             for value in self.Parameters:
                 self.display_parameter(value[0])
 
+# run tasks in worker processes, one per cpu by default
+def run_pool(function, tasks, processes=None, ordered=False):
+    pool = multiprocessing.Pool(processes)
+    try:
+        # results in the order of the tasks, or as soon as available
+        if ordered:
+            results = pool.imap(function, tasks)
+        else:
+            results = pool.imap_unordered(function, tasks)
+        for result in results:
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+# optimize one archive database, at module level to run in worker processes
+def optimize_archive(task):
+    data_path, file_name, page_size, station_index = task
+    start = time.time()
+    full_path = jcd.common.SqliteDB.get_full_path(file_name, data_path)
+    size = os.path.getsize(full_path)
+    # page size can only be changed outside of wal mode
+    jcd.common.SqliteDB.Wal = False
+    try:
+        with jcd.common.SqliteDB(file_name, data_path) as archive_db:
+            short_dao = jcd.dao.ShortSamplesDAO(archive_db)
+            if archive_db.get_pragma("user_version") == AdminCmd.OptimizedVersion:
+                if not station_index or short_dao.has_station_index():
+                    return file_name, "already optimized", size, size, 0, None
+            converted = short_dao.has_rowid_archive()
+            if converted:
+                short_dao.rebuild_archived_table()
+                archive_db.commit()
+            if station_index:
+                short_dao.create_station_index()
+                archive_db.commit()
+            archive_db.set_pragma("journal_mode", "DELETE")
+            archive_db.set_pragma("page_size", page_size)
+            archive_db.vacuum()
+            archive_db.analyze()
+            archive_db.set_pragma("user_version", AdminCmd.OptimizedVersion)
+            archive_db.commit()
+    except jcd.common.JcdException as exception:
+        return file_name, "failed (%s)" % exception, size, size, time.time() - start, None
+    # the file will not change anymore
+    return (file_name, "converted" if converted else "optimized",
+            size, os.path.getsize(full_path), time.time() - start,
+            jcd.dao.ArchivesDAO.get_checksum(full_path))
+
+# merge daily databases into a monthly one, at module level as well
+def merge_month(task):
+    data_path, month, file_names, page_size, station_index = task
+    start = time.time()
+    month_filename = jcd.dao.ShortSamplesDAO.get_db_file_name(
+        jcd.dao.ShortSamplesDAO.get_schema_name(month))
+    size = 0
+    count = 0
+    try:
+        with jcd.common.SqliteDB(month_filename, data_path) as month_db:
+            short_dao = jcd.dao.ShortSamplesDAO(month_db)
+            short_dao.create_archived_table()
+            for file_name in file_names:
+                full_path = jcd.common.SqliteDB.get_full_path(file_name, data_path)
+                size += os.path.getsize(full_path)
+                day_schema = file_name[:-len(".db")]
+                # WARNING: attaching commits current transaction
+                month_db.attach_database(file_name, day_schema, data_path, True)
+                expected = month_db.get_count("%s.%s" % (
+                    day_schema, jcd.dao.ShortSamplesDAO.TableNameArchive))
+                merged = short_dao.merge_archived_samples(day_schema)
+                if merged != expected:
+                    raise jcd.common.JcdException(
+                        "Merged only %i of %i samples from [%s]" % (
+                            merged, expected, file_name))
+                if month_db.has_table(
+                        jcd.dao.ShortSamplesDAO.TableNameKeyframe, day_schema):
+                    short_dao.merge_keyframes(day_schema)
+                # modified, to be optimized again
+                month_db.set_pragma("user_version", 0)
+                month_db.commit()
+                # WARNING: detaching commits current transaction
+                month_db.detach_database(day_schema)
+                os.remove(full_path)
+                count += merged
+    except jcd.common.JcdException as exception:
+        return month_filename, "failed (%s)" % exception, size, size, time.time() - start, None
+    result = optimize_archive((data_path, month_filename, page_size, station_index))
+    return (month_filename, "%i days, %i samples, %s" % (
+        len(file_names), count, result[1]), size, result[3], time.time() - start,
+            result[5])
+
 # administration
 class AdminCmd(object):
 
     Parameters = (
         ('vacuum', 'defragment and trim sqlite database'),
         ('apitest', 'test JCDecaux API access'),
+        ('compact', 'convert archives of closed days to the compact format'),
+        ('merge-months', 'merge daily databases of closed months into monthly databases'),
+        ('optimize-archives', 'convert, vacuum and analyze daily and monthly databases'),
+        ('rebuild-catalog', 'rebuild the archives catalog from the archive files'),
+        ('check-archives', 'verify the archive files against the archives catalog'),
+        ('archive-stats', 'display archives statistics from the catalog'),
     )
 
+    # archives are marked once optimized, using the user_version pragma
+    OptimizedVersion = 1
+    # for the archives, larger pages only made full day reads slower
+    ArchivePageSize = 4096
+
     def __init__(self, args):
         self._args = args
 
@@ -183,42 +317,337 @@ class AdminCmd(object):
                 raise jcd.common.JcdException(
                     "API key is not set ! "
                     "Please configure using 'config --apikey'")
-            # real testing
-            api = jcd.app.ApiAccess(apikey)
-            # get all available contracts
-            if jcd.app.App.Verbose:
-                print "Searching contracts ..."
-            contracts = api.get_contracts()
-            count = len(contracts)
-            if jcd.app.App.Verbose:
-                print "Found %i contracts." % count
-            # get a random contract
-            rnd = random.randint(0, count-1)
-            contract = contracts[rnd]
-            if jcd.app.App.Verbose:
-                print "Fetching stations contract [%s] ..." % contract["name"]
-            stations = api.get_contract_stations(contract["name"])
-            count = len(stations)
-            if jcd.app.App.Verbose:
-                print "Found %i stations." % count
-            # get a random contract
-            rnd = random.randint(0, count-1)
-            station = stations[rnd]
-            if jcd.app.App.Verbose:
-                print "Fetching a single station [%i] of contract [%s] ..." % (
-                    station["number"], contract["name"])
-            station = api.get_contract_station(
-                contract["name"], station["number"])
+            # real testing, all calls share the same connection
+            with jcd.app.ApiAccess(apikey) as api:
+                # get all available contracts
+                if jcd.app.App.Verbose:
+                    print "Searching contracts ..."
+                contracts = api.get_contracts()
+                count = len(contracts)
+                if jcd.app.App.Verbose:
+                    print "Found %i contracts." % count
+                # get a random contract
+                rnd = random.randint(0, count-1)
+                contract = contracts[rnd]
+                if jcd.app.App.Verbose:
+                    print "Fetching stations contract [%s] ..." % contract["name"]
+                stations = api.get_contract_stations(contract["name"])
+                count = len(stations)
+                if jcd.app.App.Verbose:
+                    print "Found %i stations." % count
+                # get a random contract
+                rnd = random.randint(0, count-1)
+                station = stations[rnd]
+                if jcd.app.App.Verbose:
+                    print "Fetching a single station [%i] of contract [%s] ..." % (
+                        station["number"], contract["name"])
+                station = api.get_contract_station(
+                    contract["name"], station["number"])
             if jcd.app.App.Verbose:
                 print "Station name is [%s]" % station["name"]
             # test OK
             if jcd.app.App.Verbose:
                 print "API TEST SUCCESS"
 
+    @staticmethod
+    def _compact_day(date, db_filename):
+        schema_name = jcd.dao.ShortSamplesDAO.get_schema_name(date)
+        compact_filename = jcd.dao.ShortSamplesDAO.get_compact_file_name(schema_name)
+        db_path = jcd.common.SqliteDB.get_full_path(db_filename, jcd.app.App.DataPath)
+        compact_path = jcd.common.SqliteDB.get_full_path(
+            compact_filename, jcd.app.App.DataPath)
+        with jcd.common.SqliteDB(db_filename, jcd.app.App.DataPath,
+                                 read_only=True) as day_db:
+            day_dao = jcd.dao.ShortSamplesDAO(day_db)
+            jcd.archive.CompactArchive.write(
+                compact_path, day_dao.get_date_range(date)[0],
+                day_dao.list_archived_table("main"),
+                day_dao.list_keyframes("main"))
+            # verify everything before removing the database
+            with jcd.archive.CompactArchive(compact_path) as archive:
+                keyframes = ((keyframe, ) + sample
+                             for keyframe in archive.get_keyframes()
+                             for sample in archive.read_keyframe(keyframe))
+                for expected, sample in itertools.chain(
+                        itertools.izip_longest(day_dao.list_archived_table("main"),
+                                               archive.read_all()),
+                        itertools.izip_longest(day_dao.list_keyframes("main"),
+                                               keyframes)):
+                    if expected is None or sample is None or tuple(expected) != sample:
+                        os.remove(compact_path)
+                        raise jcd.common.JcdException(
+                            "Compact archive of [%s] differs, database kept" % date)
+                count = sum(station[2] for station in archive.get_stations())
+        if jcd.app.App.Verbose:
+            print "Compacted %s into %s (%i samples, %i -> %i bytes)" % (
+                db_filename, compact_filename, count,
+                os.path.getsize(db_path), os.path.getsize(compact_path))
+        os.remove(db_path)
+        size = os.path.getsize(compact_path)
+        checksum = jcd.dao.ArchivesDAO.get_checksum(compact_path)
+        with jcd.common.SqliteDB(jcd.app.App.DbName, jcd.app.App.DataPath) as app_db:
+            archives_dao = jcd.dao.ArchivesDAO(app_db)
+            archives_dao.open_table()
+            if archives_dao.update_file(db_filename, compact_filename,
+                                        jcd.dao.ArchivesDAO.FormatCompact,
+                                        size, checksum) == 0:
+                # not cataloged yet
+                archives_dao.set_day(date, compact_filename,
+                                     jcd.dao.ArchivesDAO.FormatCompact,
+                                     AdminCmd._get_compact_bounds(compact_path),
+                                     size, checksum)
+            app_db.commit()
+
+    @staticmethod
+    def _get_compact_bounds(full_path):
+        # number of samples, first and last timestamps, contract ids
+        with jcd.archive.CompactArchive(full_path) as archive:
+            stations = archive.get_stations()
+            return ((sum(station[2] for station in stations), ) +
+                    archive.get_bounds() +
+                    (set(station[0] for station in stations), ))
+
+    @staticmethod
+    def _get_closed_archives():
+        # daily databases of closed days, before today with everything stored
+        today = jcd.dao.ShortSamplesDAO.get_date(time.time())
+        with jcd.common.SqliteDB(jcd.app.App.DbName, jcd.app.App.DataPath,
+                                 read_only=True) as app_db:
+            short_dao = jcd.dao.ShortSamplesDAO(app_db)
+            pending = set(date for date, count in short_dao.get_changed_samples_stats())
+        closed = []
+        for date, file_name in jcd.dao.ShortSamplesDAO.find_archives():
+            schema_name = jcd.dao.ShortSamplesDAO.get_schema_name(date)
+            if file_name != jcd.dao.ShortSamplesDAO.get_db_file_name(schema_name):
+                continue
+            if date >= today or date in pending:
+                continue
+            if os.path.exists(jcd.common.SqliteDB.get_full_path(
+                    "%s-wal" % file_name, jcd.app.App.DataPath)):
+                print >>sys.stderr, "Database [%s] is in use, skipped" % file_name
+                continue
+            closed.append((date, file_name))
+        return closed
+
+    @staticmethod
+    def _report(results):
+        start = time.time()
+        reclaimed = 0
+        checksums = {}
+        for file_name, status, before, after, elapsed, checksum in results:
+            if status.startswith("failed"):
+                print >>sys.stderr, "Database [%s] %s" % (file_name, status)
+            if jcd.app.App.Verbose:
+                print "%s %s: %i -> %i bytes in %.2fs" % (
+                    file_name, status, before, after, elapsed)
+            reclaimed += before - after
+            checksums[file_name] = checksum
+        if jcd.app.App.Verbose:
+            # small files can grow, with a larger page size or an index
+            if reclaimed >= 0:
+                change = "%i bytes reclaimed" % reclaimed
+            else:
+                change = "size grew by %i bytes" % -reclaimed
+            print "%i databases processed, %s in %.1fs" % (
+                len(checksums), change, time.time() - start)
+        # checksum of every rewritten file, None if it was not
+        return checksums
+
+    @staticmethod
+    def _update_catalog(files):
+        # (previous file name, file name, format, checksum) of rewritten files
+        with jcd.common.SqliteDB(jcd.app.App.DbName, jcd.app.App.DataPath) as app_db:
+            archives_dao = jcd.dao.ArchivesDAO(app_db)
+            archives_dao.open_table()
+            for old_file_name, file_name, file_format, checksum in files:
+                archives_dao.update_file(
+                    old_file_name, file_name, file_format,
+                    os.path.getsize(jcd.common.SqliteDB.get_full_path(
+                        file_name, jcd.app.App.DataPath)),
+                    checksum)
+            app_db.commit()
+
+    @staticmethod
+    def _get_station_index():
+        with jcd.common.SqliteDB(jcd.app.App.DbName, jcd.app.App.DataPath,
+                                 read_only=True) as app_db:
+            settings = jcd.dao.SettingsDAO(app_db)
+            return int(ConfigCmd.get_value(settings, "station_index")) != 0
+
+    @staticmethod
+    def optimize_archives():
+        formats = collections.OrderedDict(
+            (file_name, jcd.dao.ArchivesDAO.FormatDaily)
+            for date, file_name in AdminCmd._get_closed_archives())
+        formats.update(
+            (file_name, jcd.dao.ArchivesDAO.FormatMonthly)
+            for month, file_name in jcd.dao.ShortSamplesDAO.find_monthly_archives())
+        station_index = AdminCmd._get_station_index()
+        tasks = [(jcd.app.App.DataPath, file_name, AdminCmd.ArchivePageSize,
+                  station_index)
+                 for file_name in formats]
+        checksums = AdminCmd._report(run_pool(optimize_archive, tasks))
+        AdminCmd._update_catalog(
+            (file_name, file_name, formats[file_name], checksum)
+            for file_name, checksum in checksums.iteritems()
+            if checksum is not None)
+
+    @staticmethod
+    def merge_months():
+        this_month = jcd.dao.ShortSamplesDAO.get_date(time.time())[:7]
+        months = collections.OrderedDict()
+        for date, file_name in AdminCmd._get_closed_archives():
+            if date[:7] < this_month:
+                months.setdefault(date[:7], []).append(file_name)
+        station_index = AdminCmd._get_station_index()
+        tasks = [(jcd.app.App.DataPath, month, file_names, AdminCmd.ArchivePageSize,
+                  station_index)
+                 for month, file_names in months.iteritems()]
+        checksums = AdminCmd._report(run_pool(merge_month, tasks))
+        # days merged before a failure are in the monthly database as well
+        files = []
+        for month, file_names in months.iteritems():
+            month_filename = jcd.dao.ShortSamplesDAO.get_db_file_name(
+                jcd.dao.ShortSamplesDAO.get_schema_name(month))
+            checksum = checksums.get(month_filename)
+            for file_name in [month_filename] + file_names:
+                if file_name == month_filename or not os.path.exists(
+                        jcd.common.SqliteDB.get_full_path(
+                            file_name, jcd.app.App.DataPath)):
+                    files.append((file_name, month_filename,
+                                  jcd.dao.ArchivesDAO.FormatMonthly, checksum))
+        AdminCmd._update_catalog(files)
+
+    @staticmethod
+    def compact():
+        for date, file_name in AdminCmd._get_closed_archives():
+            schema_name = jcd.dao.ShortSamplesDAO.get_schema_name(date)
+            if os.path.exists(jcd.common.SqliteDB.get_full_path(
+                    jcd.dao.ShortSamplesDAO.get_compact_file_name(schema_name),
+                    jcd.app.App.DataPath)):
+                print >>sys.stderr, "Both formats exist for [%s], not compacted" % date
+                continue
+            AdminCmd._compact_day(date, file_name)
+
+    @staticmethod
+    def _catalog_database(archives_dao, app_db, file_name, file_format, dates):
+        short_dao = jcd.dao.ShortSamplesDAO(app_db)
+        schema_name = file_name[:-len(".db")]
+        # WARNING: attaching commits current transaction
+        app_db.attach_database(file_name, schema_name, jcd.app.App.DataPath, True)
+        try:
+            if not app_db.has_table(short_dao.TableNameArchive, schema_name):
+                print >>sys.stderr, "No table for archived samples in [%s] database" % file_name
+                return
+            # optimized files are closed, and will not change anymore
+            checksum = None
+            full_path = jcd.common.SqliteDB.get_full_path(
+                file_name, jcd.app.App.DataPath)
+            if app_db.get_pragma("user_version", schema_name) == AdminCmd.OptimizedVersion:
+                checksum = jcd.dao.ArchivesDAO.get_checksum(full_path)
+            for date in dates:
+                bounds = short_dao.get_archived_bounds(schema_name, date)
+                if bounds[0] > 0:
+                    archives_dao.set_day(date, file_name, file_format, bounds,
+                                         os.path.getsize(full_path), checksum)
+        finally:
+            # WARNING: detaching commits current transaction
+            app_db.detach_database(schema_name)
+
+    @staticmethod
+    def rebuild_catalog():
+        with jcd.common.SqliteDB(jcd.app.App.DbName, jcd.app.App.DataPath) as app_db:
+            archives_dao = jcd.dao.ArchivesDAO(app_db)
+            archives_dao.create_table()
+            archives_dao.clear()
+            # same precedence as when reading : daily, compact, monthly
+            cataloged = set()
+            for date, file_name in jcd.dao.ShortSamplesDAO.find_archives():
+                if date in cataloged:
+                    print >>sys.stderr, "Both formats exist for [%s], using the database" % date
+                    continue
+                cataloged.add(date)
+                if file_name.endswith(".db"):
+                    AdminCmd._catalog_database(
+                        archives_dao, app_db, file_name,
+                        jcd.dao.ArchivesDAO.FormatDaily, [date])
+                    continue
+                full_path = jcd.common.SqliteDB.get_full_path(
+                    file_name, jcd.app.App.DataPath)
+                archives_dao.set_day(
+                    date, file_name, jcd.dao.ArchivesDAO.FormatCompact,
+                    AdminCmd._get_compact_bounds(full_path),
+                    os.path.getsize(full_path),
+                    jcd.dao.ArchivesDAO.get_checksum(full_path))
+            for month, file_name in jcd.dao.ShortSamplesDAO.find_monthly_archives():
+                year, month_number = [int(value) for value in month.split("-")]
+                dates = ["%s-%02i" % (month, day) for day in xrange(
+                    1, calendar.monthrange(year, month_number)[1] + 1)]
+                AdminCmd._catalog_database(
+                    archives_dao, app_db, file_name,
+                    jcd.dao.ArchivesDAO.FormatMonthly,
+                    [date for date in dates if date not in cataloged])
+            app_db.commit()
+            if jcd.app.App.Verbose:
+                print "Cataloged %i archive files" % (
+                    len(set(row["file_name"] for row in archives_dao.list())))
+
+    @staticmethod
+    def check_archives():
+        problems = 0
+        with jcd.common.SqliteDB(jcd.app.App.DbName, jcd.app.App.DataPath,
+                                 read_only=True) as app_db:
+            archives_dao = jcd.dao.ArchivesDAO(app_db)
+            files = collections.OrderedDict()
+            for row in archives_dao.list():
+                files[row["file_name"]] = (row["file_size"], row["checksum"])
+        on_disk = set(file_name for date, file_name in itertools.chain(
+            jcd.dao.ShortSamplesDAO.find_archives(),
+            jcd.dao.ShortSamplesDAO.find_monthly_archives()))
+        for file_name, (file_size, checksum) in files.iteritems():
+            full_path = jcd.common.SqliteDB.get_full_path(
+                file_name, jcd.app.App.DataPath)
+            if file_name not in on_disk:
+                print >>sys.stderr, "Archive [%s] is missing" % file_name
+                problems += 1
+            # only files which are not written to anymore can be verified
+            elif checksum is None:
+                continue
+            elif os.path.getsize(full_path) != file_size:
+                print >>sys.stderr, "Archive [%s] size is %i, %i expected" % (
+                    file_name, os.path.getsize(full_path), file_size)
+                problems += 1
+            elif jcd.dao.ArchivesDAO.get_checksum(full_path) != checksum:
+                print >>sys.stderr, "Archive [%s] checksum differs" % file_name
+                problems += 1
+            elif jcd.app.App.Verbose:
+                print "Archive [%s] verified" % file_name
+        for file_name in sorted(on_disk.difference(files)):
+            print >>sys.stderr, "Archive [%s] is not cataloged" % file_name
+            problems += 1
+        if problems > 0:
+            raise jcd.common.JcdException(
+                "%i archive problems found, see 'admin --rebuild-catalog'" % problems)
+        if jcd.app.App.Verbose:
+            print "%i archive files checked" % len(files)
+
+    @staticmethod
+    def archive_stats():
+        with jcd.common.SqliteDB(jcd.app.App.DbName, jcd.app.App.DataPath,
+                                 read_only=True) as app_db:
+            archives_dao = jcd.dao.ArchivesDAO(app_db)
+            # don't check for verbose, display is mandatory
+            for row in archives_dao.get_stats():
+                print "%s: %i files, %i days from %s to %s, %i samples, %i bytes" % (
+                    row["file_format"], row["num_files"], row["num_days"],
+                    row["first_date"], row["last_date"], row["num_samples"],
+                    row["file_size"])
+
     def run(self):
         args_dict = self._args.__dict__
         for param in AdminCmd.Parameters:
-            name = param[0]
+            # argparse turns dashes into underscores
+            name = param[0].replace("-", "_")
             if name in args_dict:
                 value = args_dict[name]
                 if isinstance(value, bool) and value:
@@ -232,59 +661,231 @@ class FetchCmd(object):
         self._args = args
         self._check_contracts_ttl = check_contracts_ttl
         self._timestamp = int(time.time())
+        self._api = None
+        self._app_db = None
+        self._contracts_dao = None
+        self._full_dao = None
 
-    def fetch_contracts(self):
-        with jcd.common.SqliteDB(jcd.app.App.DbName, jcd.app.App.DataPath) as app_db:
-            settings = jcd.dao.SettingsDAO(app_db)
-            dao = jcd.dao.ContractsDAO(app_db)
-            # in case of cron, check for refresh necessity
-            if self._check_contracts_ttl and not dao.is_refresh_needed():
-                return
+    def _get_api(self, settings):
+        # a single api access (and its pooled session) for all fetches
+        if self._api is None:
             # fetch api key
             apikey = settings.get_parameter("apikey")
             if apikey is None:
                 raise jcd.common.JcdException(
                     "API key is not set ! "
                     "Please configure using 'config --apikey'")
-            # get all available contracts
-            api = jcd.app.ApiAccess(apikey)
-            json_contracts = api.get_contracts()
-            new_contracts_count = dao.store_contracts(
-                json_contracts, self._timestamp)
-            # if everything went fine
-            app_db.commit()
-            if jcd.app.App.Verbose:
-                print "New contracts added: %i" % new_contracts_count
+            # keep a pooled connection for each worker
+            workers = self._get_fetch_mode(settings)[0]
+            # optionally keep every reply
+            journal = None
+            if ConfigCmd.get_value(settings, "journal"):
+                journal = jcd.common.ResponseJournal(jcd.app.App.DataPath)
+            self._api = jcd.app.ApiAccess(apikey, max(
+                workers, jcd.app.ApiAccess.PoolSize), journal=journal)
+        # replies are journaled with the cycle timestamp
+        self._api.timestamp = self._timestamp
+        return self._api
+
+    def close(self):
+        if self._api is not None:
+            self._api.close()
+        self._api = None
+
+    def _bind_database(self, app_db):
+        # daos cache contract ids and state, keep them as long as the database
+        if self._app_db is not app_db:
+            self._app_db = app_db
+            self._contracts_dao = jcd.dao.ContractsDAO(app_db)
+            self._full_dao = jcd.dao.FullSamplesDAO(app_db)
+
+    def _get_contracts_dao(self, app_db):
+        self._bind_database(app_db)
+        return self._contracts_dao
+
+    def _get_fetch_mode(self, settings):
+        # command line arguments override configuration
+        workers = getattr(self._args, "workers", None)
+        if workers is None:
+            workers = ConfigCmd.get_value(settings, "fetch_workers")
+        only = getattr(self._args, "only", None)
+        if only is None:
+            only = ConfigCmd.get_value(settings, "fetch_only")
+        if only:
+            only = [name.strip() for name in only.split(",") if name.strip()]
+        return int(workers), only
 
-    def fetch_state(self):
-        with jcd.common.SqliteDB(jcd.app.App.DbName, jcd.app.App.DataPath) as app_db:
-            settings = jcd.dao.SettingsDAO(app_db)
-            full_dao = jcd.dao.FullSamplesDAO(app_db)
-            short_dao = jcd.dao.ShortSamplesDAO(app_db)
-            # fetch api key
-            apikey = settings.get_parameter("apikey")
-            if apikey is None:
-                raise jcd.common.JcdException(
-                    "API key is not set ! "
-                    "Please configure using 'config --apikey'")
-            # get all station states
-            api = jcd.app.ApiAccess(apikey)
-            json_stations = api.get_all_stations()
-            num_new = full_dao.store_new_samples(json_stations, self._timestamp)
-            if jcd.app.App.Verbose:
-                print "New samples acquired: %i" % num_new
-            # analyse changes
-            num_changed = short_dao.find_changed_samples()
-            if jcd.app.App.Verbose:
-                print "Changed samples available for archive: %i" % num_changed
+    @staticmethod
+    def _fetch_contract(api, contract_name):
+        # runs in a worker thread, so errors are returned, not raised
+        start = time.time()
+        try:
+            stations = api.get_contract_stations(contract_name)
+            return contract_name, stations, time.time() - start, None
+        except jcd.common.JcdException as exception:
+            return contract_name, None, time.time() - start, exception
+
+    def _fetch_by_contract(self, api, contracts_dao, workers, only):
+        names = [contract["contract_name"] for contract in contracts_dao.list()]
+        if len(names) == 0:
+            raise jcd.common.JcdException(
+                "No contract available, please use 'fetch --contracts' first")
+        # limit to the requested contracts
+        if only:
+            for name in only:
+                if name not in names:
+                    print >>sys.stderr, "Unknown contract [%s] ignored" % name
+            names = [name for name in names if name in only]
+        # fetch contracts concurrently
+        pool = multiprocessing.pool.ThreadPool(max(workers, 1))
+        try:
+            results = pool.map(
+                lambda name: self._fetch_contract(api, name), names)
+        finally:
+            pool.close()
+            pool.join()
+        # merge every contract into a single snapshot
+        json_stations = []
+        fetched = {}
+        for name, stations, elapsed, error in results:
+            if error is not None:
+                print >>sys.stderr, "JcdException: contract [%s] failed after %.3fs: %s" % (
+                    name, elapsed, error)
+                continue
+            json_stations.extend(stations)
+            fetched[name] = len(stations)
+        # report per-contract latency, slowest first
+        if jcd.app.App.Verbose:
+            for name, stations, elapsed, error in sorted(
+                    results, key=lambda result: result[2], reverse=True):
+                if error is None:
+                    print "Contract [%s]: %i stations in %.3fs" % (
+                        name, len(stations), elapsed)
+        if len(fetched) == 0:
+            raise jcd.common.JcdException(
+                "State could not be fetched for any contract")
+        return json_stations, fetched
+
+    def fetch_contracts(self, app_db):
+        settings = jcd.dao.SettingsDAO(app_db)
+        dao = self._get_contracts_dao(app_db)
+        # in case of cron, check for refresh necessity
+        if self._check_contracts_ttl and not dao.is_refresh_needed():
+            return
+        # get all available contracts
+        api = self._get_api(settings)
+        json_contracts = api.get_contracts()
+        self.store_contracts(app_db, json_contracts, self._timestamp)
+
+    def store_contracts(self, app_db, json_contracts, timestamp):
+        dao = self._get_contracts_dao(app_db)
+        new_contracts_count = dao.store_contracts(json_contracts, timestamp)
+        # if everything went fine
+        app_db.commit()
+        if jcd.app.App.Verbose:
+            print "New contracts added: %i" % new_contracts_count
+
+    def fetch_state(self, app_db, contracts=None):
+        settings = jcd.dao.SettingsDAO(app_db)
+        contracts_dao = self._get_contracts_dao(app_db)
+        workers, only = self._get_fetch_mode(settings)
+        # explicit contracts override configuration
+        if contracts is not None:
+            only = contracts
+        # get all station states
+        api = self._get_api(settings)
+        fetched = None
+        if workers > 0 or only:
+            json_stations, fetched = self._fetch_by_contract(
+                api, contracts_dao, workers, only)
+        else:
+            # stations are decoded and stored while being received
+            json_stations = api.iter_all_stations()
+        return self.store_state(app_db, json_stations, self._timestamp, fetched)
+
+    def store_state(self, app_db, json_stations, timestamp, fetched=None):
+        self._bind_database(app_db)
+        settings = jcd.dao.SettingsDAO(app_db)
+        short_dao = jcd.dao.ShortSamplesDAO(app_db)
+        contract_ids = self._contracts_dao.get_contract_ids()
+        storage_mode = ConfigCmd.get_value(settings, "storage_mode")
+        if storage_mode == "direct":
+            # before any change, as attaching commits
+            schema_name, created = short_dao.attach_archive(
+                short_dao.get_date(timestamp))
+            if jcd.app.App.Verbose and created:
+                print "Database [%s] created" % short_dao.get_db_file_name(
+                    schema_name)
+            jcd.dao.ArchivesDAO(app_db).open_table()
+        changed = None
+        try:
+            if storage_mode == "tables":
+                num_new = self._full_dao.store_new_samples(
+                    json_stations, timestamp, contract_ids)
+                if jcd.app.App.Verbose:
+                    print "New samples acquired: %i" % num_new
+                # analyse changes
+                num_changed = short_dao.find_changed_samples()
+                if jcd.app.App.Verbose:
+                    print "Changed samples available for archive: %i" % num_changed
+            else:
+                num_new, changed = self._full_dao.update_state(
+                    json_stations, timestamp, contract_ids)
+                if jcd.app.App.Verbose:
+                    print "New samples acquired: %i" % num_new
+                if storage_mode == "direct":
+                    # in the same transaction as the state
+                    short_dao.insert_samples(changed, schema_name)
+                    jcd.dao.ArchivesDAO(app_db).add_samples(
+                        short_dao.get_date(timestamp),
+                        short_dao.get_db_file_name(schema_name),
+                        (len(changed), timestamp, timestamp,
+                         set(sample[1] for sample in changed)),
+                        app_db.get_size(schema_name), schema_name)
+                    if jcd.app.App.Verbose:
+                        print "Archived %i changed samples into %s" % (
+                            len(changed), schema_name)
+                else:
+                    num_changed = short_dao.insert_changed_samples(changed)
+                    if jcd.app.App.Verbose:
+                        print "Changed samples available for archive: %i" % num_changed
             # if everything went fine
             app_db.commit()
-
-    def run(self):
+        except:
+            self._full_dao.reset_state()
+            raise
+        self._full_dao.commit_state()
+        # when fetched by contract, give stations and changes by contract
+        stats = None
+        if fetched is not None:
+            stats = dict((name, (count, 0)) for name, count in fetched.iteritems())
+            if changed is not None:
+                names = dict((contract_id, name)
+                             for name, contract_id in contract_ids.iteritems())
+                counts = collections.Counter(names[sample[1]] for sample in changed)
+            else:
+                counts = short_dao.get_changed_contracts_stats()
+                counts = dict((name, count) for name, count in counts)
+            for name, count in counts.iteritems():
+                if name in stats:
+                    stats[name] = (stats[name][0], count)
+        return stats
+
+    def fetch(self, app_db, timestamp=None, contracts=None):
+        # a single fetch cycle on an already open database
+        if timestamp is not None:
+            self._timestamp = timestamp
         if self._args.contracts:
-            self.fetch_contracts()
+            self.fetch_contracts(app_db)
         if self._args.state:
-            self.fetch_state()
+            return self.fetch_state(app_db, contracts)
+
+    def run(self):
+        try:
+            with jcd.common.SqliteDB(jcd.app.App.DbName, jcd.app.App.DataPath) as app_db:
+                self.fetch(app_db)
+        finally:
+            self.close()
 
 # store state into database:
 class StoreCmd(object):
@@ -293,46 +894,89 @@ class StoreCmd(object):
         self._args = args
 
     @staticmethod
-    def run():
-        with jcd.common.SqliteDB(jcd.app.App.DbName, jcd.app.App.DataPath) as app_db:
-            full_dao = jcd.dao.FullSamplesDAO(app_db)
-            short_dao = jcd.dao.ShortSamplesDAO(app_db)
-            # daily databases are used
-            stats = short_dao.get_changed_samples_stats()
-            for date, count in stats:
-                # create, initialize databases as necessary
-                schema_name = short_dao.get_schema_name(date)
-                db_filename = short_dao.get_db_file_name(schema_name)
-                # prepare archive storage if needed
-                created = short_dao.initialize_archived_table(db_filename)
-                if jcd.app.App.Verbose and created:
-                    print "Database [%s] created" % db_filename
-                # WARNING: attaching commits current transaction
-                app_db.attach_database(db_filename, schema_name, jcd.app.App.DataPath)
-                # moving changed samples to attached db
-                if jcd.app.App.Verbose:
-                    print "Archiving %i changed samples into %s" % (
-                        count, schema_name)
-                # archive changed samples from date
-                num_stored = short_dao.archive_changed_samples(
-                    date, schema_name)
-                if num_stored != count:
-                    raise jcd.common.JcdException(
-                        "Not all changed samples could be archived")
-                # age new samples into old
-                num_aged = full_dao.age_samples(date)
-                if jcd.app.App.Verbose:
-                    print "Aged %i samples for %s" % (num_aged, date)
-                # if everything went fine for this date
-                app_db.commit()
-                # WARNING: detaching commits current transaction
-                app_db.detach_database(schema_name)
-            # verify nothing changed remains after processing
-            # unchanged new are not aged, old holds last change
-            remain_changed = short_dao.get_changed_count()
-            if remain_changed > 0:
+    def store(app_db):
+        full_dao = jcd.dao.FullSamplesDAO(app_db)
+        short_dao = jcd.dao.ShortSamplesDAO(app_db)
+        archives_dao = jcd.dao.ArchivesDAO(app_db)
+        archives_dao.open_table()
+        # daily databases are used
+        stats = short_dao.get_changed_samples_stats()
+        for date, count in stats:
+            # create, initialize, attach databases as necessary
+            # WARNING: attaching commits current transaction
+            schema_name, created = short_dao.attach_archive(date)
+            if jcd.app.App.Verbose and created:
+                print "Database [%s] created" % short_dao.get_db_file_name(
+                    schema_name)
+            # moving changed samples to attached db
+            if jcd.app.App.Verbose:
+                print "Archiving %i changed samples into %s" % (
+                    count, schema_name)
+            # archive changed samples from date
+            bounds = short_dao.get_changed_bounds(date)
+            num_stored = short_dao.archive_changed_samples(
+                date, schema_name)
+            if num_stored != count:
                 raise jcd.common.JcdException(
-                    "Unprocessed changes: %i" % remain_changed)
+                    "Not all changed samples could be archived")
+            archives_dao.add_samples(
+                date, short_dao.get_db_file_name(schema_name), bounds,
+                app_db.get_size(schema_name), schema_name)
+            # age new samples into old
+            num_aged = full_dao.age_samples(date)
+            if jcd.app.App.Verbose:
+                print "Aged %i samples for %s" % (num_aged, date)
+            # if everything went fine for this date
+            app_db.commit()
+            app_db.checkpoint(schema_name)
+        # verify nothing changed remains after processing
+        # unchanged new are not aged, old holds last change
+        remain_changed = short_dao.get_changed_count()
+        if remain_changed > 0:
+            raise jcd.common.JcdException(
+                "Unprocessed changes: %i" % remain_changed)
+        StoreCmd.store_keyframe(app_db)
+        app_db.checkpoint()
+
+    @staticmethod
+    def store_keyframe(app_db):
+        # once every change is archived, the state table is a snapshot of
+        # the whole network, stored once per interval in the daily database
+        interval = ConfigCmd.get_value(jcd.dao.SettingsDAO(app_db), "keyframe_interval")
+        if interval <= 0:
+            return
+        timestamp = jcd.dao.FullSamplesDAO(app_db).get_state_timestamp()
+        if timestamp is None:
+            return
+        short_dao = jcd.dao.ShortSamplesDAO(app_db)
+        date = short_dao.get_date(timestamp)
+        day_start = short_dao.get_date_range(date)[0]
+        period_start = timestamp - (timestamp - day_start) % interval
+        # WARNING: attaching commits current transaction
+        schema_name = short_dao.attach_archive(date)[0]
+        if short_dao.get_last_keyframe(schema_name, period_start, timestamp + 1) is not None:
+            return
+        # the state table holds the current values, but not when each
+        # station last changed : that comes from the previous keyframe and
+        # the changes after it, or from the state table when the history
+        # does not reach that far
+        history = dict(((sample[1], sample[2]), sample)
+                       for sample in short_dao.get_state_at(timestamp))
+        samples = []
+        for sample in jcd.dao.FullSamplesDAO(app_db).list_state():
+            last = history.get((sample[1], sample[2]))
+            if last is not None and tuple(last)[3:] == tuple(sample)[3:]:
+                sample = last
+            samples.append(tuple(sample))
+        count = short_dao.store_keyframe(timestamp, samples, schema_name)
+        app_db.commit()
+        app_db.checkpoint(schema_name)
+        if jcd.app.App.Verbose:
+            print "Keyframe of %i stations stored into %s" % (count, schema_name)
+
+    def run(self):
+        with jcd.common.SqliteDB(jcd.app.App.DbName, jcd.app.App.DataPath) as app_db:
+            self.store(app_db)
 
 # store state into database:
 class CronCmd(object):
@@ -345,10 +989,337 @@ class CronCmd(object):
         from argparse import Namespace
         params = Namespace(state=True, contracts=True)
         fetch = FetchCmd(params, check_contracts_ttl=True)
-        fetch.run()
         params = Namespace()
         store = StoreCmd(params)
-        store.run()
+        # a single database connection for the whole cycle
+        try:
+            with jcd.common.SqliteDB(jcd.app.App.DbName, jcd.app.App.DataPath) as app_db:
+                fetch.fetch(app_db)
+                store.store(app_db)
+        finally:
+            fetch.close()
+
+# per contract polling intervals, driven by observed changes
+class PollScheduler(object):
+
+    # expected fraction of changed stations between two polls
+    TargetChange = 0.1
+    # weight of the latest observation in the smoothed change rate
+    Smoothing = 0.3
+
+    def __init__(self, min_interval, max_interval, budget):
+        self._min_interval = float(min_interval)
+        self._max_interval = float(max(min_interval, max_interval))
+        self._budget = float(budget)
+        # contract name -> [change rate per second, wanted interval, last poll]
+        self._contracts = {}
+
+    def _get_factor(self):
+        # requests per minute implied by the wanted intervals
+        load = sum(60.0 / info[1] for info in self._contracts.itervalues())
+        # the budget wins over the maximum interval
+        return max(1.0, load / self._budget)
+
+    def _next_poll(self, info, factor):
+        if info[2] is None:
+            return None
+        return info[2] + info[1] * factor
+
+    def due(self, names, now, tick):
+        # forget removed contracts, new contracts are due at once
+        for name in self._contracts.keys():
+            if name not in names:
+                del self._contracts[name]
+        for name in names:
+            if name not in self._contracts:
+                self._contracts[name] = [None, self._max_interval, None]
+        # most late contracts first, within the requests allowed this tick
+        factor = self._get_factor()
+        late = []
+        for name, info in self._contracts.iteritems():
+            next_poll = self._next_poll(info, factor)
+            if next_poll is None or next_poll <= now:
+                late.append((next_poll, name))
+        late.sort()
+        allowed = max(1, int(self._budget * tick / 60.0))
+        return [name for next_poll, name in late[:allowed]]
+
+    def update(self, name, now, num_stations, num_changed):
+        info = self._contracts[name]
+        if info[2] is not None and num_stations > 0 and now > info[2]:
+            rate = float(num_changed) / num_stations / (now - info[2])
+            if info[0] is None:
+                info[0] = rate
+            else:
+                info[0] += self.Smoothing * (rate - info[0])
+        # poll when the target fraction of stations is expected to change
+        if info[0]:
+            interval = self.TargetChange / info[0]
+        elif info[2] is None:
+            interval = self._min_interval
+        else:
+            interval = self._max_interval
+        info[1] = min(max(interval, self._min_interval), self._max_interval)
+        info[2] = now
+
+    def failed(self, name, now):
+        # retry after the minimum interval, without learning anything
+        info = self._contracts[name]
+        info[2] = now - info[1] + self._min_interval
+
+    def intervals(self):
+        factor = self._get_factor()
+        return sorted((name, info[1] * factor, info[0])
+                      for name, info in self._contracts.iteritems())
+
+# long running acquisition
+class DaemonCmd(object):
+
+    DefaultInterval = 60
+
+    def __init__(self, args):
+        self._args = args
+        self._running = False
+        self._scheduler = None
+
+    def _stop(self, signum, frame):
+        if jcd.app.App.Verbose:
+            print "Received signal %i, stopping" % signum
+        self._running = False
+
+    def _sleep_until(self, deadline):
+        # signals interrupt the sleep, so check for shutdown regularly
+        while self._running:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(remaining)
+
+    @staticmethod
+    def _abort_cycle(app_db, exception):
+        # a failed cycle must not stop the acquisition
+        print >>sys.stderr, "%s: %s" % (type(exception).__name__, exception)
+        try:
+            app_db.rollback()
+            app_db.detach_all_databases()
+        except (jcd.common.JcdException, sqlite3.Error) as error:
+            print >>sys.stderr, "%s: %s" % (type(error).__name__, error)
+
+    @staticmethod
+    def _cycle(app_db, fetch, store):
+        start = time.time()
+        try:
+            fetch.fetch(app_db, int(start))
+            store.store(app_db)
+        # a database locked for too long, or a malformed station record
+        except (jcd.common.JcdException, sqlite3.Error,
+                KeyError, TypeError, ValueError) as exception:
+            DaemonCmd._abort_cycle(app_db, exception)
+        if jcd.app.App.Verbose:
+            print "Cycle done in %.3fs" % (time.time() - start)
+
+    @staticmethod
+    def _prepare_day(app_db, timestamp):
+        # create and attach the daily database ahead of the first cycle of
+        # a day, so that this cycle is not slower than the others
+        short_dao = jcd.dao.ShortSamplesDAO(app_db)
+        try:
+            schema_name, created = short_dao.attach_archive(
+                short_dao.get_date(timestamp))
+        except jcd.common.JcdException as exception:
+            print >>sys.stderr, "JcdException: %s" % exception
+            return
+        if jcd.app.App.Verbose and created:
+            print "Database [%s] created" % short_dao.get_db_file_name(
+                schema_name)
+
+    def _get_scheduler(self, app_db):
+        if self._scheduler is None:
+            settings = jcd.dao.SettingsDAO(app_db)
+            self._scheduler = PollScheduler(
+                ConfigCmd.get_value(settings, "poll_min_interval"),
+                ConfigCmd.get_value(settings, "poll_max_interval"),
+                ConfigCmd.get_value(settings, "poll_budget"))
+        return self._scheduler
+
+    def _adaptive_cycle(self, app_db, fetch, store):
+        start = time.time()
+        scheduler = self._get_scheduler(app_db)
+        due = []
+        try:
+            # contracts are refreshed according to their ttl
+            fetch.fetch(app_db, int(start))
+            contracts_dao = jcd.dao.ContractsDAO(app_db)
+            names = [contract["contract_name"] for contract in contracts_dao.list()]
+            due = scheduler.due(names, start, self._args.interval)
+            if len(due) > 0:
+                stats = fetch.fetch_state(app_db, due)
+                store.store(app_db)
+                for name in due:
+                    if name in stats:
+                        scheduler.update(name, start, *stats[name])
+                    else:
+                        scheduler.failed(name, start)
+        # a database locked for too long, or a malformed station record
+        except (jcd.common.JcdException, sqlite3.Error,
+                KeyError, TypeError, ValueError) as exception:
+            self._abort_cycle(app_db, exception)
+            for name in due:
+                scheduler.failed(name, start)
+        if jcd.app.App.Verbose:
+            for name, interval, rate in scheduler.intervals():
+                print "Contract [%s] polled every %is (%s changes/min)" % (
+                    name, interval,
+                    "?" if rate is None else "%.1f%%" % (rate * 6000))
+            print "Cycle done in %.3fs" % (time.time() - start)
+
+    def run(self):
+        from argparse import Namespace
+        interval = self._args.interval
+        if interval <= 0:
+            raise jcd.common.JcdException("Interval must be positive")
+        # everything is kept warm across cycles
+        if self._args.adaptive:
+            # state is fetched by the adaptive cycle itself
+            fetch = FetchCmd(Namespace(state=False, contracts=True),
+                             check_contracts_ttl=True)
+            cycle = self._adaptive_cycle
+        else:
+            fetch = FetchCmd(Namespace(state=True, contracts=True),
+                             check_contracts_ttl=True)
+            cycle = self._cycle
+        store = StoreCmd(Namespace())
+        self._running = True
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        try:
+            with jcd.common.SqliteDB(jcd.app.App.DbName, jcd.app.App.DataPath) as app_db:
+                # cycles are aligned on multiples of the interval, and
+                # scheduled from there, so they do not drift
+                next_run = (int(time.time()) // interval + 1) * interval
+                while self._running:
+                    self._sleep_until(next_run)
+                    if not self._running:
+                        break
+                    cycle(app_db, fetch, store)
+                    next_run += interval
+                    # skip cycles instead of stacking them after an overrun
+                    late = time.time() - next_run
+                    if late >= 0:
+                        skipped = int(late // interval) + 1
+                        next_run += skipped * interval
+                        print >>sys.stderr, "Cycle overrun, %i cycle(s) skipped" % skipped
+                    # next cycle is the first of a new day
+                    if time.gmtime(next_run).tm_yday != time.gmtime().tm_yday:
+                        self._prepare_day(app_db, next_run)
+        finally:
+            fetch.close()
+
+# feed journaled API replies back into the store pipeline
+class ReplayCmd(object):
+
+    def __init__(self, args):
+        from argparse import Namespace
+        self._args = args
+        self._n_cycles = 0
+        # storage is the same as for fetched replies
+        self._fetch = FetchCmd(Namespace(contracts=False, state=False))
+
+    def _get_range(self):
+        start = calendar.timegm(time.strptime(self._args.start, "%Y-%m-%d"))
+        end = self._args.end if self._args.end is not None else self._args.start
+        end = calendar.timegm(time.strptime(end, "%Y-%m-%d")) + 86400
+        if end <= start:
+            raise jcd.common.JcdException("End date is before start date")
+        return start, end
+
+    def _replay_group(self, app_db, timestamp, endpoint, bodies):
+        if endpoint == "contracts":
+            for body in bodies:
+                json_contracts = list(jcd.app.ApiAccess.iter_reply([body]))
+                self._fetch.store_contracts(app_db, json_contracts, timestamp)
+            return
+        # contracts fetched separately in the same cycle form one snapshot
+        json_stations = itertools.chain.from_iterable(
+            jcd.app.ApiAccess.iter_reply([body]) for body in bodies)
+        self._fetch.store_state(app_db, json_stations, timestamp)
+        StoreCmd.store(app_db)
+        self._n_cycles += 1
+
+    def _replay(self, app_db, journal, start, end):
+        group = None
+        bodies = []
+        for timestamp, endpoint, query, body in journal.read(start, end):
+            # single station replies are not part of a snapshot
+            if endpoint not in ("contracts", "stations"):
+                continue
+            # interrupted replies or api errors were not stored either
+            if not body.rstrip().endswith("]"):
+                print >>sys.stderr, "Skipping incomplete %s reply from %i" % (
+                    endpoint, timestamp)
+                continue
+            if group != (timestamp, endpoint):
+                if group is not None:
+                    self._replay_group(app_db, group[0], group[1], bodies)
+                group = (timestamp, endpoint)
+                bodies = []
+            bodies.append(body)
+        if group is not None:
+            self._replay_group(app_db, group[0], group[1], bodies)
+
+    def run(self):
+        start, end = self._get_range()
+        path = self._args.journal
+        if path is None:
+            path = jcd.app.App.DataPath
+        journal = jcd.common.ResponseJournal(path)
+        begin = time.time()
+        with jcd.common.SqliteDB(jcd.app.App.DbName, jcd.app.App.DataPath) as app_db:
+            # replaying is not collecting, go as fast as the disk allows
+            app_db.set_synchronous("main", self._args.sync)
+            self._replay(app_db, journal, start, end)
+        if jcd.app.App.Verbose:
+            print "Replayed %i cycles in %.3fs" % (
+                self._n_cycles, time.time() - begin)
+
+# import the version 1 samples of one day, at module level to run in worker
+# processes : each day has its own target database
+def import_day(task):
+    data_path, source, date, contract_ids, sync, resumed, earliest_timestamp = task
+    start = time.time()
+    file_name = jcd.dao.ShortSamplesDAO.get_db_file_name(
+        jcd.dao.ShortSamplesDAO.get_schema_name(date))
+    n_read = 0
+    n_extracted = 0
+    n_stored = 0
+    try:
+        with jcd.common.SqliteDB(file_name, data_path) as day_db:
+            day_db.set_synchronous("main", sync)
+            short_dao = jcd.dao.ShortSamplesDAO(day_db)
+            short_dao.create_archived_table()
+            day_db.attach_database(Import1Cmd.DefaultFile,
+                                   jcd.dao.Version1Dao.SchemaName, source, True)
+            # do not go beyond what is already in db, unless the day was
+            # partly imported from csv, and its limit is known already
+            if not resumed:
+                earliest_timestamp = short_dao.get_overall_earliest_timestamp("main")
+            # same deduplication as the sequential import : the first sample
+            # of a station on that day, then only when it changes, done by
+            # sqlite one timestamp after the other
+            dao_v1 = jcd.dao.Version1Dao(day_db)
+            dao_v1.create_work_tables(contract_ids)
+            n_read = dao_v1.get_day_count(date)
+            for timestamp in dao_v1.list_day_timestamps(date):
+                n_extracted += dao_v1.find_changed_samples(timestamp)
+                n_stored += dao_v1.store_changed_samples("main", earliest_timestamp)
+            day_db.commit()
+            bounds = short_dao.get_archived_bounds("main")
+            size = day_db.get_size("main")
+    except jcd.common.JcdException as exception:
+        return (date, file_name, n_read, n_extracted, 0, None, 0,
+                earliest_timestamp, time.time() - start, str(exception))
+    return (date, file_name, n_read, n_extracted, n_stored, bounds, size,
+            earliest_timestamp, time.time() - start, None)
 
 # import data from version 1
 class Import1Cmd(object):
@@ -356,11 +1327,17 @@ class Import1Cmd(object):
     DefaultFile = "jcd.sqlite3"
     DefaultPath = "~/.jcd"
 
+    # temporary csv files, in the data folder
+    FolderName = "import_v1"
+
     def __init__(self, args):
         self._args = args
         self._app_db = None
         self._short_dao = None
         self._dao_v1 = None
+        self._ledger_dao = None
+        self._source = None
+        self._days = None
         self._f_date_str = None
         self._daily_schema_name = None
         self._kept_samples = None
@@ -388,24 +1365,36 @@ class Import1Cmd(object):
             raise jcd.common.JcdException(
                 "Version 1 database is missing its sample table")
 
+        # days already extracted or imported from that database
+        self._source = jcd.common.SqliteDB.get_full_path(
+            self.DefaultFile, self._args.source)
+        self._ledger_dao = jcd.dao.ImportLedgerDAO(self._app_db)
+        self._ledger_dao.create_table()
+        # imported days are cataloged whole
+        jcd.dao.ArchivesDAO(self._app_db).open_table()
+        self._app_db.commit()
+        self._days = self._ledger_dao.get_days(self._source)
+
+    def _index_version1(self):
+        # needed to read the samples by day, or in timestamp order
+        if not self._dao_v1.has_timestamp_index():
+            print "Index version 1 data by timestamp"
+            print "This will take a while :-)"
+            self._dao_v1.create_timestamp_index()
+            self._app_db.commit()
+
     def _attach_v2_daily_db(self):
-        # create, initialize databases as necessary
-        self._daily_schema_name = self._short_dao.get_schema_name(self._f_date_str)
-        db_filename = self._short_dao.get_db_file_name(self._daily_schema_name)
-        # prepare archive storage if needed
-        created = self._short_dao.initialize_archived_table(db_filename)
-        if created:
-            print "Database", db_filename, "created"
+        # create, initialize, attach databases as necessary
         # WARNING: attaching commits current transaction
-        self._app_db.attach_database(db_filename, self._daily_schema_name, jcd.app.App.DataPath)
+        self._daily_schema_name, created = self._short_dao.attach_archive(
+            self._f_date_str)
+        if created:
+            print "Database", self._short_dao.get_db_file_name(
+                self._daily_schema_name), "created"
         # modify synchronization for version 1 db
         self._app_db.set_synchronous(self._daily_schema_name, self._args.sync)
 
-    def _detach_v2_daily_db(self):
-        # WARNING: detaching commits current transaction
-        self._app_db.detach_database(self._daily_schema_name)
-
-    def _store_kept_samples(self):
+    def _store_kept_samples(self, earliest_timestamp):
         # store samples
         self._short_dao.insert_samples(
             self._kept_samples, self._daily_schema_name)
@@ -413,10 +1402,19 @@ class Import1Cmd(object):
         self._n_stored += len(self._kept_samples)
         # clear samples buffer
         self._kept_samples.clear()
+        # samples and progress are committed together, a later run
+        # resumes after the last committed line
+        self._ledger_dao.set_day(
+            self._source, self._f_date_str, jcd.dao.ImportLedgerDAO.StatusImporting,
+            self._days[self._f_date_str][1], self._n_worked, self._n_stored,
+            earliest_timestamp)
+        self._app_db.commit()
 
     @staticmethod
     def _get_csv_name(date_str):
-        return '%s.csv' % date_str
+        return jcd.common.SqliteDB.get_full_path(
+            os.path.join(Import1Cmd.FolderName, '%s.csv' % date_str),
+            jcd.app.App.DataPath)
 
     @staticmethod
     def _remove_csv_file(date_str):
@@ -443,9 +1441,19 @@ class Import1Cmd(object):
             for sample in reader:
                 yield sample
 
-    def _flush_all(self):
-        for date_str, date_info in self._data.iteritems():
-            self._flush_samples(date_str, date_info["kept"])
+    def _finish_day(self, date_str):
+        # samples are read in timestamp order, the day is complete
+        self._flush_samples(date_str, self._data[date_str]["kept"])
+        num_extracted = self._data.pop(date_str)["extracted"]
+        day = self._days.get(date_str)
+        if day is not None and day[0] == jcd.dao.ImportLedgerDAO.StatusImporting:
+            # extracted again, in the same order, keep the import progress
+            day = (day[0], num_extracted) + day[2:]
+        else:
+            day = (jcd.dao.ImportLedgerDAO.StatusExtracted, num_extracted, 0, 0, None)
+        self._days[date_str] = day
+        self._ledger_dao.set_day(self._source, date_str, *day)
+        self._app_db.commit()
 
     def _work_sample(self, sample_raw):
         # manage dates
@@ -459,9 +1467,13 @@ class Import1Cmd(object):
 
         # manage structure
         if date_str not in self._data:
+            # previous day is complete
+            for previous_date in self._data.keys():
+                self._finish_day(previous_date)
+            self._remove_csv_file(date_str)
             self._data[date_str] = {
                 "kept": collections.deque(),
-                "created": False,
+                "extracted": 0,
                 "contracts": dict()
             }
         date_info = self._data[date_str]
@@ -469,9 +1481,6 @@ class Import1Cmd(object):
         # flush samples if required
         kept = date_info["kept"]
         if len(kept) >= 1000:
-            if not date_info["created"]:
-                self._remove_csv_file(date_str)
-                date_info["created"] = True
             self._flush_samples(date_str, kept)
 
         # manage contracts
@@ -495,19 +1504,40 @@ class Import1Cmd(object):
         last = station_info["last"]
         if last is None:
             date_info["kept"].append(sample)
+            date_info["extracted"] += 1
             station_info["last"] = sample
             return
 
         # compare bikes and slots with previous sample
         if last[3] != bikes or last[4] != slots:
             date_info["kept"].append(sample)
+            date_info["extracted"] += 1
             station_info["last"] = sample
             return
 
         # if same, skip
         return
 
+    def _get_extraction_start(self):
+        # days are extracted in order : restart at the first day whose csv
+        # file is missing, or after the last extracted day
+        start = 0
+        for date in sorted(self._days):
+            status = self._days[date][0]
+            if status != jcd.dao.ImportLedgerDAO.StatusImported and \
+                    not os.path.exists(self._get_csv_name(date)):
+                return jcd.dao.ShortSamplesDAO.get_date_range(date)[0]
+            start = jcd.dao.ShortSamplesDAO.get_date_range(date)[1]
+        return start
+
     def _extract_deduplicate_data(self):
+        folder = os.path.dirname(self._get_csv_name(""))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self._index_version1()
+        start = self._get_extraction_start()
+        if start > 0:
+            print "Resume extraction from", jcd.dao.ShortSamplesDAO.get_date(start)
         print "Read and deduplicate all version 1 data"
         print "Store results in daily CSV files"
         print "This will take a while :-)"
@@ -515,7 +1545,11 @@ class Import1Cmd(object):
         self._n_stored = 0
         flush_counter = 0
         # read all samples on input
-        for sample in self._dao_v1.list_samples():
+        for sample in self._dao_v1.list_samples(start):
+            # imported days are only read again to get to the next ones
+            if self._days.get(sample[1], ("", ))[0] == \
+                    jcd.dao.ImportLedgerDAO.StatusImported:
+                continue
             self._n_worked += 1
             flush_counter += 1
             self._work_sample(sample)
@@ -525,16 +1559,18 @@ class Import1Cmd(object):
                 sys.stdout.write(".")
                 sys.stdout.flush()
         # final flush
-        self._flush_all()
+        for date_str in self._data.keys():
+            self._finish_day(date_str)
         # result
         print "Done."
         print self._n_worked, "samples read and", self._n_stored, "extracted to CSV files"
 
     def _import_data(self, date_str, earliest_timestamp):
-        reader = self._load_samples(date_str)
         self._kept_samples = collections.deque()
-        self._n_worked = 0
-        self._n_stored = 0
+        # lines already imported by a previous run
+        self._n_worked = self._days[date_str][2]
+        self._n_stored = self._days[date_str][3]
+        reader = itertools.islice(self._load_samples(date_str), self._n_worked, None)
         for sample in reader:
             self._n_worked += 1
             # CSV reads strings
@@ -547,78 +1583,547 @@ class Import1Cmd(object):
             if len(self._kept_samples) >= 1000:
                 sys.stdout.write(".")
                 sys.stdout.flush()
-                self._store_kept_samples()
+                self._store_kept_samples(earliest_timestamp)
         # final flush
-        self._store_kept_samples()
+        self._store_kept_samples(earliest_timestamp)
 
     def _import_all_csv_data(self):
-        for date in self._data.keys():
+        for date in sorted(self._days):
+            status, num_extracted, num_imported, num_stored, timestamp = self._days[date]
+            if status == jcd.dao.ImportLedgerDAO.StatusImported:
+                continue
             print "Importing CSV for", date
             self._f_date_str = date
             # attach target database
             self._attach_v2_daily_db() # warning: commits
-            # find maximum target timestamp, to limit import
-            timestamp = self._short_dao.get_overall_earliest_timestamp(self._daily_schema_name)
+            if status == jcd.dao.ImportLedgerDAO.StatusExtracted:
+                # find maximum target timestamp, to limit import, once : the
+                # samples imported by an interrupted run must not lower it
+                timestamp = self._short_dao.get_overall_earliest_timestamp(
+                    self._daily_schema_name)
+            else:
+                print "Resuming after", num_imported, "samples"
             self._import_data(date, timestamp)
+            # catalog the whole day, including what was already there
+            jcd.dao.ArchivesDAO(self._app_db).set_day(
+                date, self._short_dao.get_db_file_name(self._daily_schema_name),
+                jcd.dao.ArchivesDAO.FormatDaily,
+                self._short_dao.get_archived_bounds(self._daily_schema_name),
+                self._app_db.get_size(self._daily_schema_name))
+            self._days[date] = (jcd.dao.ImportLedgerDAO.StatusImported, num_extracted,
+                                self._n_worked, self._n_stored, timestamp)
+            self._ledger_dao.set_day(self._source, date, *self._days[date])
             # commit transaction
             self._app_db.commit()
             print "Done."
             print self._n_stored, "samples added and", (self._n_worked-self._n_stored), "skipped"
-            # detach target daily db
-            self._detach_v2_daily_db() # warning: commits
             # remove imported csv file
             print "Removing CSV file for", date
             self._remove_csv_file(date)
 
+    def _import_parallel(self):
+        # each day is read from the index, deduplicated and stored by a
+        # worker process, only the catalog and the ledger are updated here
+        self._index_version1()
+        dates = [date for date in self._dao_v1.list_dates()
+                 if self._days.get(date, ("", ))[0] !=
+                 jcd.dao.ImportLedgerDAO.StatusImported]
+        print "Import %i days of version 1 data, %i at a time" % (
+            len(dates), self._args.jobs)
+        contract_ids = jcd.dao.ContractsDAO(self._app_db).get_contract_ids()
+        tasks = []
+        for date in dates:
+            day = self._days.get(date)
+            resumed = day is not None and day[0] == jcd.dao.ImportLedgerDAO.StatusImporting
+            tasks.append((jcd.app.App.DataPath, self._args.source, date, contract_ids,
+                          self._args.sync, resumed, day[4] if resumed else None))
+        start = time.time()
+        n_read = 0
+        n_stored = 0
+        failed = 0
+        archives_dao = jcd.dao.ArchivesDAO(self._app_db)
+        for (date, file_name, read, extracted, stored, bounds, size,
+             earliest_timestamp, elapsed, error) in run_pool(
+                 import_day, tasks, self._args.jobs):
+            if error is not None:
+                print >>sys.stderr, "Import of [%s] failed: %s" % (date, error)
+                failed += 1
+                continue
+            # catalog the whole day, including what was already there
+            archives_dao.set_day(date, file_name, jcd.dao.ArchivesDAO.FormatDaily,
+                                 bounds, size)
+            # as when imported from csv : every deduplicated sample was
+            # extracted, then imported
+            self._ledger_dao.set_day(self._source, date,
+                                     jcd.dao.ImportLedgerDAO.StatusImported,
+                                     num_extracted=extracted,
+                                     num_imported=extracted,
+                                     num_stored=stored,
+                                     earliest_timestamp=earliest_timestamp)
+            self._app_db.commit()
+            # left by an interrupted import from csv
+            self._remove_csv_file(date)
+            n_read += read
+            n_stored += stored
+            total = time.time() - start
+            print "%s: %i samples read, %i added in %.2fs (%i samples/s overall)" % (
+                date, read, stored, elapsed, n_read / max(total, 0.001))
+        print "%i samples read and %i added in %.2fs" % (
+            n_read, n_stored, time.time() - start)
+        if failed > 0:
+            raise jcd.common.JcdException("Import of %i days failed" % failed)
+
     def run(self):
+        if self._args.jobs is not None and self._args.jobs <= 0:
+            raise jcd.common.JcdException("Jobs must be positive")
         with jcd.common.SqliteDB(jcd.app.App.DbName, jcd.app.App.DataPath) as app_db:
             self._app_db = app_db
             self._initialize()
-            self._extract_deduplicate_data()
-            self._import_all_csv_data()
+            if self._args.jobs is not None:
+                self._import_parallel()
+            else:
+                self._extract_deduplicate_data()
+                self._import_all_csv_data()
+        # only removed once empty
+        try:
+            os.rmdir(os.path.dirname(self._get_csv_name("")))
+        except OSError:
+            pass
+
+# export the samples of one day, at module level to run in worker processes
+def export_day(task):
+    data_path, db_name, date, contract_id, station_number, file_path, compression = task
+    start = time.time()
+    try:
+        with jcd.common.SqliteDB(db_name, data_path, read_only=True) as app_db:
+            short_dao = jcd.dao.ShortSamplesDAO(app_db)
+            day_start, day_end = short_dao.get_date_range(date)
+            with jcd.common.OutputWriter(file_path, compression) as output:
+                count = ExportCsvCmd._export_lines(short_dao.list_range(
+                    day_start, day_end, contract_id, station_number, as_csv=True), output)
+    except jcd.common.JcdException as exception:
+        return date, file_path, 0, 0, time.time() - start, str(exception)
+    return date, file_path, count, os.path.getsize(file_path), time.time() - start, None
 
 # import data from version 1
 class ExportCsvCmd(object):
 
+    Extensions = {None: "", "gzip": ".gz", "xz": ".xz"}
+
+    # samples written at once
+    BatchSize = 10000
+
     def __init__(self, args):
         self._app_db = None
         self._args = args
+        self._output = None
 
     @staticmethod
-    def _export_csv(items):
-        writer = csv.writer(sys.stdout, quoting=csv.QUOTE_ALL)
+    def _export_csv(items, output):
+        writer = csv.writer(output, quoting=csv.QUOTE_ALL)
         for item in items:
             writer.writerow([unicode(field).encode("utf-8") for field in item])
 
+    @staticmethod
+    def _export_lines(lines, output):
+        # samples are already formatted, a single string for a batch
+        lines = iter(lines)
+        count = 0
+        while True:
+            batch = list(itertools.islice(lines, ExportCsvCmd.BatchSize))
+            if len(batch) == 0:
+                break
+            output.write("".join(batch).encode("utf-8"))
+            count += len(batch)
+        return count
+
+    def _get_contract_id(self):
+        if self._args.station is not None and self._args.contract is None:
+            raise jcd.common.JcdException("A station can only be exported with its contract")
+        if self._args.contract is None:
+            return None
+        contract_ids = jcd.dao.ContractsDAO(self._app_db).get_contract_ids()
+        if self._args.contract not in contract_ids:
+            raise jcd.common.JcdException(
+                "Unknown contract [%s]" % self._args.contract)
+        return contract_ids[self._args.contract]
+
     def export_contracts(self):
         dao = jcd.dao.ContractsDAO(self._app_db)
         contracts = dao.list()
-        self._export_csv(contracts)
+        self._export_csv(contracts, self._output)
 
     def export_stations(self):
         dao = jcd.dao.FullSamplesDAO(self._app_db)
         stations = dao.list()
-        self._export_csv(stations)
+        contract_id = self._get_contract_id()
+        if contract_id is not None:
+            stations = (station for station in stations
+                        if station["contract_id"] == contract_id and
+                        self._args.station in (None, station["station_number"]))
+        self._export_csv(stations, self._output)
+
+    def _get_dates(self):
+        first_date = self._args.source
+        last_date = self._args.end if self._args.end is not None else first_date
+        if last_date < first_date:
+            raise jcd.common.JcdException("End date is before start date")
+        return first_date, last_date
 
     def export_date(self):
-        # build target db information
+        # either archive format, for one or more days
+        short_dao = jcd.dao.ShortSamplesDAO(self._app_db)
+        first_date, last_date = self._get_dates()
+        if last_date == first_date:
+            # a single day must exist
+            short_dao.locate_archive(first_date)
+        lines = short_dao.list_range(
+            short_dao.get_date_range(first_date)[0],
+            short_dao.get_date_range(last_date)[1],
+            self._get_contract_id(), self._args.station, as_csv=True)
+        return self._export_lines(lines, self._output)
+
+    def export_state(self):
+        # last change of each station at a time of the day, or its state in
+        # the keyframe before it
+        short_dao = jcd.dao.ShortSamplesDAO(self._app_db)
+        timestamp = short_dao.get_date_range(self._args.source)[0] + self._args.at
+        samples = short_dao.get_state_at(
+            timestamp, self._get_contract_id(), self._args.station)
+        return self._export_lines(
+            (short_dao.CsvFormat % sample for sample in samples), self._output)
+
+    def export_grid(self):
+        # states of the stations at each step, instead of their changes
+        short_dao = jcd.dao.ShortSamplesDAO(self._app_db)
+        first_date, last_date = self._get_dates()
+        step = self._args.step
+        if step <= 0 or 86400 % step != 0:
+            raise jcd.common.JcdException("Step must divide a day (86400 seconds)")
+        start, end = (short_dao.get_date_range(first_date)[0],
+                      short_dao.get_date_range(last_date)[1])
+        # stations known at the start, even idle ones, and those seen later
+        contract_id = self._get_contract_id()
+        start_state = short_dao.get_state_at(start - 1, contract_id, self._args.station)
+        stations = sorted(set((sample[1], sample[2]) for sample in start_state).union(
+            short_dao.list_range_stations(start, end, contract_id, self._args.station)))
+        if self._args.binary:
+            self._output.write(jcd.archive.GridMatrix.get_header(
+                start, step, (end - start) // step, stations))
+        # contract and station are formatted once
+        prefixes = ['"%d","%d",' % station for station in stations]
+        count = 0
+        for day_start, all_bikes, all_stands in short_dao.list_grid(
+                first_date, last_date, step, stations, start_state):
+            if self._args.binary:
+                self._output.write(
+                    jcd.archive.GridMatrix.get_block(all_bikes, all_stands))
+                count += len(stations) * (86400 // step)
+                continue
+            # one line per station at each step, unknown states are skipped
+            lines = []
+            for position, (bikes, stands) in enumerate(
+                    zip(zip(*all_bikes), zip(*all_stands))):
+                timestamp = '"%d",' % (day_start + position * step)
+                lines.extend('%s%s"%d","%d"\r\n' % (timestamp, prefix, bike, stand)
+                             for prefix, bike, stand in zip(prefixes, bikes, stands)
+                             if bike >= 0)
+                if len(lines) >= self.BatchSize:
+                    count += self._export_lines(lines, self._output)
+                    lines = []
+            count += self._export_lines(lines, self._output)
+        return count
+
+    def _report_day(self, date, file_path, count, size, elapsed, error):
+        if error is not None:
+            print >>sys.stderr, "Export of [%s] failed: %s" % (date, error)
+            return
+        # stdout is the export itself
+        if jcd.app.App.Verbose and (self._args.output is not None or
+                                    self._args.output_dir is not None):
+            print "%s: %i samples, %i bytes in %.2fs" % (date, count, size, elapsed)
+
+    def export_days(self, compression):
+        # days are exported by worker processes, each to its own file
         short_dao = jcd.dao.ShortSamplesDAO(self._app_db)
-        schema_name = short_dao.get_schema_name(self._args.source)
-        db_filename = short_dao.get_db_file_name(schema_name)
-        # open if it exists, and verify that table exists
-        self._app_db.attach_database(db_filename, schema_name, jcd.app.App.DataPath, True)
-        if not self._app_db.has_table(jcd.dao.ShortSamplesDAO.TableNameArchive, schema_name):
-            raise jcd.common.JcdException("No table for archived samples in [%s] database" % db_filename)
-        # dump the content
-        samples = short_dao.list_archived(schema_name)
-        self._export_csv(samples)
+        first_date, last_date = self._get_dates()
+        contract_id = self._get_contract_id()
+        dates = []
+        for date in short_dao.get_dates(first_date, last_date):
+            try:
+                short_dao.locate_archive(date)
+                dates.append(date)
+            except jcd.common.JcdException:
+                # no sample on that day
+                continue
+        output_dir = self._args.output_dir
+        if output_dir is None:
+            # parts of a single output, under the data folder
+            output_dir = tempfile.mkdtemp(
+                prefix="export_", dir=os.path.expanduser(jcd.app.App.DataPath))
+        else:
+            output_dir = os.path.expanduser(output_dir)
+            if not os.path.isdir(output_dir):
+                raise jcd.common.JcdException(
+                    "Folder [%s] does not exist" % self._args.output_dir)
+        tasks = [(jcd.app.App.DataPath, jcd.app.App.DbName, date, contract_id,
+                  self._args.station,
+                  os.path.join(output_dir, "%s.csv%s" % (
+                      short_dao.get_schema_name(date), self.Extensions[compression])),
+                  compression)
+                 for date in dates]
+        count = 0
+        failed = 0
+        try:
+            if self._args.output_dir is not None:
+                for result in run_pool(export_day, tasks, self._args.jobs):
+                    self._report_day(*result)
+                    count += result[2]
+                    if result[5] is not None:
+                        failed += 1
+            else:
+                # gzip and xz outputs can be concatenated, days are
+                # appended in order as soon as they are available
+                for result in run_pool(export_day, tasks, self._args.jobs, ordered=True):
+                    self._report_day(*result)
+                    if result[5] is not None:
+                        raise jcd.common.JcdException(
+                            "Export of [%s] failed" % result[0])
+                    with open(result[1], "rb") as part:
+                        for chunk in iter(lambda: part.read(self._output.ChunkSize), ""):
+                            self._output.write(chunk)
+                    os.remove(result[1])
+                    count += result[2]
+        finally:
+            if self._args.output_dir is None:
+                shutil.rmtree(output_dir, True)
+        if failed > 0:
+            raise jcd.common.JcdException("Export of %i days failed" % failed)
+        return count
 
     def run(self):
-        with jcd.common.SqliteDB(jcd.app.App.DbName, jcd.app.App.DataPath) as app_db:
+        start = time.time()
+        compression = self._args.compress
+        # compression defaults to the one of the output file name
+        if compression is None and self._args.output is not None:
+            for name, extension in (("gzip", ".gz"), ("xz", ".xz")):
+                if self._args.output.endswith(extension):
+                    compression = name
+        parallel = self._args.jobs is not None or self._args.output_dir is not None
+        if parallel and self._args.source in ('contracts', 'stations'):
+            raise jcd.common.JcdException(
+                "Only samples can be exported by day or in parallel")
+        if self._args.output is not None and self._args.output_dir is not None:
+            raise jcd.common.JcdException(
+                "Export either to a single output, or to a folder")
+        if self._args.jobs is not None and self._args.jobs <= 0:
+            raise jcd.common.JcdException("Jobs must be positive")
+        if self._args.binary and self._args.step is None:
+            raise jcd.common.JcdException("Only a grid can be exported as binary")
+        if self._args.step is not None and (
+                parallel or self._args.source in ('contracts', 'stations')):
+            raise jcd.common.JcdException(
+                "A grid is only exported from samples, to a single output")
+        if self._args.at is not None and (
+                parallel or self._args.source in ('contracts', 'stations') or
+                self._args.end is not None or self._args.step is not None):
+            raise jcd.common.JcdException(
+                "A state is only exported for a single day, to a single output")
+        if self._args.output_dir is not None:
+            with jcd.common.SqliteDB(jcd.app.App.DbName, jcd.app.App.DataPath,
+                                     read_only=True) as app_db:
+                self._app_db = app_db
+                count = self.export_days(compression)
+            if jcd.app.App.Verbose:
+                elapsed = time.time() - start
+                print "Exported %i samples to %s in %.2fs, %i samples/s" % (
+                    count, self._args.output_dir, elapsed, count / max(elapsed, 0.001))
+            return
+        count = None
+        with jcd.common.SqliteDB(jcd.app.App.DbName, jcd.app.App.DataPath,
+                                 read_only=True) as app_db:
             self._app_db = app_db
-            if self._args.source == 'contracts':
-                self.export_contracts()
-            elif self._args.source == 'stations':
-                self.export_stations()
+            # parts are compressed by the workers already
+            with jcd.common.OutputWriter(self._args.output,
+                                         None if parallel else compression) as output:
+                self._output = output
+                if self._args.source == 'contracts':
+                    self.export_contracts()
+                elif self._args.source == 'stations':
+                    self.export_stations()
+                elif self._args.step is not None:
+                    count = self.export_grid()
+                elif self._args.at is not None:
+                    count = self.export_state()
+                elif parallel:
+                    count = self.export_days(compression)
+                else:
+                    count = self.export_date()
+        # stdout is the export itself
+        if jcd.app.App.Verbose and self._args.output is not None:
+            elapsed = time.time() - start
+            if count is None:
+                print "Exported %s to %s (%i bytes) in %.2fs" % (
+                    self._args.source, self._args.output, output.num_bytes, elapsed)
             else:
-                self.export_date()
+                print "Exported %i samples to %s (%i bytes) in %.2fs, %i samples/s" % (
+                    count, self._args.output, output.num_bytes, elapsed,
+                    count / max(elapsed, 0.001))
+
+# aggregate station activity by day and hour, into the stats database
+class StatsCmd(object):
+
+    # days a station keeps its last state without any change
+    CarryDays = 7
+
+    def __init__(self, args):
+        self._args = args
+        self._app_db = None
+        self._stats_db = None
+        self._short_dao = None
+        self._stats_dao = None
+
+    @staticmethod
+    def _aggregate_station(day_start, state, changes):
+        # state is (last change, bikes, stands) at the start of the day, or
+        # None, changes are (timestamp, bikes, stands) in timestamp order ;
+        # returns the aggregates of each hour where the state is known, with
+        # the sum of bikes over time instead of the mean, and the final state
+        last, bikes, stands = (None, None, None) if state is None else state
+        hours = []
+        position = 0
+        num_changes = len(changes)
+        for hour_start in xrange(day_start, day_start + 86400, 3600):
+            hour_end = hour_start + 3600
+            changed = taken = returned = 0
+            known = empty = full = weighted = 0
+            low = high = None
+            since = hour_start
+            while True:
+                if position < num_changes and changes[position][0] < hour_end:
+                    until = changes[position][0]
+                else:
+                    until = hour_end
+                # state held from its change (or the hour start) until now
+                if bikes is not None and until > since:
+                    duration = until - since
+                    known += duration
+                    weighted += bikes * duration
+                    if bikes == 0:
+                        empty += duration
+                    if stands == 0:
+                        full += duration
+                    if low is None or bikes < low:
+                        low = bikes
+                    if high is None or bikes > high:
+                        high = bikes
+                if until == hour_end:
+                    break
+                timestamp, new_bikes, new_stands = changes[position]
+                position += 1
+                changed += 1
+                if bikes is not None:
+                    if new_bikes < bikes:
+                        taken += bikes - new_bikes
+                    else:
+                        returned += new_bikes - bikes
+                last, bikes, stands = timestamp, new_bikes, new_stands
+                since = timestamp
+            if known > 0:
+                hours.append((hour_start, changed, taken, returned, low, high,
+                              weighted, known, empty, full))
+        return hours, None if bikes is None else (last, bikes, stands)
+
+    def _aggregate_day(self, date, states):
+        # states at the start of the day are updated to its end
+        day_start, day_end = jcd.dao.ShortSamplesDAO.get_date_range(date)
+        changes = collections.defaultdict(list)
+        num_samples = 0
+        for sample in self._short_dao.list_range(day_start, day_end):
+            changes[(sample[1], sample[2])].append((sample[0], sample[3], sample[4]))
+            num_samples += 1
+        day_rows = []
+        hour_rows = []
+        for station in sorted(set(states).union(changes)):
+            hours, state = self._aggregate_station(
+                day_start, states.get(station), changes.get(station, ()))
+            if len(hours) == 0:
+                continue
+            states[station] = state
+            for hour in hours:
+                hour_rows.append(hour[:1] + station + hour[1:6] + (
+                    float(hour[6]) / hour[7], ) + hour[7:])
+            # the day from its hours, column by column
+            columns = zip(*hours)
+            known = sum(columns[7])
+            day_rows.append((day_start, ) + station + (
+                sum(columns[1]), sum(columns[2]), sum(columns[3]),
+                min(columns[4]), max(columns[5]),
+                float(sum(columns[6])) / known, known,
+                sum(columns[8]), sum(columns[9])) + state)
+        return day_rows, hour_rows, num_samples
+
+    def _get_initial_states(self, date, previous_date, done):
+        # from the aggregates of the previous day when they are up to date,
+        # else from the archives
+        day_start = jcd.dao.ShortSamplesDAO.get_date_range(date)[0]
+        oldest = day_start - self.CarryDays * 86400
+        if previous_date in done:
+            previous_start = jcd.dao.ShortSamplesDAO.get_date_range(previous_date)[0]
+            if previous_start >= oldest:
+                return self._stats_dao.get_states(previous_start)
+            return {}
+        stations = self._short_dao.list_range_stations(oldest, day_start)
+        return self._short_dao.get_states_before(
+            day_start, stations, self.CarryDays)
+
+    def _aggregate(self):
+        catalog = [(row["date"], row["num_samples"], row["last_timestamp"])
+                   for row in jcd.dao.ArchivesDAO(self._app_db).list()]
+        done = self._stats_dao.get_days()
+        # a day aggregated again changes the states the next days start with
+        pending = 0
+        while pending < len(catalog) and done.get(catalog[pending][0]) == catalog[pending][1:]:
+            pending += 1
+        if pending == len(catalog):
+            if jcd.app.App.Verbose:
+                print "No day to aggregate"
+            return 0
+        states = self._get_initial_states(
+            catalog[pending][0], catalog[pending - 1][0] if pending > 0 else None, done)
+        for date, num_samples, last_timestamp in catalog[pending:]:
+            start = time.time()
+            day_start, day_end = jcd.dao.ShortSamplesDAO.get_date_range(date)
+            # forget stations which stopped changing long ago
+            oldest = day_start - self.CarryDays * 86400
+            for station in [station for station, state in states.iteritems()
+                            if state[0] < oldest]:
+                del states[station]
+            day_rows, hour_rows, read = self._aggregate_day(date, states)
+            # samples may be added while reading, never removed
+            if read < num_samples:
+                print >>sys.stderr, "%s: only %i of %i cataloged samples found" % (
+                    date, read, num_samples)
+            self._stats_dao.set_day(date, (day_start, day_end), day_rows, hour_rows,
+                                    num_samples, last_timestamp)
+            self._stats_db.commit()
+            if jcd.app.App.Verbose:
+                print "%s: %i samples, %i stations aggregated in %.2fs" % (
+                    date, read, len(day_rows), time.time() - start)
+        return len(catalog) - pending
+
+    def run(self):
+        start = time.time()
+        with jcd.common.SqliteDB(jcd.dao.StatsDAO.DbName, jcd.app.App.DataPath) as stats_db:
+            self._stats_db = stats_db
+            self._stats_dao = jcd.dao.StatsDAO(stats_db)
+            self._stats_dao.create_tables()
+            if self._args.rebuild:
+                self._stats_dao.clear()
+            with jcd.common.SqliteDB(jcd.app.App.DbName, jcd.app.App.DataPath,
+                                     read_only=True) as app_db:
+                self._app_db = app_db
+                self._short_dao = jcd.dao.ShortSamplesDAO(app_db)
+                num_days = self._aggregate()
+        if jcd.app.App.Verbose:
+            print "Aggregated %i days in %.2fs" % (num_days, time.time() - start)
@@ -23,8 +23,25 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
+import sys
+import gzip
+import zlib
+import time
+import errno
+import Queue
 import os.path
 import sqlite3
+import threading
+import collections
+
+# optional, only needed for xz compressed exports
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 import jcd.cmd
 
@@ -37,12 +54,22 @@ class JcdException(Exception):
 # manages access to the application database
 class SqliteDB(object):
 
-    def __init__(self, db_filename, data_path):
+    # write-ahead log, so that readers and the writer do not block each other
+    Wal = False
+    # seconds to wait for a lock held by another connection
+    BusyTimeout = 5.0
+    # attached databases kept open, below sqlite's default limit of 10
+    AttachLimit = 8
+
+    def __init__(self, db_filename, data_path, read_only=False):
         self._data_path = data_path
         self._file_name = db_filename
         self._full_path = SqliteDB.get_full_path(self._file_name, self._data_path)
+        self._read_only = read_only
         self._connection = None
         self._att_databases = {}
+        # schemas attached on demand, least recently used first
+        self._lru_databases = collections.OrderedDict()
 
     @staticmethod
     def get_full_path(filename, path):
@@ -52,12 +79,43 @@ class SqliteDB(object):
     def open(self):
         if self._connection is None:
             try:
-                self._connection = sqlite3.connect(self._full_path)
+                self._connection = sqlite3.connect(
+                    self._full_path, timeout=self.BusyTimeout)
                 self._connection.row_factory = sqlite3.Row
             except sqlite3.Error as error:
                 print "%s: %s" % (type(error).__name__, error)
                 raise JcdException(
                     "Database error while opening [%s]" % self._full_path)
+            if self._read_only:
+                self.execute_single(
+                    '''
+                    PRAGMA query_only=1
+                    ''',
+                    None,
+                    "Database error while setting query_only pragma")
+            else:
+                self.set_journal_mode("main")
+
+    def set_journal_mode(self, schema_name):
+        # see https://www.sqlite.org/wal.html, the mode is kept in the file
+        if self.Wal:
+            self.execute_single(
+                '''
+                PRAGMA %s.journal_mode=WAL
+                ''' % schema_name,
+                None,
+                "Database error while setting journal_mode pragma")
+
+    def checkpoint(self, schema_name="main"):
+        # move the write-ahead log into the database, without waiting for
+        # readers, so that it does not grow between automatic checkpoints
+        if self.Wal and not self._read_only:
+            self.execute_single(
+                '''
+                PRAGMA %s.wal_checkpoint(PASSIVE)
+                ''' % schema_name,
+                None,
+                "Database error while checkpointing [%s]" % schema_name)
 
     def close(self):
         # close main databases
@@ -69,6 +127,10 @@ class SqliteDB(object):
         if self._connection is not None:
             self._connection.commit()
 
+    def rollback(self):
+        if self._connection is not None:
+            self._connection.rollback()
+
     def __enter__(self):
         # open the connection if it's not already open
         self.open()
@@ -85,6 +147,32 @@ class SqliteDB(object):
         if self._connection is not None:
             self._connection.execute("vacuum")
 
+    def analyze(self):
+        if self._connection is not None:
+            self._connection.execute("analyze")
+
+    def get_pragma(self, name, schema_name="main"):
+        result = self.execute_fetch_one(
+            '''
+            PRAGMA %s.%s
+            ''' % (schema_name, name),
+            None,
+            "Database error while reading %s pragma" % name)
+        return result[0]
+
+    def set_pragma(self, name, value, schema_name="main"):
+        self.execute_single(
+            '''
+            PRAGMA %s.%s=%s
+            ''' % (schema_name, name, value),
+            None,
+            "Database error while setting %s pragma" % name)
+
+    def get_size(self, schema_name="main"):
+        # in bytes, including what is not yet checkpointed
+        return (self.get_pragma("page_count", schema_name) *
+                self.get_pragma("page_size", schema_name))
+
     def has_table(self, name, schema="main"):
         result = self.execute_fetch_one(
             '''
@@ -111,6 +199,8 @@ class SqliteDB(object):
             "Database error while attaching [%s] as schema [%s]" % (file_name, schema_name))
         # memorize attachement
         self._att_databases[schema_name] = file_name
+        if not self._read_only:
+            self.set_journal_mode(schema_name)
 
     def detach_database(self, schema_name):
         if schema_name not in self._att_databases:
@@ -123,6 +213,30 @@ class SqliteDB(object):
             (schema_name, ),
             "Database error while detaching [%s]" % schema_name)
         del self._att_databases[schema_name]
+        self._lru_databases.pop(schema_name, None)
+
+    def use_database(self, file_name, schema_name, path):
+        # attach on demand, and keep attached until the limit is reached
+        if schema_name in self._lru_databases:
+            self._lru_databases[schema_name] = self._lru_databases.pop(schema_name)
+            return False
+        while (len(self._att_databases) >= self.AttachLimit and
+               len(self._lru_databases) > 0):
+            oldest = next(iter(self._lru_databases))
+            self.checkpoint(oldest)
+            # WARNING: detaching commits current transaction
+            self.detach_database(oldest)
+        # WARNING: attaching commits current transaction
+        self.attach_database(file_name, schema_name, path)
+        self._lru_databases[schema_name] = file_name
+        return True
+
+    def is_attached(self, schema_name):
+        return schema_name in self._att_databases
+
+    def detach_all_databases(self):
+        for schema_name in self._att_databases.keys():
+            self.detach_database(schema_name)
 
     def get_count(self, target):
         result = self.execute_fetch_one(
@@ -210,3 +324,193 @@ class SqliteDB(object):
                     "Database error while executing [%s] using [%s]" % (sql, params))
             else:
                 raise jcd.common.JcdException(error_message)
+
+# append-only compressed journal of raw api replies
+class ResponseJournal(object):
+
+    FolderName = "journal"
+
+    def __init__(self, data_path):
+        self._path = SqliteDB.get_full_path(self.FolderName, data_path)
+        # replies fetched in parallel are written one at a time
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_file_name(timestamp):
+        return time.strftime("journal_%Y_%m_%d.gz", time.gmtime(timestamp))
+
+    def _create_folder(self):
+        try:
+            os.makedirs(self._path)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise JcdException("Could not create journal folder : %s" % error)
+
+    def record(self, timestamp, endpoint, query, chunks):
+        # one header line, then the reply on a single line ; json only
+        # has newlines between tokens, so they can be replaced by spaces
+        self._create_folder()
+        file_path = os.path.join(self._path, self.get_file_name(timestamp))
+        with self._lock:
+            # each record is a complete gzip member, appended to the file
+            with gzip.open(file_path, "ab") as journal:
+                journal.write("%i\t%s\t%s\n" % (
+                    timestamp, endpoint, query.encode("utf-8")))
+                try:
+                    for chunk in chunks:
+                        journal.write(chunk.replace("\n", " ").replace("\r", " "))
+                        yield chunk
+                finally:
+                    # an interrupted reply is terminated, and rejected on replay
+                    journal.write("\n")
+
+    def list_files(self, start, end):
+        day = start - start % 86400
+        while day < end:
+            file_path = os.path.join(self._path, self.get_file_name(day))
+            if os.path.exists(file_path):
+                yield file_path
+            day += 86400
+
+    def read(self, start, end):
+        for file_path in self.list_files(start, end):
+            with gzip.open(file_path, "rb") as journal:
+                while True:
+                    header = journal.readline()
+                    if not header:
+                        break
+                    body = journal.readline()
+                    try:
+                        timestamp, endpoint, query = header.rstrip("\n").split("\t")
+                        timestamp = int(timestamp)
+                    except ValueError:
+                        raise JcdException(
+                            "Corrupted journal [%s] near [%s]" % (file_path, header[:100]))
+                    if start <= timestamp < end:
+                        yield timestamp, endpoint, query.decode("utf-8"), body
+
+# buffered output, compressed and written by a background thread
+class OutputWriter(object):
+
+    Compressions = ("gzip", "xz")
+    # bytes handed to the background thread at once
+    ChunkSize = 1 << 20
+    # chunks waiting to be written, bounds memory use
+    QueueSize = 8
+    # seconds between checks that the background thread still runs
+    PutTimeout = 1
+
+    def __init__(self, file_path=None, compression=None):
+        self._file_path = file_path
+        self._compression = compression
+        self._file = None
+        self._compressor = None
+        self._buffer = []
+        self._size = 0
+        self._queue = None
+        self._thread = None
+        self._error = None
+        # after compression
+        self.num_bytes = 0
+
+    def open(self):
+        if self._compression == "xz" and lzma is None:
+            raise JcdException(
+                "xz compression needs the lzma module (backports.lzma with python 2)")
+        if self._file_path is None:
+            self._file = sys.stdout
+        else:
+            try:
+                self._file = open(self._file_path, "wb")
+            except IOError as error:
+                raise JcdException("Could not open [%s]: %s" % (self._file_path, error))
+        if self._compression == "gzip":
+            # gzip header and trailer, as the gzip command writes them
+            self._compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif self._compression == "xz":
+            self._compressor = lzma.LZMACompressor()
+        # zlib and lzma release the interpreter lock while compressing
+        self._queue = Queue.Queue(self.QueueSize)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _write_chunk(self, chunk):
+        if self._compressor is not None:
+            chunk = self._compressor.compress(chunk)
+        self._file.write(chunk)
+        self.num_bytes += len(chunk)
+
+    def _run(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                break
+            # after an error, only empty the queue
+            if self._error is not None:
+                continue
+            # any failure is given to the producer, else it would block
+            # forever on the full queue
+            try:
+                self._write_chunk(chunk)
+            except Exception as error:
+                self._error = "%s: %s" % (type(error).__name__, error)
+
+    def _put(self, chunk):
+        # never wait on a background thread which is gone
+        while self._thread.is_alive():
+            try:
+                self._queue.put(chunk, True, self.PutTimeout)
+                return
+            except Queue.Full:
+                pass
+        if self._error is None:
+            self._error = "background writer stopped"
+
+    def _flush(self):
+        if self._size > 0:
+            self._put("".join(self._buffer))
+            self._buffer = []
+            self._size = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._size += len(data)
+        if self._size >= self.ChunkSize:
+            self._flush()
+        if self._error is not None:
+            raise JcdException("Could not write output: %s" % self._error)
+
+    def close(self, discard=False):
+        if self._thread is not None:
+            if not discard:
+                self._flush()
+            self._put(None)
+            self._thread.join()
+            self._thread = None
+            try:
+                if self._error is None and not discard:
+                    if self._compressor is not None:
+                        tail = self._compressor.flush()
+                        self._file.write(tail)
+                        self.num_bytes += len(tail)
+                    self._file.flush()
+            except Exception as error:
+                self._error = "%s: %s" % (type(error).__name__, error)
+        if self._file is not None and self._file is not sys.stdout:
+            self._file.close()
+            # never leave a partial file behind
+            if discard or self._error is not None:
+                os.remove(self._file_path)
+        self._file = None
+        if self._error is not None and not discard:
+            raise JcdException("Could not write output: %s" % self._error)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(discard=exc_type is not None)
+        # don't suppress the eventual exception
+        return False
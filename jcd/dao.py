@@ -23,9 +23,16 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
+import re
+import time
+import array
+import hashlib
 import sqlite3
+import os.path
+import calendar
 
 import jcd.common
+import jcd.archive
 import jcd.app
 import jcd.cmd
 
@@ -81,6 +88,7 @@ class ContractsDAO(object):
 
     def __init__(self, database):
         self._database = database
+        self._contract_ids = None
 
     def create_table(self):
         if jcd.app.App.Verbose:
@@ -135,9 +143,23 @@ class ContractsDAO(object):
             ''' % self.TableName,
             json_content,
             "Database error while inserting contracts")
+        # contract ids will be loaded again on next use
+        self._contract_ids = None
         # return number of new contracts
         return num_inserted
 
+    def get_contract_ids(self):
+        # contract name to id mapping, loaded once
+        if self._contract_ids is None:
+            self._contract_ids = dict(self._database.execute_fetch_generator(
+                '''
+                SELECT contract_name, contract_id
+                FROM %s
+                ''' % self.TableName,
+                None,
+                "Database error listing contract ids"))
+        return self._contract_ids
+
     def is_refresh_needed(self):
         result = self._database.execute_fetch_one(
             '''
@@ -167,14 +189,122 @@ class ContractsDAO(object):
             None,
             "Database error listing contracts")
 
-# settings table
+# stations information table
+class StationsDAO(object):
+
+    TableName = "stations"
+
+    def __init__(self, database):
+        self._database = database
+        # current information by (contract_id, station_number)
+        self._current = None
+        self._pending = {}
+
+    def create_table(self):
+        if jcd.app.App.Verbose:
+            print "Creating table [%s]" % self.TableName
+        self._database.execute_single(
+            '''
+            CREATE TABLE %s (
+                contract_id INTEGER NOT NULL,
+                station_number INTEGER NOT NULL,
+                valid_from INTEGER NOT NULL,
+                valid_until INTEGER,
+                bike_stands INTEGER NOT NULL,
+                bonus INTEGER NOT NULL,
+                banking INTEGER NOT NULL,
+                position TEXT NOT NULL,
+                address TEXT NOT NULL,
+                station_name TEXT NOT NULL,
+                PRIMARY KEY (contract_id, station_number, valid_from)
+            ) WITHOUT ROWID;
+            ''' % self.TableName,
+            None,
+            "Database error while creating table [%s]" % self.TableName)
+
+    def get_current(self):
+        if self._current is None:
+            self._current = dict(
+                ((row[0], row[1]), tuple(row)[2:])
+                for row in self._database.execute_fetch_generator(
+                    '''
+                    SELECT
+                        contract_id,
+                        station_number,
+                        bike_stands,
+                        bonus,
+                        banking,
+                        position,
+                        address,
+                        station_name
+                    FROM %s
+                    WHERE valid_until IS NULL
+                    ''' % self.TableName,
+                    None,
+                    "Database error loading stations information"))
+        return self._current
+
+    def track(self, key, information):
+        # remember information which differs from the current one
+        if self._current.get(key) != information:
+            self._pending[key] = information
+
+    def store_changes(self, timestamp):
+        # close the current version of changed stations, and open a new one
+        self._database.execute_many(
+            '''
+            UPDATE %s SET valid_until = ?
+            WHERE contract_id = ? AND
+                station_number = ? AND
+                valid_until IS NULL
+            ''' % self.TableName,
+            ((timestamp, ) + key for key in self._pending),
+            "Database error while closing stations information")
+        inserted = self._database.execute_many(
+            '''
+            INSERT OR REPLACE INTO %s (
+                contract_id,
+                station_number,
+                valid_from,
+                valid_until,
+                bike_stands,
+                bonus,
+                banking,
+                position,
+                address,
+                station_name)
+            VALUES (?, ?, ?, NULL, ?, ?, ?, ?, ?, ?)
+            ''' % self.TableName,
+            (key + (timestamp, ) + information
+             for key, information in self._pending.iteritems()),
+            "Database error while storing stations information")
+        # return number of stations with new information
+        return inserted
+
+    def commit_changes(self):
+        # only once the database holds them too
+        self._current.update(self._pending)
+        self._pending = {}
+
+    def reset_changes(self):
+        # after a failure, reload from the database on next use
+        self._current = None
+        self._pending = {}
+
+# samples table
 class FullSamplesDAO(object):
 
     TableNameNew = "new_samples"
     TableNameOld = "old_samples"
+    # settings row holding the time of the last fetch, when in memory
+    ParameterStateTimestamp = "state_timestamp"
 
     def __init__(self, database):
         self._database = database
+        self._stations = StationsDAO(database)
+        # last known state by (contract_id, station_number), when in memory
+        self._state = None
+        self._pending = {}
 
     def create_tables(self):
         self._create_table(self.TableNameNew)
@@ -192,12 +322,6 @@ class FullSamplesDAO(object):
                 available_bikes INTEGER NOT NULL,
                 available_bike_stands INTEGER NOT NULL,
                 status INTEGER NOT NULL,
-                bike_stands INTEGER NOT NULL,
-                bonus INTEGER NOT NULL,
-                banking INTEGER NOT NULL,
-                position TEXT NOT NULL,
-                address TEXT NOT NULL,
-                station_name TEXT NOT NULL,
                 last_update INTEGER,
                 PRIMARY KEY (contract_id, station_number)
             ) WITHOUT ROWID;
@@ -205,16 +329,36 @@ class FullSamplesDAO(object):
             None,
             "Database error while creating table [%s]" % table_name)
 
-    def store_new_samples(self, json_content, timestamp):
-        # adapt json_content to database schema
+    def _adapt_stations(self, json_content, timestamp, contract_ids):
+        # convert json_content to database rows, one station at a time,
+        # and track station information changes on the way
+        self._stations.get_current()
         for station in json_content:
-            station["timestamp"] = timestamp
-            station["status"] = 1 if station["status"] == "OPEN" else 0
-            station["bonus"] = 1 if station["bonus"] else 0
-            station["banking"] = 1 if station["banking"] else 0
-            station["position"] = "/".join(
-                str(v) for v in station["position"].values())
-        # insert station data
+            try:
+                contract_id = contract_ids[station["contract_name"]]
+            except KeyError:
+                raise jcd.common.JcdException(
+                    "Unknown contract [%s], please fetch contracts" % (
+                        station["contract_name"], ))
+            self._stations.track(
+                (contract_id, station["number"]),
+                (station["bike_stands"],
+                 1 if station["bonus"] else 0,
+                 1 if station["banking"] else 0,
+                 "/".join(str(v) for v in station["position"].values()),
+                 station["address"],
+                 station["name"]))
+            yield (
+                timestamp,
+                contract_id,
+                station["number"],
+                station["available_bikes"],
+                station["available_bike_stands"],
+                1 if station["status"] == "OPEN" else 0,
+                station["last_update"])
+
+    def store_new_samples(self, json_content, timestamp, contract_ids):
+        # insert station data, json_content can be any iterable
         num_inserted = self._database.execute_many(
             '''
             INSERT OR REPLACE INTO %s (
@@ -224,49 +368,139 @@ class FullSamplesDAO(object):
                 available_bikes,
                 available_bike_stands,
                 status,
-                bike_stands,
-                bonus,
-                banking,
-                position,
-                address,
-                station_name,
                 last_update)
-            VALUES (
-                :timestamp,
-                (SELECT contract_id FROM %s
-                    WHERE contract_name = :contract_name),
-                :number,
-                :available_bikes,
-                :available_bike_stands,
-                :status,
-                :bike_stands,
-                :bonus,
-                :banking,
-                :position,
-                :address,
-                :name,
-                :last_update)
-            ''' % (self.TableNameNew, ContractsDAO.TableName),
-            json_content,
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''' % self.TableNameNew,
+            self._adapt_stations(json_content, timestamp, contract_ids),
             "Database error while inserting state")
+        self._stations.store_changes(timestamp)
         # return number of inserted records
         return num_inserted
 
+    def _load_state(self):
+        if self._state is None:
+            self._state = dict(
+                ((row[1], row[2]), tuple(row))
+                for row in self._database.execute_fetch_generator(
+                    '''
+                    SELECT
+                        timestamp,
+                        contract_id,
+                        station_number,
+                        available_bikes,
+                        available_bike_stands,
+                        status,
+                        last_update
+                    FROM %s
+                    ''' % self.TableNameOld,
+                    None,
+                    "Database error loading current state"))
+        return self._state
+
+    def update_state(self, json_content, timestamp, contract_ids):
+        # compare each station to its last known state while it streams
+        # in, and only write changed stations into the state table
+        state = self._load_state()
+        self._pending = {}
+        changed = []
+        num_samples = 0
+        for row in self._adapt_stations(json_content, timestamp, contract_ids):
+            num_samples += 1
+            key = (row[1], row[2])
+            previous = state.get(key)
+            if previous is not None and row[6] is not None and previous[6] == row[6]:
+                # not updated by the api since, nothing to compare
+                continue
+            if (previous is None or previous[3] != row[3] or
+                    previous[4] != row[4]):
+                # new station or counters changed
+                changed.append(row[:5])
+            elif previous[5] == row[5] and previous[6] == row[6]:
+                # nothing changed at all
+                continue
+            # memory follows the latest sample once committed
+            self._pending[key] = row
+        self._database.execute_many(
+            '''
+            INSERT OR REPLACE INTO %s (
+                timestamp,
+                contract_id,
+                station_number,
+                available_bikes,
+                available_bike_stands,
+                status,
+                last_update)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''' % self.TableNameOld,
+            self._pending.values(),
+            "Database error while updating state")
+        # unchanged rows keep the timestamp of their last change, the time
+        # of the fetch is stored once
+        SettingsDAO(self._database).set_parameter(
+            self.ParameterStateTimestamp, timestamp)
+        self._stations.store_changes(timestamp)
+        # return number of received samples, and changed samples
+        return num_samples, changed
+
+    def commit_state(self):
+        # only once the database holds it too
+        if self._state is not None:
+            self._state.update(self._pending)
+        self._pending = {}
+        self._stations.commit_changes()
+
+    def reset_state(self):
+        # after a failure, reload from the database on next use
+        self._state = None
+        self._pending = {}
+        self._stations.reset_changes()
+
+    def list_state(self):
+        # (timestamp, contract_id, station_number, bikes, stands) of each
+        # station, the timestamp being the last time its row was written
+        return self._database.execute_fetch_generator(
+            '''
+            SELECT
+                timestamp,
+                contract_id,
+                station_number,
+                available_bikes,
+                available_bike_stands
+            FROM %s
+            ORDER BY contract_id, station_number
+            ''' % self.TableNameOld,
+            None,
+            "Database error listing current state")
+
+    def get_state_timestamp(self):
+        # every change up to this timestamp is in the state table, which is
+        # the last fetch when in memory
+        result = self._database.execute_fetch_one(
+            '''
+            SELECT MAX(MAX(timestamp), IFNULL((
+                SELECT value FROM %s WHERE name = ?), 0))
+            FROM %s
+            ''' % (SettingsDAO.TableName, self.TableNameOld),
+            (self.ParameterStateTimestamp, ),
+            "Database error getting timestamp of current state")
+        return result[0]
+
     def age_samples(self, date):
+        day_range = ShortSamplesDAO.get_date_range(date)
         inserted = self._database.execute_single(
             '''
             INSERT OR REPLACE INTO %s
             SELECT * FROM %s
-            WHERE date(timestamp,'unixepoch') = ?
+            WHERE timestamp >= ? AND timestamp < ?
             ''' % (self.TableNameOld, self.TableNameNew),
-            (date, ),
+            day_range,
             "Database error ageing new samples into old")
         deleted = self._database.execute_single(
             '''
             DELETE FROM %s
-            WHERE date(timestamp,'unixepoch') = ?
+            WHERE timestamp >= ? AND timestamp < ?
             ''' % self.TableNameNew,
-            (date, ),
+            day_range,
             "Database error removing aged samples from %s" % self.TableNameNew)
         # verify coherence
         if deleted != inserted:
@@ -280,21 +514,25 @@ class FullSamplesDAO(object):
         return self._database.execute_fetch_generator(
             '''
             SELECT
-                timestamp,
-                contract_id,
-                station_number,
-                status,
-                bike_stands,
-                bonus,
-                banking,
-                position,
-                address,
-                station_name,
-                last_update
-            FROM %s
-            ORDER BY contract_id, station_number
-            ''' % self.TableNameOld,
-            None,
+                MAX(o.timestamp, IFNULL((
+                    SELECT value FROM %s WHERE name = ?), 0)) AS timestamp,
+                o.contract_id,
+                o.station_number,
+                o.status,
+                s.bike_stands,
+                s.bonus,
+                s.banking,
+                s.position,
+                s.address,
+                s.station_name,
+                o.last_update
+            FROM %s AS o JOIN %s AS s
+            ON o.contract_id = s.contract_id AND
+                o.station_number = s.station_number AND
+                s.valid_until IS NULL
+            ORDER BY o.contract_id, o.station_number
+            ''' % (SettingsDAO.TableName, self.TableNameOld, StationsDAO.TableName),
+            (self.ParameterStateTimestamp, ),
             "Database error listing stations")
 
 # stored sample DAO
@@ -302,6 +540,10 @@ class ShortSamplesDAO(object):
 
     TableNameChanged = "changed_samples"
     TableNameArchive = "archived_samples"
+    TableNameKeyframe = "keyframe_samples"
+    IndexNameStation = "archived_samples_station"
+    # archived samples as csv lines, quoted as the csv module does
+    CsvFormat = '"%d","%d","%d","%d","%d"\r\n'
 
     def __init__(self, database):
         self._database = database
@@ -310,7 +552,7 @@ class ShortSamplesDAO(object):
     def _create_table(database, table_name):
         database.execute_single(
             '''
-            CREATE TABLE %s (
+            CREATE TABLE IF NOT EXISTS %s (
                 timestamp INTEGER NOT NULL,
                 contract_id INTEGER NOT NULL,
                 station_number INTEGR NOT NULL,
@@ -327,6 +569,9 @@ class ShortSamplesDAO(object):
             print "Creating table [%s]" % self.TableNameChanged
         self._create_table(self._database, self.TableNameChanged)
 
+    def create_archived_table(self):
+        self._create_table(self._database, self.TableNameArchive)
+
     def find_changed_samples(self):
         self._database.execute_single(
             '''
@@ -357,6 +602,22 @@ class ShortSamplesDAO(object):
         # return number of inserted records
         return inserted
 
+    def insert_changed_samples(self, samples):
+        inserted = self._database.execute_many(
+            '''
+            INSERT INTO %s (
+                timestamp,
+                contract_id,
+                station_number,
+                available_bikes,
+                available_bike_stands)
+            VALUES (?, ?, ?, ?, ?)
+            ''' % self.TableNameChanged,
+            samples,
+            "Database error while inserting changed samples")
+        # return number of inserted records
+        return inserted
+
     def get_changed_samples_stats(self):
         return self._database.execute_fetch_generator(
             '''
@@ -370,6 +631,19 @@ class ShortSamplesDAO(object):
             None,
             "Database error getting changed date list")
 
+    def get_changed_contracts_stats(self):
+        return self._database.execute_fetch_generator(
+            '''
+            SELECT
+                c.contract_name,
+                COUNT(s.timestamp) AS num_changed_samples
+            FROM %s AS s JOIN %s AS c
+            ON s.contract_id = c.contract_id
+            GROUP BY c.contract_name
+            ''' % (self.TableNameChanged, ContractsDAO.TableName),
+            None,
+            "Database error getting changed contract list")
+
     @staticmethod
     def get_schema_name(date):
         return "samples_%s" % date.replace("-", "_")
@@ -378,30 +652,97 @@ class ShortSamplesDAO(object):
     def get_db_file_name(schema_name):
         return "%s.db" % schema_name
 
-    def initialize_archived_table(self, dbfilename):
-        with jcd.common.SqliteDB(dbfilename, jcd.app.App.DataPath) as storage_db:
-            if not storage_db.has_table(self.TableNameArchive):
-                self._create_table(storage_db, self.TableNameArchive)
-                return True
-        return False
+    @staticmethod
+    def get_compact_file_name(schema_name):
+        return "%s.%s" % (schema_name, jcd.archive.CompactArchive.Extension)
+
+    @staticmethod
+    def find_archives():
+        # (date, file name) of every daily archive, in either format
+        pattern = re.compile(r"^samples_(\d{4})_(\d{2})_(\d{2})\.(db|%s)$" % (
+            jcd.archive.CompactArchive.Extension))
+        archives = []
+        for file_name in os.listdir(os.path.expanduser(jcd.app.App.DataPath)):
+            match = pattern.match(file_name)
+            if match is not None:
+                archives.append(("-".join(match.groups()[:3]), file_name))
+        return sorted(archives)
+
+    @staticmethod
+    def find_monthly_archives():
+        # (month, file name) of every monthly database
+        pattern = re.compile(r"^samples_(\d{4})_(\d{2})\.db$")
+        archives = []
+        for file_name in os.listdir(os.path.expanduser(jcd.app.App.DataPath)):
+            match = pattern.match(file_name)
+            if match is not None:
+                archives.append(("-".join(match.groups()), file_name))
+        return sorted(archives)
+
+    @classmethod
+    def locate_archive(cls, date):
+        # the sqlite database while it exists, else the compact file, else
+        # the monthly database
+        schema_name = cls.get_schema_name(date)
+        for file_name in (cls.get_db_file_name(schema_name),
+                          cls.get_compact_file_name(schema_name),
+                          cls.get_db_file_name(cls.get_schema_name(date[:7]))):
+            if os.path.exists(jcd.common.SqliteDB.get_full_path(
+                    file_name, jcd.app.App.DataPath)):
+                return file_name
+        raise jcd.common.JcdException("No archive for [%s]" % date)
+
+    @staticmethod
+    def get_date(timestamp):
+        return time.strftime("%Y-%m-%d", time.gmtime(timestamp))
+
+    @staticmethod
+    def get_date_range(date):
+        # first and past-the-end timestamps of an utc day
+        start = calendar.timegm(time.strptime(date, "%Y-%m-%d"))
+        return start, start + 86400
+
+    @classmethod
+    def get_dates(cls, first_date, last_date):
+        # every day from first to last, both included
+        start = cls.get_date_range(first_date)[0]
+        end = cls.get_date_range(last_date)[1]
+        return [cls.get_date(timestamp) for timestamp in xrange(start, end, 86400)]
+
+    def attach_archive(self, date):
+        # daily databases stay attached, and are initialized when attached
+        schema_name = self.get_schema_name(date)
+        db_filename = self.get_db_file_name(schema_name)
+        created = False
+        if not self._database.is_attached(schema_name):
+            created = not os.path.exists(jcd.common.SqliteDB.get_full_path(
+                db_filename, jcd.app.App.DataPath))
+        # WARNING: attaching commits current transaction
+        if self._database.use_database(
+                db_filename, schema_name, jcd.app.App.DataPath):
+            self._create_table(self._database, "%s.%s" % (
+                schema_name, self.TableNameArchive))
+        return schema_name, created
 
     def archive_changed_samples(self, date, target_schema):
+        # timestamp ranges use the primary key, unlike date()
+        day_range = self.get_date_range(date)
         inserted = self._database.execute_single(
             '''
             INSERT INTO %s.%s
             SELECT * FROM %s
-            WHERE date(timestamp,'unixepoch') = ?
+            WHERE timestamp >= ? AND timestamp < ?
             ''' % (target_schema,
                    self.TableNameArchive,
                    self.TableNameChanged),
-            (date, ),
+            day_range,
             "Database error inserting changed samples to %s.%s" % (target_schema, self.TableNameArchive))
         deleted = self._database.execute_single(
             '''
             DELETE FROM %s
-            WHERE date(timestamp,'unixepoch') = ?
+            WHERE timestamp >= ? AND timestamp < ?
             ''' % self.TableNameChanged,
-            (date, ),
+            day_range,
             "Database error archiving changed samples from %s" % self.TableNameChanged)
         # verify coherence
         if deleted != inserted:
@@ -450,26 +791,909 @@ class ShortSamplesDAO(object):
         # return number of inserted records
         return num_inserted
 
-    def list_archived(self, schema_name):
+    def list_archived(self, date):
+        file_name = self.locate_archive(date)
+        if file_name.endswith(jcd.archive.CompactArchive.Extension):
+            return self._list_compact(file_name)
+        schema_name = file_name[:-len(".db")]
+        # open if it exists, and verify that table exists
+        if not self._database.is_attached(schema_name):
+            self._database.attach_database(
+                file_name, schema_name, jcd.app.App.DataPath, True)
+        if not self._database.has_table(self.TableNameArchive, schema_name):
+            raise jcd.common.JcdException(
+                "No table for archived samples in [%s] database" % file_name)
+        if schema_name != self.get_schema_name(date):
+            # only the requested day of a monthly database
+            return self.list_archived_table(schema_name, self.get_date_range(date))
+        return self.list_archived_table(schema_name)
+
+    @staticmethod
+    def _list_compact(file_name):
+        with jcd.archive.CompactArchive(jcd.common.SqliteDB.get_full_path(
+                file_name, jcd.app.App.DataPath)) as archive:
+            for sample in archive.read_all():
+                yield sample
+
+    def list_archived_table(self, schema_name, time_range=None,
+                            contract_id=None, station_number=None, as_csv=False):
+        # filters are done by sqlite, using the station index if any
+        conditions = []
+        params = []
+        columns = '''
+                timestamp,
+                contract_id,
+                station_number,
+                available_bikes,
+                available_bike_stands'''
+        if as_csv:
+            # formatted by sqlite, a single string by sample
+            columns = "printf(?, %s)" % columns
+            params.append(self.CsvFormat)
+        if time_range is not None:
+            conditions.append("timestamp >= ? AND timestamp < ?")
+            params.extend(time_range)
+        if contract_id is not None:
+            conditions.append("contract_id = ?")
+            params.append(contract_id)
+        if station_number is not None:
+            conditions.append("station_number = ?")
+            params.append(station_number)
+        return self._database.execute_fetch_generator(
+            '''
+            SELECT %s
+            FROM %s.%s
+            %s
+            ORDER BY timestamp, contract_id, station_number
+            ''' % (columns, schema_name, ShortSamplesDAO.TableNameArchive,
+                   "" if len(conditions) == 0 else
+                   "WHERE %s" % " AND ".join(conditions)),
+            params,
+            "Database error listing archived samples")
+
+    def get_samples_bounds(self, table, time_range=None):
+        # number of samples, first and last timestamps, contract ids
+        result = self._database.execute_fetch_one(
+            '''
+            SELECT
+                COUNT(*),
+                MIN(timestamp),
+                MAX(timestamp),
+                GROUP_CONCAT(DISTINCT contract_id)
+            FROM %s
+            %s
+            ''' % (table, "" if time_range is None else
+                   "WHERE timestamp >= ? AND timestamp < ?"),
+            time_range,
+            "Database error getting bounds of samples in %s" % table)
+        contract_ids = set()
+        if result[3] is not None:
+            contract_ids = set(int(value) for value in result[3].split(","))
+        return result[0], result[1], result[2], contract_ids
+
+    def get_changed_bounds(self, date):
+        return self.get_samples_bounds(
+            self.TableNameChanged, self.get_date_range(date))
+
+    def get_archived_bounds(self, schema_name, date=None):
+        return self.get_samples_bounds(
+            "%s.%s" % (schema_name, self.TableNameArchive),
+            None if date is None else self.get_date_range(date))
+
+    def has_station_index(self, schema_name="main"):
+        result = self._database.execute_fetch_one(
+            '''
+            SELECT COUNT(*)
+            FROM %s.sqlite_master
+            WHERE type = "index" AND name = ?
+            ''' % schema_name,
+            (self.IndexNameStation, ),
+            "Database error checking if index [%s] exists" % self.IndexNameStation)
+        return result[0] != 0
+
+    def create_station_index(self, schema_name="main"):
+        # covering, so that a station history never reads the table itself
+        self._database.execute_single(
+            '''
+            CREATE INDEX IF NOT EXISTS %s.%s
+            ON %s (
+                contract_id,
+                station_number,
+                timestamp,
+                available_bikes,
+                available_bike_stands)
+            ''' % (schema_name, self.IndexNameStation, self.TableNameArchive),
+            None,
+            "Database error while creating index [%s]" % self.IndexNameStation)
+
+    def _locate_range(self, start, end):
+        # [file name, start, end] of the files holding a time range,
+        # consecutive days in the same file are read at once
+        files = []
+        if end <= start:
+            return files
+        for date in self.get_dates(self.get_date(start), self.get_date(end - 1)):
+            try:
+                file_name = self.locate_archive(date)
+            except jcd.common.JcdException:
+                # no sample on that day
+                continue
+            day_start, day_end = self.get_date_range(date)
+            day_start = max(day_start, start)
+            day_end = min(day_end, end)
+            if len(files) > 0 and files[-1][0] == file_name:
+                files[-1][2] = day_end
+            else:
+                files.append([file_name, day_start, day_end])
+        return files
+
+    def list_range(self, start, end, contract_id=None, station_number=None,
+                   as_csv=False):
+        # samples from start (included) to end (excluded), in the order of
+        # a single day : every file holds whole days, so reading them one
+        # after the other keeps the timestamp order, one file at a time
+        if station_number is not None and contract_id is None:
+            raise jcd.common.JcdException(
+                "A station number is only meaningful within a contract")
+        for file_name, file_start, file_end in self._locate_range(start, end):
+            if file_name.endswith(jcd.archive.CompactArchive.Extension):
+                with jcd.archive.CompactArchive(jcd.common.SqliteDB.get_full_path(
+                        file_name, jcd.app.App.DataPath)) as archive:
+                    for sample in archive.read_all(contract_id, station_number):
+                        if file_start <= sample[0] < file_end:
+                            yield self.CsvFormat % sample if as_csv else sample
+                continue
+            schema_name = file_name[:-len(".db")]
+            if not self._database.is_attached(schema_name):
+                # WARNING: attaching commits current transaction
+                self._database.use_database(
+                    file_name, schema_name, jcd.app.App.DataPath)
+            samples = self.list_archived_table(
+                schema_name, (file_start, file_end), contract_id, station_number,
+                as_csv)
+            if as_csv:
+                for sample in samples:
+                    yield sample[0]
+            else:
+                for sample in samples:
+                    yield sample
+
+    def list_station(self, contract_id, station_number, first_date, last_date):
+        # history of a station, from the first to the last day included
+        return self.list_range(
+            self.get_date_range(first_date)[0], self.get_date_range(last_date)[1],
+            contract_id, station_number)
+
+    def list_range_stations(self, start, end, contract_id=None,
+                            station_number=None):
+        # (contract_id, station_number) having samples in a time range, sorted,
+        # compact files are only read from their index, for whole days
+        stations = set()
+        for file_name, file_start, file_end in self._locate_range(start, end):
+            if file_name.endswith(jcd.archive.CompactArchive.Extension):
+                with jcd.archive.CompactArchive(jcd.common.SqliteDB.get_full_path(
+                        file_name, jcd.app.App.DataPath)) as archive:
+                    stations.update(entry[:2] for entry in archive.get_stations())
+                continue
+            schema_name = file_name[:-len(".db")]
+            if not self._database.is_attached(schema_name):
+                # WARNING: attaching commits current transaction
+                self._database.use_database(
+                    file_name, schema_name, jcd.app.App.DataPath)
+            stations.update(tuple(row) for row in self._database.execute_fetch_generator(
+                '''
+                SELECT DISTINCT contract_id, station_number
+                FROM %s.%s
+                WHERE timestamp >= ? AND timestamp < ?
+                ''' % (schema_name, ShortSamplesDAO.TableNameArchive),
+                (file_start, file_end),
+                "Database error listing stations of %s" % schema_name))
+        return sorted(station for station in stations
+                      if contract_id in (None, station[0]) and
+                      station_number in (None, station[1]))
+
+    def get_states_before(self, timestamp, stations, max_days=7):
+        # last (timestamp, bikes, stands) of stations before a timestamp,
+        # reading back one day at a time until every station is found
+        states = {}
+        wanted = set(stations)
+        contract_ids = set(station[0] for station in wanted)
+        # a single contract is read from the station index if any
+        contract_id = contract_ids.pop() if len(contract_ids) == 1 else None
+        end = timestamp
+        for _ in xrange(max_days):
+            if len(wanted) == 0:
+                break
+            start = self.get_date_range(self.get_date(end - 1))[0]
+            found = {}
+            for sample in self.list_range(start, end, contract_id):
+                key = (sample[1], sample[2])
+                if key in wanted:
+                    found[key] = (sample[0], sample[3], sample[4])
+            states.update(found)
+            wanted.difference_update(found)
+            end = start
+        return states
+
+    def list_grid(self, first_date, last_date, step, stations, start_state=None):
+        # states of stations every step seconds, forward filled from their
+        # last change ; yields, for each day, its first timestamp and, for
+        # each station, an array of its bikes and one of its stands, -1 as
+        # long as the state of the station is unknown ; start_state is the
+        # result of get_state_at just before the first day, if known
+        if step <= 0 or 86400 % step != 0:
+            raise jcd.common.JcdException(
+                "Step must divide a day (86400 seconds)")
+        num_steps = 86400 // step
+        start = self.get_date_range(first_date)[0]
+        index = dict((station, position) for position, station in enumerate(stations))
+        contract_ids = set(station[0] for station in stations)
+        contract_id = contract_ids.pop() if len(contract_ids) == 1 else None
+        # state at the start of the range
+        current = [(-1, -1)] * len(stations)
+        if start_state is None:
+            start_state = self.get_state_at(start - 1, contract_id, stations=stations)
+        for sample in start_state:
+            position = index.get((sample[1], sample[2]))
+            if position is not None:
+                current[position] = (sample[3], sample[4])
+        for date in self.get_dates(first_date, last_date):
+            day_start, day_end = self.get_date_range(date)
+            # changes of each station, in timestamp order
+            changes = [[] for _ in stations]
+            for sample in self.list_range(day_start, day_end, contract_id):
+                position = index.get((sample[1], sample[2]))
+                if position is not None:
+                    changes[position].append(sample)
+            all_bikes = []
+            all_stands = []
+            for position in xrange(len(stations)):
+                bikes = array.array("h")
+                stands = array.array("h")
+                bike, stand = current[position]
+                done = 0
+                # a change is visible from the first grid point at or after it
+                for sample in changes[position]:
+                    filled = (sample[0] - day_start + step - 1) // step
+                    if filled > done:
+                        bikes.extend(array.array("h", (bike, )) * (filled - done))
+                        stands.extend(array.array("h", (stand, )) * (filled - done))
+                        done = filled
+                    bike = sample[3]
+                    stand = sample[4]
+                bikes.extend(array.array("h", (bike, )) * (num_steps - done))
+                stands.extend(array.array("h", (stand, )) * (num_steps - done))
+                current[position] = (bike, stand)
+                all_bikes.append(bikes)
+                all_stands.append(stands)
+            yield day_start, all_bikes, all_stands
+
+    @staticmethod
+    def _create_keyframe_table(database, table_name):
+        # the last change of each station, as of the keyframe timestamp
+        database.execute_single(
+            '''
+            CREATE TABLE IF NOT EXISTS %s (
+                keyframe INTEGER NOT NULL,
+                timestamp INTEGER NOT NULL,
+                contract_id INTEGER NOT NULL,
+                station_number INTEGR NOT NULL,
+                available_bikes INTEGER NOT NULL,
+                available_bike_stands INTEGER NOT NULL,
+                PRIMARY KEY (keyframe, contract_id, station_number)
+            ) WITHOUT ROWID;
+            ''' % table_name,
+            None,
+            "Database error while creating table [%s]" % table_name)
+
+    def store_keyframe(self, keyframe, samples, target_schema):
+        # samples are the last change of every station up to keyframe
+        self._create_keyframe_table(self._database, "%s.%s" % (
+            target_schema, self.TableNameKeyframe))
+        return self._database.execute_many(
+            '''
+            INSERT OR REPLACE INTO %s.%s
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''' % (target_schema, self.TableNameKeyframe),
+            [(keyframe, ) + tuple(sample) for sample in samples],
+            "Database error storing keyframe into %s" % target_schema)
+
+    def get_last_keyframe(self, schema_name, start, end):
+        # timestamp of the last keyframe from start (included) to end
+        # (excluded), None if there is none
+        if not self._database.has_table(self.TableNameKeyframe, schema_name):
+            return None
+        result = self._database.execute_fetch_one(
+            '''
+            SELECT MAX(keyframe)
+            FROM %s.%s
+            WHERE keyframe >= ? AND keyframe < ?
+            ''' % (schema_name, self.TableNameKeyframe),
+            (start, end),
+            "Database error getting last keyframe of %s" % schema_name)
+        return result[0]
+
+    def list_keyframes(self, schema_name):
+        # every keyframe row of a daily database, for the compact format
+        if not self._database.has_table(self.TableNameKeyframe, schema_name):
+            return []
         return self._database.execute_fetch_generator(
             '''
             SELECT
+                keyframe,
                 timestamp,
                 contract_id,
                 station_number,
                 available_bikes,
                 available_bike_stands
             FROM %s.%s
-            ORDER BY timestamp, contract_id, station_number
-            ''' % (schema_name, ShortSamplesDAO.TableNameArchive),
+            ORDER BY keyframe, contract_id, station_number
+            ''' % (schema_name, self.TableNameKeyframe),
             None,
-            "Database error listing archived samples")
+            "Database error listing keyframes of %s" % schema_name)
+
+    def find_keyframe(self, timestamp, max_days=7):
+        # (file name, timestamp) of the last keyframe at or before a
+        # timestamp, reading back one day at a time
+        end = timestamp + 1
+        for _ in xrange(max_days):
+            date = self.get_date(end - 1)
+            day_start = self.get_date_range(date)[0]
+            try:
+                file_name = self.locate_archive(date)
+            except jcd.common.JcdException:
+                # no sample on that day
+                file_name = None
+            if file_name is None:
+                keyframe = None
+            elif file_name.endswith(jcd.archive.CompactArchive.Extension):
+                with jcd.archive.CompactArchive(jcd.common.SqliteDB.get_full_path(
+                        file_name, jcd.app.App.DataPath)) as archive:
+                    keyframes = [keyframe for keyframe in archive.get_keyframes()
+                                 if keyframe < end]
+                keyframe = keyframes[-1] if keyframes else None
+            else:
+                schema_name = file_name[:-len(".db")]
+                if not self._database.is_attached(schema_name):
+                    # WARNING: attaching commits current transaction
+                    self._database.use_database(
+                        file_name, schema_name, jcd.app.App.DataPath)
+                keyframe = self.get_last_keyframe(schema_name, day_start, end)
+            if keyframe is not None:
+                return file_name, keyframe
+            end = day_start
+        return None
+
+    def _read_keyframe(self, file_name, keyframe, contract_id, station_number):
+        if file_name.endswith(jcd.archive.CompactArchive.Extension):
+            with jcd.archive.CompactArchive(jcd.common.SqliteDB.get_full_path(
+                    file_name, jcd.app.App.DataPath)) as archive:
+                for sample in archive.read_keyframe(
+                        keyframe, contract_id, station_number):
+                    yield sample
+            return
+        schema_name = file_name[:-len(".db")]
+        conditions = ["keyframe = ?"]
+        params = [keyframe]
+        if contract_id is not None:
+            conditions.append("contract_id = ?")
+            params.append(contract_id)
+        if station_number is not None:
+            conditions.append("station_number = ?")
+            params.append(station_number)
+        for row in self._database.execute_fetch_generator(
+                '''
+                SELECT
+                    timestamp,
+                    contract_id,
+                    station_number,
+                    available_bikes,
+                    available_bike_stands
+                FROM %s.%s
+                WHERE %s
+                ''' % (schema_name, self.TableNameKeyframe,
+                       " AND ".join(conditions)),
+                params,
+                "Database error reading keyframe of %s" % schema_name):
+            yield row
+
+    def get_state_at(self, timestamp, contract_id=None, station_number=None,
+                     max_days=7, stations=None):
+        # last sample of each station at a timestamp (included), sorted by
+        # station : the nearest keyframe, then the changes after it ; with
+        # no keyframe in max_days, the stations (default: those which changed
+        # during that time) are read back day by day
+        if station_number is not None and contract_id is None:
+            raise jcd.common.JcdException(
+                "A station number is only meaningful within a contract")
+        states = {}
+        keyframe = self.find_keyframe(timestamp, max_days)
+        if keyframe is None:
+            if stations is None:
+                stations = self.list_range_stations(
+                    timestamp + 1 - max_days * 86400, timestamp + 1,
+                    contract_id, station_number)
+            for key, state in self.get_states_before(
+                    timestamp + 1, stations, max_days).iteritems():
+                states[key] = (state[0], ) + key + state[1:]
+            return [states[key] for key in sorted(states)]
+        file_name, start = keyframe
+        for row in self._read_keyframe(file_name, start, contract_id,
+                                       station_number):
+            states[(row[1], row[2])] = tuple(row)
+        for sample in self.list_range(start + 1, timestamp + 1, contract_id,
+                                      station_number):
+            states[(sample[1], sample[2])] = tuple(sample)
+        return [states[key] for key in sorted(states)]
+
+    def has_rowid_archive(self, schema_name="main"):
+        # archives created before v2.3.0 (see utils folder)
+        result = self._database.execute_fetch_one(
+            '''
+            SELECT sql
+            FROM %s.sqlite_master
+            WHERE type = "table" AND name = ?
+            ''' % schema_name,
+            (self.TableNameArchive, ),
+            "Database error reading archived samples table definition")
+        return "WITHOUT ROWID" not in result[0].upper()
+
+    def rebuild_archived_table(self):
+        # copy samples into a table without rowid, and use it instead
+        temp_name = "%s_without_rowid" % self.TableNameArchive
+        self._create_table(self._database, temp_name)
+        self._database.execute_single(
+            '''
+            INSERT INTO %s
+            SELECT
+                timestamp,
+                contract_id,
+                station_number,
+                available_bikes,
+                available_bike_stands
+            FROM %s
+            ''' % (temp_name, self.TableNameArchive),
+            None,
+            "Database error copying archived samples")
+        self._database.execute_single(
+            '''
+            DROP TABLE %s
+            ''' % self.TableNameArchive,
+            None,
+            "Database error dropping archived samples table")
+        self._database.execute_single(
+            '''
+            ALTER TABLE %s RENAME TO %s
+            ''' % (temp_name, self.TableNameArchive),
+            None,
+            "Database error renaming archived samples table")
+
+    def merge_archived_samples(self, source_schema):
+        # merging the same samples again is harmless
+        inserted = self._database.execute_single(
+            '''
+            INSERT OR REPLACE INTO %s
+            SELECT
+                timestamp,
+                contract_id,
+                station_number,
+                available_bikes,
+                available_bike_stands
+            FROM %s.%s
+            ''' % (self.TableNameArchive, source_schema, self.TableNameArchive),
+            None,
+            "Database error merging archived samples from %s" % source_schema)
+        # return number of merged records
+        return inserted
+
+    def merge_keyframes(self, source_schema):
+        self._create_keyframe_table(self._database, self.TableNameKeyframe)
+        return self._database.execute_single(
+            '''
+            INSERT OR REPLACE INTO %s
+            SELECT * FROM %s.%s
+            ''' % (self.TableNameKeyframe, source_schema, self.TableNameKeyframe),
+            None,
+            "Database error merging keyframes from %s" % source_schema)
+
+# catalog of archived samples, one row per day
+class ArchivesDAO(object):
+
+    TableName = "archives"
+
+    FormatDaily = "daily"
+    FormatCompact = "compact"
+    FormatMonthly = "monthly"
+
+    def __init__(self, database):
+        self._database = database
+
+    def create_table(self):
+        if jcd.app.App.Verbose:
+            print "Creating table [%s]" % self.TableName
+        # may be created later on, when upgrading
+        self._database.execute_single(
+            '''
+            CREATE TABLE IF NOT EXISTS %s (
+                date TEXT PRIMARY KEY NOT NULL,
+                file_name TEXT NOT NULL,
+                file_format TEXT NOT NULL,
+                num_samples INTEGER NOT NULL,
+                first_timestamp INTEGER,
+                last_timestamp INTEGER,
+                contract_ids TEXT NOT NULL,
+                file_size INTEGER NOT NULL,
+                checksum TEXT,
+                last_modification INTEGER NOT NULL
+            ) WITHOUT ROWID;
+            ''' % self.TableName,
+            None,
+            "Database error while creating table [%s]" % self.TableName)
+
+    def open_table(self):
+        # an application database from before the catalog gets it on first
+        # use, and its days are cataloged as they are written to
+        if not self._database.has_table(self.TableName):
+            self.create_table()
+
+    @staticmethod
+    def get_checksum(file_path):
+        digest = hashlib.sha1()
+        with open(file_path, "rb") as archive:
+            for chunk in iter(lambda: archive.read(1 << 20), ""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def get_day(self, date):
+        return self._database.execute_fetch_one(
+            '''
+            SELECT
+                date,
+                file_name,
+                file_format,
+                num_samples,
+                first_timestamp,
+                last_timestamp,
+                contract_ids,
+                file_size,
+                checksum
+            FROM %s
+            WHERE date = ?
+            ''' % self.TableName,
+            (date, ),
+            "Database error getting archive of [%s]" % date)
+
+    def set_day(self, date, file_name, file_format, bounds, file_size, checksum=None):
+        # bounds are number of samples, first and last timestamps, contract ids
+        num_samples, first_timestamp, last_timestamp, contract_ids = bounds
+        self._database.execute_single(
+            '''
+            INSERT OR REPLACE INTO %s (
+                date,
+                file_name,
+                file_format,
+                num_samples,
+                first_timestamp,
+                last_timestamp,
+                contract_ids,
+                file_size,
+                checksum,
+                last_modification)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, strftime('%%s', 'now'))
+            ''' % self.TableName,
+            (date, file_name, file_format, num_samples, first_timestamp,
+             last_timestamp, ",".join(str(value) for value in sorted(contract_ids)),
+             file_size, checksum),
+            "Database error while setting archive of [%s]" % date)
+
+    def add_samples(self, date, file_name, bounds, file_size, schema_name):
+        # samples were added to a daily database, attached as schema_name
+        num_samples, first_timestamp, last_timestamp, contract_ids = bounds
+        if num_samples == 0:
+            return
+        row = self.get_day(date)
+        if row is None:
+            # not cataloged yet : the whole file, added samples included
+            num_samples, first_timestamp, last_timestamp, contract_ids = (
+                ShortSamplesDAO(self._database).get_archived_bounds(schema_name, date))
+        elif row["file_name"] == file_name:
+            num_samples += row["num_samples"]
+            if row["first_timestamp"] is not None:
+                first_timestamp = min(first_timestamp, row["first_timestamp"])
+                last_timestamp = max(last_timestamp, row["last_timestamp"])
+            if row["contract_ids"]:
+                contract_ids = set(contract_ids).union(
+                    int(value) for value in row["contract_ids"].split(","))
+        # the file changed, so it has no checksum anymore
+        self.set_day(date, file_name, self.FormatDaily,
+                     (num_samples, first_timestamp, last_timestamp, contract_ids),
+                     file_size)
+
+    def update_file(self, old_file_name, file_name, file_format, file_size, checksum):
+        # samples moved to another file, or the file was rewritten
+        return self._database.execute_single(
+            '''
+            UPDATE %s
+            SET file_name = ?,
+                file_format = ?,
+                file_size = ?,
+                checksum = ?,
+                last_modification = strftime('%%s', 'now')
+            WHERE file_name = ?
+            ''' % self.TableName,
+            (file_name, file_format, file_size, checksum, old_file_name),
+            "Database error while updating archive file [%s]" % old_file_name)
+
+    def clear(self):
+        self._database.execute_single(
+            '''
+            DELETE FROM %s
+            ''' % self.TableName,
+            None,
+            "Database error while clearing %s table" % self.TableName)
+
+    def list(self):
+        return self._database.execute_fetch_generator(
+            '''
+            SELECT
+                date,
+                file_name,
+                file_format,
+                num_samples,
+                first_timestamp,
+                last_timestamp,
+                contract_ids,
+                file_size,
+                checksum
+            FROM %s
+            ORDER BY date
+            ''' % self.TableName,
+            None,
+            "Database error listing archives")
+
+    def get_stats(self):
+        # monthly files hold many days, count their size once
+        return self._database.execute_fetch_generator(
+            '''
+            SELECT
+                file_format,
+                COUNT(*) AS num_files,
+                SUM(num_days) AS num_days,
+                SUM(num_samples) AS num_samples,
+                SUM(file_size) AS file_size,
+                MIN(first_date) AS first_date,
+                MAX(last_date) AS last_date
+            FROM (
+                SELECT
+                    file_format,
+                    COUNT(*) AS num_days,
+                    SUM(num_samples) AS num_samples,
+                    MAX(file_size) AS file_size,
+                    MIN(date) AS first_date,
+                    MAX(date) AS last_date
+                FROM %s
+                GROUP BY file_name
+            )
+            GROUP BY file_format
+            ORDER BY file_format
+            ''' % self.TableName,
+            None,
+            "Database error getting archives statistics")
+
+# progress of the version 1 imports, by source database and day
+class ImportLedgerDAO(object):
+
+    TableName = "import_ledger"
+
+    # samples of the day are in its CSV file, being imported, or imported
+    StatusExtracted = "extracted"
+    StatusImporting = "importing"
+    StatusImported = "imported"
+
+    def __init__(self, database):
+        self._database = database
+
+    def create_table(self):
+        # created by the first import
+        self._database.execute_single(
+            '''
+            CREATE TABLE IF NOT EXISTS %s (
+                source TEXT NOT NULL,
+                date TEXT NOT NULL,
+                status TEXT NOT NULL,
+                num_extracted INTEGER NOT NULL,
+                num_imported INTEGER NOT NULL,
+                num_stored INTEGER NOT NULL,
+                earliest_timestamp INTEGER,
+                last_modification INTEGER NOT NULL,
+                PRIMARY KEY (source, date)
+            ) WITHOUT ROWID;
+            ''' % self.TableName,
+            None,
+            "Database error while creating table [%s]" % self.TableName)
+
+    def get_days(self, source):
+        # date to (status, extracted, imported, stored, earliest timestamp)
+        return dict((row[0], tuple(row)[1:]) for row in self._database.execute_fetch_generator(
+            '''
+            SELECT
+                date,
+                status,
+                num_extracted,
+                num_imported,
+                num_stored,
+                earliest_timestamp
+            FROM %s
+            WHERE source = ?
+            ''' % self.TableName,
+            (source, ),
+            "Database error listing imported days of [%s]" % source))
+
+    def set_day(self, source, date, status, num_extracted, num_imported=0,
+                num_stored=0, earliest_timestamp=None):
+        # imported samples are csv lines already read, of which num_stored
+        # were added ; earliest_timestamp is the first sample of the target
+        # database before the import of the day started
+        self._database.execute_single(
+            '''
+            INSERT OR REPLACE INTO %s (
+                source,
+                date,
+                status,
+                num_extracted,
+                num_imported,
+                num_stored,
+                earliest_timestamp,
+                last_modification)
+            VALUES (?, ?, ?, ?, ?, ?, ?, strftime('%%s', 'now'))
+            ''' % self.TableName,
+            (source, date, status, num_extracted, num_imported, num_stored,
+             earliest_timestamp),
+            "Database error while setting import of [%s]" % date)
+
+# station activity aggregates, in their own database
+class StatsDAO(object):
+
+    DbName = "stats.db"
+    TableNameDay = "activity_stations_day"
+    TableNameHour = "activity_stations_hour"
+    TableNameLedger = "activity_ledger"
+
+    def __init__(self, database):
+        self._database = database
+
+    def _create_activity_table(self, table_name, period, extra_columns=""):
+        # samples of a period are removed and inserted together, so its
+        # start comes first in the key
+        self._database.execute_single(
+            '''
+            CREATE TABLE IF NOT EXISTS %s (
+                %s INTEGER NOT NULL,
+                contract_id INTEGER NOT NULL,
+                station_number INTEGER NOT NULL,
+                num_changes INTEGER NOT NULL,
+                bikes_taken INTEGER NOT NULL,
+                bikes_returned INTEGER NOT NULL,
+                min_bikes INTEGER NOT NULL,
+                max_bikes INTEGER NOT NULL,
+                mean_bikes REAL NOT NULL,
+                time_known INTEGER NOT NULL,
+                time_empty INTEGER NOT NULL,
+                time_full INTEGER NOT NULL,%s
+                PRIMARY KEY (%s, contract_id, station_number)
+            ) WITHOUT ROWID;
+            ''' % (table_name, period, extra_columns, period),
+            None,
+            "Database error while creating table [%s]" % table_name)
+
+    def create_tables(self):
+        # created by the first aggregation
+        self._create_activity_table(self.TableNameDay, "start_of_day", '''
+                last_change INTEGER NOT NULL,
+                last_bikes INTEGER NOT NULL,
+                last_stands INTEGER NOT NULL,''')
+        self._create_activity_table(self.TableNameHour, "start_of_hour")
+        self._database.execute_single(
+            '''
+            CREATE TABLE IF NOT EXISTS %s (
+                date TEXT PRIMARY KEY NOT NULL,
+                num_samples INTEGER NOT NULL,
+                last_timestamp INTEGER,
+                num_stations INTEGER NOT NULL,
+                last_modification INTEGER NOT NULL
+            ) WITHOUT ROWID;
+            ''' % self.TableNameLedger,
+            None,
+            "Database error while creating table [%s]" % self.TableNameLedger)
+
+    def clear(self):
+        for table_name in (self.TableNameDay, self.TableNameHour, self.TableNameLedger):
+            self._database.execute_single(
+                '''
+                DELETE FROM %s
+                ''' % table_name,
+                None,
+                "Database error while clearing %s table" % table_name)
+
+    def get_days(self):
+        # date to (number of samples, last timestamp) of the archive when
+        # the day was aggregated
+        return dict((row[0], tuple(row)[1:]) for row in self._database.execute_fetch_generator(
+            '''
+            SELECT
+                date,
+                num_samples,
+                last_timestamp
+            FROM %s
+            ''' % self.TableNameLedger,
+            None,
+            "Database error listing aggregated days"))
+
+    def get_states(self, start_of_day):
+        # (last change, bikes, stands) of each station at the end of a day
+        return dict((tuple(row)[:2], tuple(row)[2:]) for row in self._database.execute_fetch_generator(
+            '''
+            SELECT
+                contract_id,
+                station_number,
+                last_change,
+                last_bikes,
+                last_stands
+            FROM %s
+            WHERE start_of_day = ?
+            ''' % self.TableNameDay,
+            (start_of_day, ),
+            "Database error getting station states of %i" % start_of_day))
+
+    def set_day(self, date, day_range, day_rows, hour_rows, num_samples,
+                last_timestamp):
+        # rows of a day aggregated again replace the previous ones
+        for table_name, period in ((self.TableNameDay, "start_of_day"),
+                                   (self.TableNameHour, "start_of_hour")):
+            self._database.execute_single(
+                '''
+                DELETE FROM %s
+                WHERE %s >= ? AND %s < ?
+                ''' % (table_name, period, period),
+                day_range,
+                "Database error removing aggregates of [%s] from %s" % (date, table_name))
+        self._database.execute_many(
+            '''
+            INSERT INTO %s
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''' % self.TableNameDay,
+            day_rows,
+            "Database error inserting aggregates of [%s] into %s" % (date, self.TableNameDay))
+        self._database.execute_many(
+            '''
+            INSERT INTO %s
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''' % self.TableNameHour,
+            hour_rows,
+            "Database error inserting aggregates of [%s] into %s" % (date, self.TableNameHour))
+        self._database.execute_single(
+            '''
+            INSERT OR REPLACE INTO %s (
+                date,
+                num_samples,
+                last_timestamp,
+                num_stations,
+                last_modification)
+            VALUES (?, ?, ?, ?, strftime('%%s', 'now'))
+            ''' % self.TableNameLedger,
+            (date, num_samples, last_timestamp, len(day_rows)),
+            "Database error while setting aggregation of [%s]" % date)
 
 # stored sample DAO
 class Version1Dao(object):
 
     TableName = "samples"
     SchemaName = "version1"
+    IndexNameTimestamp = "samples_timestamp"
+    # work tables of the per day import
+    TableNameContracts = "version1_contracts"
+    TableNameLast = "version1_last"
+    TableNameChanged = "version1_changed"
 
     def __init__(self, database):
         self._database = database
@@ -477,7 +1701,9 @@ class Version1Dao(object):
     def has_sample_table(self):
         return self._database.has_table(self.TableName, self.SchemaName)
 
-    def list_samples(self):
+    def list_samples(self, start=0):
+        # in timestamp order (using the timestamp index), so that each day
+        # is complete as soon as the next one starts
         return self._database.execute_fetch_generator(
             '''
             SELECT s.timestamp,
@@ -488,8 +1714,169 @@ class Version1Dao(object):
                 s.empty
             FROM %s AS c JOIN %s.%s AS s
             ON c.contract_name = s.contract_name
+            WHERE s.timestamp >= ?
+            ORDER BY s.timestamp
             ''' % (ContractsDAO.TableName,
                    self.SchemaName,
                    self.TableName),
-            None,
+            (start, ),
             "Database error listing all samples in version 1 data")
+
+    def has_timestamp_index(self):
+        result = self._database.execute_fetch_one(
+            '''
+            SELECT COUNT(*)
+            FROM %s.sqlite_master
+            WHERE type = "index" AND name = ?
+            ''' % self.SchemaName,
+            (self.IndexNameTimestamp, ),
+            "Database error checking index of version 1 data")
+        return result[0] > 0
+
+    def create_timestamp_index(self):
+        # days are read separately, sqlite sorts the whole table once
+        self._database.execute_single(
+            '''
+            CREATE INDEX IF NOT EXISTS %s.%s
+            ON %s (timestamp)
+            ''' % (self.SchemaName, self.IndexNameTimestamp, self.TableName),
+            None,
+            "Database error indexing version 1 data")
+
+    def list_dates(self):
+        # days holding samples, jumping from one day to the next on the index
+        dates = []
+        start = 0
+        while True:
+            result = self._database.execute_fetch_one(
+                '''
+                SELECT MIN(timestamp)
+                FROM %s.%s
+                WHERE timestamp >= ?
+                ''' % (self.SchemaName, self.TableName),
+                (start, ),
+                "Database error listing days of version 1 data")
+            if result[0] is None:
+                return dates
+            dates.append(ShortSamplesDAO.get_date(result[0]))
+            start = ShortSamplesDAO.get_date_range(dates[-1])[1]
+
+    def get_day_count(self, date):
+        result = self._database.execute_fetch_one(
+            '''
+            SELECT COUNT(*)
+            FROM %s.%s
+            WHERE timestamp >= ? AND timestamp < ?
+            ''' % (self.SchemaName, self.TableName),
+            ShortSamplesDAO.get_date_range(date),
+            "Database error counting samples of %s in version 1 data" % date)
+        return result[0]
+
+    def list_day_timestamps(self, date):
+        return [row[0] for row in self._database.execute_fetch_generator(
+            '''
+            SELECT DISTINCT timestamp
+            FROM %s.%s
+            WHERE timestamp >= ? AND timestamp < ?
+            ORDER BY timestamp
+            ''' % (self.SchemaName, self.TableName),
+            ShortSamplesDAO.get_date_range(date),
+            "Database error listing timestamps of %s in version 1 data" % date)]
+
+    def create_work_tables(self, contract_ids):
+        # in the temporary schema : contract names to ids (the contracts
+        # table is in the application database, which is not attached),
+        # last state of each station, and changes at the current timestamp
+        for sql in (
+                '''
+                CREATE TEMP TABLE %s (
+                    contract_name TEXT PRIMARY KEY NOT NULL,
+                    contract_id INTEGER NOT NULL
+                ) WITHOUT ROWID
+                ''' % self.TableNameContracts,
+                '''
+                CREATE TEMP TABLE %s (
+                    contract_id INTEGER NOT NULL,
+                    station_number INTEGER NOT NULL,
+                    bike INTEGER NOT NULL,
+                    empty INTEGER NOT NULL,
+                    PRIMARY KEY (contract_id, station_number)
+                ) WITHOUT ROWID
+                ''' % self.TableNameLast,
+                '''
+                CREATE TEMP TABLE %s (
+                    timestamp INTEGER NOT NULL,
+                    contract_id INTEGER NOT NULL,
+                    station_number INTEGER NOT NULL,
+                    bike INTEGER NOT NULL,
+                    empty INTEGER NOT NULL
+                )
+                ''' % self.TableNameChanged):
+            self._database.execute_single(
+                sql, None, "Database error creating version 1 work tables")
+        self._database.execute_many(
+            '''
+            INSERT INTO temp.%s (contract_name, contract_id)
+            VALUES (?, ?)
+            ''' % self.TableNameContracts,
+            contract_ids.items(),
+            "Database error filling table [%s]" % self.TableNameContracts)
+
+    def find_changed_samples(self, timestamp):
+        # samples of a timestamp differing from the last state of their
+        # station (or the first one of the station), then the new state
+        self._database.execute_single(
+            '''
+            DELETE FROM temp.%s
+            ''' % self.TableNameChanged,
+            None,
+            "Database error while clearing %s table" % self.TableNameChanged)
+        changed = self._database.execute_single(
+            '''
+            INSERT INTO temp.%s
+            SELECT s.timestamp,
+                c.contract_id,
+                s.station_number,
+                s.bike,
+                s.empty
+            FROM %s.%s AS s JOIN temp.%s AS c
+            ON c.contract_name = s.contract_name
+            LEFT OUTER JOIN temp.%s AS l
+            ON l.contract_id = c.contract_id AND
+                l.station_number = s.station_number
+            WHERE s.timestamp = ? AND (
+                l.bike IS NULL OR
+                s.bike != l.bike OR
+                s.empty != l.empty)
+            ''' % (self.TableNameChanged, self.SchemaName, self.TableName,
+                   self.TableNameContracts, self.TableNameLast),
+            (timestamp, ),
+            "Database error finding changes in version 1 data")
+        self._database.execute_single(
+            '''
+            INSERT OR REPLACE INTO temp.%s
+            SELECT contract_id, station_number, bike, empty
+            FROM temp.%s
+            ''' % (self.TableNameLast, self.TableNameChanged),
+            None,
+            "Database error updating %s table" % self.TableNameLast)
+        return changed
+
+    def store_changed_samples(self, target_schema, earliest_timestamp=None):
+        # do not go beyond what is already in the target database, samples
+        # stored by an interrupted import are there already
+        return self._database.execute_single(
+            '''
+            INSERT OR IGNORE INTO %s.%s (
+                timestamp,
+                contract_id,
+                station_number,
+                available_bikes,
+                available_bike_stands)
+            SELECT timestamp, contract_id, station_number, bike, empty
+            FROM temp.%s
+            WHERE ? IS NULL OR timestamp < ?
+            ''' % (target_schema, ShortSamplesDAO.TableNameArchive,
+                   self.TableNameChanged),
+            (earliest_timestamp, earliest_timestamp),
+            "Database error storing samples from version 1 data")
@@ -0,0 +1,73 @@
+# synthetic API replies journal, replayed into temporary data folders
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import calendar
+import tempfile
+import subprocess
+
+import jcd.common
+
+RootPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FirstDate = "2016-03-01"
+LastDate = "2016-03-03"
+
+# station 5 of the contract never changes after the first cycle
+IdleStation = 5
+
+
+def write_journal(data_path, interval=600, seed=1):
+    random.seed(seed)
+    journal = jcd.common.ResponseJournal(data_path)
+    start = calendar.timegm(time.strptime(FirstDate, "%Y-%m-%d")) + 1800
+    end = calendar.timegm(time.strptime(LastDate, "%Y-%m-%d")) + 86400
+    contracts = [{"name": "Lyon", "commercial_name": "Velo'v",
+                  "country_code": "FR", "cities": ["Lyon"]}]
+    stations = [{"number": number, "contract_name": "Lyon",
+                 "name": "%05d - STATION" % number, "address": "RUE %d" % number,
+                 "position": {"lat": 45.75, "lng": 4.85}, "banking": False,
+                 "bonus": False, "status": "OPEN", "bike_stands": 20,
+                 "available_bike_stands": 10, "available_bikes": 10,
+                 "last_update": start * 1000}
+                for number in xrange(1, 11)]
+    list(journal.record(start, "contracts", "", [json.dumps(contracts)]))
+    for timestamp in xrange(start, end, interval):
+        for station in stations:
+            if station["number"] == IdleStation or random.random() > 0.2:
+                continue
+            bikes = random.randint(0, station["bike_stands"])
+            station["available_bikes"] = bikes
+            station["available_bike_stands"] = station["bike_stands"] - bikes
+            station["last_update"] = timestamp * 1000
+        list(journal.record(timestamp, "stations", "", [json.dumps(stations)]))
+
+
+def run_tool(data_path, *args):
+    return subprocess.check_output(
+        [sys.executable, os.path.join(RootPath, "jcdtool.py"),
+         "--datadir", data_path] + list(args))
+
+
+def replay(data_path, journal_path, **settings):
+    run_tool(data_path, "init")
+    for name, value in settings.iteritems():
+        run_tool(data_path, "config", "--%s" % name, str(value))
+    run_tool(data_path, "replay", FirstDate, LastDate, "--journal", journal_path)
+
+
+class TempFolders(object):
+
+    def __init__(self):
+        self._root = tempfile.mkdtemp(prefix="jcd_test_")
+
+    def get_path(self, name):
+        # data folders are created by init
+        return os.path.join(self._root, name)
+
+    def remove(self):
+        shutil.rmtree(self._root, True)
@@ -0,0 +1,41 @@
+import json
+import unittest
+
+import jcd.app
+import jcd.common
+
+
+class ApiReplyTest(unittest.TestCase):
+
+    Items = [1.5, -20, 3e5, 42, u"na\u00efve", {"number": 12, "name": "a, b]"},
+             [7, 8], True, None, 0.25]
+
+    def _iter_split(self, text, size):
+        return list(jcd.app.ApiAccess.iter_reply(
+            [text[i:i+size] for i in xrange(0, len(text), size)]))
+
+    def test_every_chunk_size(self):
+        # every item is cut at every position by one chunk size or another
+        text = json.dumps(self.Items, ensure_ascii=False).encode("utf-8")
+        for size in xrange(1, len(text) + 1):
+            self.assertEqual(self._iter_split(text, size), self.Items)
+
+    def test_number_at_chunk_boundary(self):
+        for chunks, expected in ((["[1", ".5]"], [1.5]),
+                                 (["[1", "e3 ]"], [1e3]),
+                                 (["[-", "2, 3", "4]"], [-2, 34]),
+                                 (["[12", " ", ",3]"], [12, 3])):
+            self.assertEqual(list(jcd.app.ApiAccess.iter_reply(chunks)), expected)
+
+    def test_truncated_reply(self):
+        for chunks in (["[1", ", 2"], ["[1.", "5"], ['["abc']):
+            with self.assertRaises(jcd.common.JcdException):
+                list(jcd.app.ApiAccess.iter_reply(chunks))
+
+    def test_missing_delimiter(self):
+        with self.assertRaises(jcd.common.JcdException):
+            list(jcd.app.ApiAccess.iter_reply(["[1 2", "]"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
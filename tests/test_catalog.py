@@ -0,0 +1,72 @@
+import shutil
+import sqlite3
+import unittest
+
+import jcd.dao
+import jcd.common
+import tests.journal
+
+
+class CatalogUpgradeTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folders = tests.journal.TempFolders()
+        journal_path = cls.folders.get_path("journal")
+        tests.journal.write_journal(journal_path)
+        cls.reference_path = cls.folders.get_path("reference")
+        tests.journal.run_tool(cls.reference_path, "init")
+        cls.upgraded_path = cls.folders.get_path("upgraded")
+        tests.journal.run_tool(cls.upgraded_path, "init")
+        for date in (tests.journal.FirstDate, tests.journal.LastDate):
+            tests.journal.run_tool(cls.reference_path, "replay", date,
+                                   "--journal", journal_path)
+            if date == tests.journal.FirstDate:
+                tests.journal.run_tool(cls.upgraded_path, "replay", date,
+                                       "--journal", journal_path)
+                # as an application database from before the catalog
+                cls._execute(cls.upgraded_path, "DROP TABLE %s" % jcd.dao.ArchivesDAO.TableName)
+        # collecting must not need the catalog to be rebuilt by hand
+        tests.journal.run_tool(cls.upgraded_path, "replay", tests.journal.LastDate,
+                               "--journal", journal_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.folders.remove()
+
+    @staticmethod
+    def _execute(data_path, sql):
+        connection = sqlite3.connect(jcd.common.SqliteDB.get_full_path("app.db", data_path))
+        try:
+            rows = connection.execute(sql).fetchall()
+            connection.commit()
+            return rows
+        finally:
+            connection.close()
+
+    def _get_catalog(self, data_path):
+        return self._execute(data_path, '''
+            SELECT date, file_name, file_format, num_samples, first_timestamp,
+                last_timestamp, contract_ids, file_size, checksum
+            FROM %s
+            ORDER BY date
+            ''' % jcd.dao.ArchivesDAO.TableName)
+
+    def test_store_catalogs_days_written_after_upgrade(self):
+        reference = self._get_catalog(self.reference_path)
+        self.assertEqual(self._get_catalog(self.upgraded_path),
+                         [row for row in reference if row[0] == tests.journal.LastDate])
+
+    def test_compaction_catalogs_whole_days(self):
+        catalogs = []
+        for data_path in (self.reference_path, self.upgraded_path):
+            compacted_path = self.folders.get_path("compacted_%i" % len(catalogs))
+            shutil.copytree(data_path, compacted_path)
+            tests.journal.run_tool(compacted_path, "admin", "--compact")
+            catalogs.append(self._get_catalog(compacted_path))
+        self.assertEqual(len(catalogs[0]), 2)
+        self.assertEqual(catalogs[1], catalogs[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import calendar
+import argparse
+import threading
+import unittest
+import subprocess
+
+import jcd.app
+import jcd.cmd
+import jcd.dao
+import jcd.common
+import tests.journal
+
+
+class ConcurrencyTest(unittest.TestCase):
+
+    # a cycle waiting for a reader would take about the read duration
+    MaxCycleLatency = 1.0
+    # seconds a sqlite3 session keeps its read transaction open
+    ReadDuration = 2.0
+    # seconds between two cycles, for the readers to run meanwhile
+    CycleInterval = 0.03
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folders = tests.journal.TempFolders()
+        cls.journal_path = cls.folders.get_path("journal")
+        tests.journal.write_journal(cls.journal_path)
+        cls.data_path = cls.folders.get_path("wal")
+        # the first day is collected already, the last one by the test
+        tests.journal.run_tool(cls.data_path, "--wal", "init")
+        tests.journal.run_tool(cls.data_path, "--wal", "replay", tests.journal.FirstDate,
+                               "--journal", cls.journal_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.folders.remove()
+
+    def setUp(self):
+        # the collector runs in this process, as with --wal
+        self.previous = (jcd.app.App.DataPath, jcd.app.App.DbName,
+                         jcd.common.SqliteDB.Wal)
+        jcd.app.App.DataPath = self.data_path
+        jcd.app.App.DbName = "app.db"
+        jcd.common.SqliteDB.Wal = True
+
+    def tearDown(self):
+        (jcd.app.App.DataPath, jcd.app.App.DbName,
+         jcd.common.SqliteDB.Wal) = self.previous
+
+    def _list_snapshots(self):
+        start = calendar.timegm(time.strptime(tests.journal.LastDate, "%Y-%m-%d"))
+        for timestamp, endpoint, query, body in jcd.common.ResponseJournal(
+                self.journal_path).read(start, start + 86400):
+            if endpoint == "stations":
+                yield timestamp, json.loads(body)
+
+    def _export_loop(self, stop, results):
+        # the current state in app.db, then the day being written
+        exports = (["stations"], [tests.journal.LastDate],
+                   [tests.journal.LastDate, "--at", "23:59"])
+        while not stop.is_set():
+            for export in exports:
+                process = subprocess.Popen(
+                    [sys.executable, os.path.join(tests.journal.RootPath, "jcdtool.py"),
+                     "--datadir", self.data_path, "export_csv"] + export,
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                error = process.communicate()[1]
+                results.append((process.returncode, error))
+
+    def _session_loop(self, stop, database_name):
+        # an analyst's sqlite3 session, in the middle of a long query
+        full_path = jcd.common.SqliteDB.get_full_path(database_name, self.data_path)
+        while not stop.is_set():
+            connection = sqlite3.connect(full_path, isolation_level=None)
+            try:
+                connection.execute("BEGIN")
+                connection.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+                stop.wait(self.ReadDuration)
+            finally:
+                connection.close()
+
+    def test_readers_do_not_block_store(self):
+        stop = threading.Event()
+        results = []
+        day_name = jcd.dao.ShortSamplesDAO.get_db_file_name(
+            jcd.dao.ShortSamplesDAO.get_schema_name(tests.journal.LastDate))
+        readers = [threading.Thread(target=self._export_loop, args=(stop, results)),
+                   threading.Thread(target=self._session_loop, args=(stop, "app.db")),
+                   threading.Thread(target=self._session_loop, args=(stop, day_name))]
+        latencies = []
+        try:
+            with jcd.common.SqliteDB(jcd.app.App.DbName, self.data_path) as app_db:
+                fetch = jcd.cmd.FetchCmd(argparse.Namespace(contracts=False, state=False))
+                for timestamp, stations in self._list_snapshots():
+                    start = time.time()
+                    fetch.store_state(app_db, stations, timestamp)
+                    jcd.cmd.StoreCmd.store(app_db)
+                    latencies.append(time.time() - start)
+                    # once the daily database of the last day exists
+                    if len(latencies) == 1:
+                        for reader in readers:
+                            reader.start()
+                    time.sleep(self.CycleInterval)
+        finally:
+            stop.set()
+            for reader in readers:
+                if reader.is_alive():
+                    reader.join()
+        self.assertGreater(len(results), 3)
+        self.assertEqual([error for code, error in results if code != 0], [])
+        self.assertLess(max(latencies), self.MaxCycleLatency)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import shutil
+import unittest
+
+import jcd.app
+import jcd.dao
+import jcd.common
+import jcd.archive
+import tests.journal
+
+
+class KeyframesTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folders = tests.journal.TempFolders()
+        cls.journal_path = cls.folders.get_path("journal")
+        tests.journal.write_journal(cls.journal_path)
+        cls.with_keyframes = cls.folders.get_path("hourly")
+        tests.journal.replay(cls.with_keyframes, cls.journal_path,
+                             keyframe_interval=3600)
+        cls.without_keyframes = cls.folders.get_path("none")
+        tests.journal.replay(cls.without_keyframes, cls.journal_path,
+                             keyframe_interval=0)
+        # the same days, in the compact format
+        cls.compacted = cls.folders.get_path("compacted")
+        shutil.copytree(cls.with_keyframes, cls.compacted)
+        tests.journal.run_tool(cls.compacted, "admin", "--compact")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.folders.remove()
+
+    def test_state_at_same_without_keyframes(self):
+        for date in (tests.journal.FirstDate, tests.journal.LastDate):
+            for at in ("00:00:00", "00:40", "08:30", "23:59:59"):
+                self.assertEqual(
+                    tests.journal.run_tool(self.with_keyframes, "export_csv", date, "--at", at),
+                    tests.journal.run_tool(self.without_keyframes, "export_csv", date, "--at", at))
+
+    def test_idle_station_keeps_last_change(self):
+        first = tests.journal.run_tool(
+            self.with_keyframes, "export_csv", tests.journal.FirstDate, "--at", "01:00",
+            "--contract", "Lyon", "--station", str(tests.journal.IdleStation))
+        last = tests.journal.run_tool(
+            self.with_keyframes, "export_csv", tests.journal.LastDate, "--at", "12:00",
+            "--contract", "Lyon", "--station", str(tests.journal.IdleStation))
+        self.assertNotEqual(first, "")
+        self.assertEqual(first, last)
+
+    def test_grid_same_without_keyframes(self):
+        self.assertEqual(
+            tests.journal.run_tool(self.with_keyframes, "export_csv",
+                                   tests.journal.LastDate, "--step", "3600"),
+            tests.journal.run_tool(self.without_keyframes, "export_csv",
+                                   tests.journal.LastDate, "--step", "3600"))
+
+    def _list_keyframes(self, date):
+        schema_name = jcd.dao.ShortSamplesDAO.get_schema_name(date)
+        with jcd.common.SqliteDB(jcd.dao.ShortSamplesDAO.get_db_file_name(schema_name),
+                                 self.with_keyframes, read_only=True) as day_db:
+            expected = [tuple(row) for row in
+                        jcd.dao.ShortSamplesDAO(day_db).list_keyframes("main")]
+        with jcd.archive.CompactArchive(jcd.common.SqliteDB.get_full_path(
+                jcd.dao.ShortSamplesDAO.get_compact_file_name(schema_name),
+                self.compacted)) as archive:
+            compacted = [(keyframe, ) + sample
+                         for keyframe in archive.get_keyframes()
+                         for sample in archive.read_keyframe(keyframe)]
+        return expected, compacted
+
+    def test_compaction_keeps_keyframes(self):
+        for date in (tests.journal.FirstDate, tests.journal.LastDate):
+            expected, compacted = self._list_keyframes(date)
+            self.assertEqual(len(set(row[0] for row in expected)), 24)
+            self.assertEqual(compacted, expected)
+
+    def test_state_at_same_after_compaction(self):
+        previous = jcd.app.App.DataPath
+        jcd.app.App.DataPath = self.compacted
+        try:
+            with jcd.common.SqliteDB("app.db", self.compacted, read_only=True) as app_db:
+                keyframe = jcd.dao.ShortSamplesDAO(app_db).find_keyframe(
+                    jcd.dao.ShortSamplesDAO.get_date_range(tests.journal.LastDate)[0] + 30600)
+        finally:
+            jcd.app.App.DataPath = previous
+        self.assertTrue(keyframe[0].endswith(jcd.archive.CompactArchive.Extension))
+        for date in (tests.journal.FirstDate, tests.journal.LastDate):
+            for at in ("00:00:00", "08:30", "23:59:59"):
+                self.assertEqual(
+                    tests.journal.run_tool(self.compacted, "export_csv", date, "--at", at),
+                    tests.journal.run_tool(self.with_keyframes, "export_csv", date, "--at", at))
+        self.assertEqual(
+            tests.journal.run_tool(self.compacted, "export_csv", tests.journal.LastDate,
+                                   "--at", "12:00", "--contract", "Lyon",
+                                   "--station", str(tests.journal.IdleStation)),
+            tests.journal.run_tool(self.with_keyframes, "export_csv", tests.journal.LastDate,
+                                   "--at", "12:00", "--contract", "Lyon",
+                                   "--station", str(tests.journal.IdleStation)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import os
+import unittest
+
+import jcd.common
+import tests.journal
+
+
+class FailingWriter(jcd.common.OutputWriter):
+
+    PutTimeout = 0.1
+
+    def _write_chunk(self, chunk):
+        raise ValueError("compression failed")
+
+
+class StoppedWriter(jcd.common.OutputWriter):
+
+    PutTimeout = 0.1
+
+    def _run(self):
+        return
+
+
+class OutputWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folders = tests.journal.TempFolders()
+        self.file_path = self.folders.get_path("output.csv")
+
+    def tearDown(self):
+        self.folders.remove()
+
+    def _write_until_error(self, writer_class):
+        chunk = "x" * writer_class.ChunkSize
+        with self.assertRaises(jcd.common.JcdException) as context:
+            with writer_class(self.file_path) as output:
+                # more than the queue holds
+                for _ in xrange(writer_class.QueueSize * 4):
+                    output.write(chunk)
+        self.assertFalse(os.path.exists(self.file_path))
+        return str(context.exception)
+
+    def test_thread_error_reaches_producer(self):
+        self.assertIn("ValueError: compression failed",
+                      self._write_until_error(FailingWriter))
+
+    def test_stopped_thread_does_not_block_producer(self):
+        self.assertIn("stopped", self._write_until_error(StoppedWriter))
+
+
+if __name__ == '__main__':
+    unittest.main()
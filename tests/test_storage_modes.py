@@ -0,0 +1,106 @@
+import json
+import shutil
+import argparse
+import unittest
+
+import jcd.cmd
+import jcd.dao
+import jcd.common
+import tests.journal
+
+
+class StorageModesTest(unittest.TestCase):
+
+    Modes = ("tables", "memory", "direct")
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folders = tests.journal.TempFolders()
+        cls.journal_path = cls.folders.get_path("journal")
+        tests.journal.write_journal(cls.journal_path)
+        for mode in cls.Modes:
+            tests.journal.replay(cls.folders.get_path(mode), cls.journal_path,
+                                 storage_mode=mode)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.folders.remove()
+
+    def _assert_same_export(self, *args):
+        expected = tests.journal.run_tool(
+            self.folders.get_path("tables"), "export_csv", *args)
+        self.assertNotEqual(expected, "")
+        for mode in self.Modes[1:]:
+            self.assertEqual(
+                tests.journal.run_tool(self.folders.get_path(mode), "export_csv", *args),
+                expected, "%s differs from tables" % mode)
+
+    def test_stations_same_in_all_modes(self):
+        self._assert_same_export("stations")
+
+    def test_samples_same_in_all_modes(self):
+        for date in (tests.journal.FirstDate, tests.journal.LastDate):
+            self._assert_same_export(date)
+
+
+class MemoryChangesTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folders = tests.journal.TempFolders()
+        journal_path = cls.folders.get_path("journal")
+        tests.journal.write_journal(journal_path)
+        cls.replayed_path = cls.folders.get_path("replayed")
+        tests.journal.replay(cls.replayed_path, journal_path, storage_mode="memory")
+        # the last snapshot, already stored by the replay
+        for timestamp, endpoint, query, body in jcd.common.ResponseJournal(
+                journal_path).read(0, 1 << 31):
+            if endpoint == "stations":
+                cls.last_timestamp = timestamp
+                cls.stations = json.loads(body)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.folders.remove()
+
+    def setUp(self):
+        # storing commits, each test starts from the replayed state
+        self.data_path = self.folders.get_path(self.id())
+        shutil.copytree(self.replayed_path, self.data_path)
+
+    @staticmethod
+    def _read_tables(app_db):
+        changed = list(app_db.execute_fetch_generator(
+            "SELECT * FROM %s" % jcd.dao.ShortSamplesDAO.TableNameChanged))
+        state = [tuple(row) for row in app_db.execute_fetch_generator(
+            "SELECT * FROM %s ORDER BY contract_id, station_number" %
+            jcd.dao.FullSamplesDAO.TableNameOld)]
+        return changed, state
+
+    def _store_again(self, stations):
+        # changed samples and state rows, before and after storing
+        with jcd.common.SqliteDB("app.db", self.data_path) as app_db:
+            before = self._read_tables(app_db)
+            fetch = jcd.cmd.FetchCmd(argparse.Namespace(contracts=False, state=False))
+            fetch.store_state(app_db, stations, self.last_timestamp + 600)
+            return before, self._read_tables(app_db)
+
+    def test_unchanged_snapshot_writes_nothing(self):
+        before, after = self._store_again(self.stations)
+        self.assertEqual(before[0], [])
+        self.assertEqual(after[0], [])
+        self.assertEqual(after[1], before[1])
+
+    def test_changed_station_writes_one_row(self):
+        stations = [dict(station) for station in self.stations]
+        station = stations[0]
+        station["available_bikes"] = (station["available_bikes"] + 1) % (
+            station["bike_stands"] + 1)
+        station["available_bike_stands"] = station["bike_stands"] - station["available_bikes"]
+        station["last_update"] += 600000
+        before, after = self._store_again(stations)
+        self.assertEqual(len(after[0]), 1)
+        self.assertEqual(len([row for row in after[1] if row not in before[1]]), 1)
+
+if __name__ == '__main__':
+    unittest.main()
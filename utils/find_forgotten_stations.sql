@@ -7,8 +7,9 @@
 
 ATTACH 'stats.db' AS stats;
 
+-- stations keep their last state for a few days, use their last change
 CREATE TEMPORARY TABLE temp.latest AS
-    SELECT contract_id, station_number, MAX(b.start_of_day) AS latest
+    SELECT contract_id, station_number, MAX(b.last_change) AS latest
     FROM stats.activity_stations_day AS b
     GROUP BY contract_id, station_number;
 
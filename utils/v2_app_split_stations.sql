@@ -0,0 +1,129 @@
+-- ---------------------------------------------------------------------------
+-- The MIT License (MIT)
+--
+-- Copyright (c) 2015-2016 Nicolas Pillot
+--
+-- Permission is hereby granted, free of charge, to any person obtaining a
+-- copy of this software and associated documentation files (the 'Software'),
+-- to deal in the Software without restriction, including without limitation
+-- the rights to use, copy, modify, merge, publish, distribute, sublicense,
+-- and/or sell copies of the Software, and to permit persons to whom the
+-- Software is furnished to do so, subject to the following conditions:
+--
+-- The above copyright notice and this permission notice shall be included
+-- in all copies or substantial portions of the Software.
+--
+-- THE SOFTWARE IS PROVIDED 'AS IS', WITHOUT WARRANTY OF ANY KIND, EXPRESS
+-- OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+-- FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+-- THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+-- LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+-- FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+-- DEALINGS IN THE SOFTWARE.
+-- ---------------------------------------------------------------------------
+
+-- ---------------------------------------------------------------------------
+-- INFORMATION
+--
+-- This SQL script is to be used on the application database (app.db)
+-- 1) in the version 2 format
+-- 2) and CREATED before station information had its own table
+--
+-- New and old samples tables held the station information (name, address,
+-- position, stands, bonus, banking) for every station, rewritten on every
+-- fetch. It now lives in the stations table, one row per version of the
+-- information of each station, and samples tables only hold counters.
+-- Using this script IS mandatory before using the new version.
+--
+-- HOW TO USE / EXAMPLE
+--
+-- stop the cron job or daemon, do a last store, then execute :
+-- sqlite3 -bail app.db < v2_app_split_stations.sql
+-- ---------------------------------------------------------------------------
+
+-- current station information, valid since its last sample
+CREATE TABLE stations (
+	contract_id INTEGER NOT NULL,
+	station_number INTEGER NOT NULL,
+	valid_from INTEGER NOT NULL,
+	valid_until INTEGER,
+	bike_stands INTEGER NOT NULL,
+	bonus INTEGER NOT NULL,
+	banking INTEGER NOT NULL,
+	position TEXT NOT NULL,
+	address TEXT NOT NULL,
+	station_name TEXT NOT NULL,
+	PRIMARY KEY (contract_id, station_number, valid_from)
+) WITHOUT ROWID;
+
+INSERT INTO stations
+	SELECT
+		contract_id,
+		station_number,
+		timestamp,
+		NULL,
+		bike_stands,
+		bonus,
+		banking,
+		position,
+		address,
+		station_name
+	FROM old_samples;
+
+-- samples tables without station information
+CREATE TABLE new_samples_counters (
+	timestamp INTEGER NOT NULL,
+	contract_id INTEGER NOT NULL,
+	station_number INTEGR NOT NULL,
+	available_bikes INTEGER NOT NULL,
+	available_bike_stands INTEGER NOT NULL,
+	status INTEGER NOT NULL,
+	last_update INTEGER,
+	PRIMARY KEY (contract_id, station_number)
+) WITHOUT ROWID;
+
+CREATE TABLE old_samples_counters (
+	timestamp INTEGER NOT NULL,
+	contract_id INTEGER NOT NULL,
+	station_number INTEGR NOT NULL,
+	available_bikes INTEGER NOT NULL,
+	available_bike_stands INTEGER NOT NULL,
+	status INTEGER NOT NULL,
+	last_update INTEGER,
+	PRIMARY KEY (contract_id, station_number)
+) WITHOUT ROWID;
+
+INSERT INTO new_samples_counters
+	SELECT
+		timestamp,
+		contract_id,
+		station_number,
+		available_bikes,
+		available_bike_stands,
+		status,
+		last_update
+	FROM new_samples;
+
+INSERT INTO old_samples_counters
+	SELECT
+		timestamp,
+		contract_id,
+		station_number,
+		available_bikes,
+		available_bike_stands,
+		status,
+		last_update
+	FROM old_samples;
+
+-- use new tables as old
+DROP TABLE new_samples;
+DROP TABLE old_samples;
+
+ALTER TABLE new_samples_counters
+	RENAME TO new_samples;
+
+ALTER TABLE old_samples_counters
+	RENAME TO old_samples;
+
+-- reclaim disk space
+VACUUM;